@@ -0,0 +1,148 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+
+import analysis
+import functions
+import loader
+
+
+# Constants
+LEVEL_IDS = list(range(1, 7))
+GROUP_BY = 'OS_generic'
+VALID_GROUP_BY = ['OS', 'OS_generic', 'is_mobile']
+NUM_TOP = 10
+
+
+# Functions
+def get_dist_matrix(points, users, dists, level_ids=LEVEL_IDS):
+    """ Pivot distances of the points into a dense users x levels matrix, in one scatter.
+
+        points    : pd.DataFrame with (user_id, level) columns
+        users     : pd.DataFrame indexed by user id
+        dists     : array-like
+            Distance of each point, e.g. from functions.get_dist_levels
+        level_ids : list of int (default: LEVEL_IDS)
+
+        Returns : pd.DataFrame of float32
+            Distances with the index of users and level_ids as columns, NaN where a user has no point
+    """
+    level_ids = np.asarray(level_ids)
+    rows = users.index.get_indexer(points['user_id'].values)
+    cols = np.searchsorted(level_ids, points['level'].values)
+    cols = np.minimum(cols, len(level_ids) - 1)
+    keep = (rows >= 0) & (level_ids[cols] == points['level'].values)
+
+    matrix = np.full((len(users), len(level_ids)), np.nan, dtype=np.float32)
+    matrix[rows[keep], cols[keep]] = np.asarray(dists, dtype=np.float32)[keep]
+    return pd.DataFrame(matrix, index=users.index, columns=pd.Index(level_ids, name='level'))
+
+
+def calc_user_stats(dist_matrix):
+    """ Mean distance of every user over the levels they played, and their rank (1 for the smallest mean).
+
+        Returns : pd.DataFrame with (mean, rank) columns, indexed as dist_matrix
+    """
+    with np.errstate(invalid='ignore'):
+        means = np.nanmean(dist_matrix.values, axis=1, dtype=np.float64)
+    user_stats = pd.DataFrame({'mean': means}, index=dist_matrix.index)
+    user_stats['rank'] = user_stats['mean'].rank(method='min').astype('Int64')
+    return user_stats
+
+
+def calc_group_stats(dist_matrix, groups):
+    """ Size, mean and standard deviation of distances per (group, level), and z-test of each group against the others.
+
+        All groups and levels are reduced together by three bincounts over the flattened matrix. The z-test
+        is two-sided and compares the mean of a group with the mean of all other users of the level.
+
+        dist_matrix : pd.DataFrame from get_dist_matrix
+        groups      : array-like
+            Group of every user, e.g. users['OS_generic'] or users['is_mobile']
+
+        Returns : pd.DataFrame
+            n, mean, std, z and pvalue indexed by (group, level)
+    """
+    codes, uniques = pd.factorize(np.asarray(groups), use_na_sentinel=True)
+    n_groups, n_levels = len(uniques), dist_matrix.shape[1]
+    values = dist_matrix.values.astype(np.float64)
+
+    # Centre each level on its mean so that sums of squares keep their precision
+    valid = ~np.isnan(values) & (codes >= 0)[:, None]
+    with np.errstate(invalid='ignore'):
+        centre = np.nanmean(np.where(valid, values, np.nan), axis=0)
+    centred = np.where(valid, values - centre, 0.0)
+    flat_idx = (np.maximum(codes, 0)[:, None]*n_levels + np.arange(n_levels)).ravel()
+    size = n_groups*n_levels
+    n = np.bincount(flat_idx, valid.ravel(), size).reshape(n_groups, n_levels)
+    sums = np.bincount(flat_idx, centred.ravel(), size).reshape(n_groups, n_levels)
+    sq_sums = np.bincount(flat_idx, (centred*centred).ravel(), size).reshape(n_groups, n_levels)
+
+    # Same moments for the users outside each group, from the level totals
+    n_rest, sums_rest, sq_sums_rest = n.sum(axis=0) - n, sums.sum(axis=0) - sums, sq_sums.sum(axis=0) - sq_sums
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean, mean_rest = sums / n, sums_rest / n_rest
+        var = (sq_sums - n*mean*mean) / (n - 1)
+        var_rest = (sq_sums_rest - n_rest*mean_rest*mean_rest) / (n_rest - 1)
+        z = (mean - mean_rest) / np.sqrt(var/n + var_rest/n_rest)
+    pvalue = 2.0 * analysis.norm_cdf(-np.abs(z))
+
+    index = pd.MultiIndex.from_product([uniques, dist_matrix.columns], names=['group', 'level'])
+    return pd.DataFrame({
+        'n': n.ravel().astype(np.int64),
+        'mean': (mean + centre).ravel(),
+        'std': np.sqrt(np.maximum(var, 0.0)).ravel(),
+        'z': z.ravel(),
+        'pvalue': pvalue.ravel(),
+    }, index=index)
+
+
+def parse_and_assert_args():
+    arg_parser = argparse.ArgumentParser(prog='pinisi', description="Per-user and per-OS accuracy of Pinisi players", usage="")
+
+    arg_parser.add_argument('-g', dest='group_by', help="Users column to group by. One of {} (default: '{}')".format(VALID_GROUP_BY, GROUP_BY))
+    arg_parser.add_argument('-n', dest='num_top', help='Number of most accurate users to print (default: {})'.format(NUM_TOP))
+    arg_parser.add_argument('-o', dest='save_to', help="Write the group table to this file, as JSON if it ends with '.json', else as CSV (default: None)")
+
+    args = arg_parser.parse_args()
+    if args.group_by is not None:
+        assert args.group_by in VALID_GROUP_BY, "group_by must be one of {}".format(VALID_GROUP_BY)
+    if args.num_top is not None:
+        assert int(args.num_top) >= 0, "num_top must be >= 0"
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_and_assert_args()
+    group_by = args.group_by or GROUP_BY
+    num_top = int(args.num_top) if args.num_top else NUM_TOP
+
+    points, users, levels, rects, TRUTH_ID, EXPERT_ID = loader.load_data()
+
+    points_truth = points[points.user_id == TRUTH_ID].reset_index(drop=True)
+    points_expert = points[points.user_id == EXPERT_ID].reset_index(drop=True)
+    points = points[~points.user_id.isin([TRUTH_ID, EXPERT_ID])].reset_index(drop=True)
+    users = users[~users.index.isin([TRUTH_ID, EXPERT_ID])]
+
+    dists, dists_expert = functions.get_dist_levels(points_truth, points_expert, points)
+    dist_matrix = get_dist_matrix(points, users, dists)
+    user_stats = calc_user_stats(dist_matrix)
+    group_stats = calc_group_stats(dist_matrix, users[group_by])
+
+    if args.save_to:
+        if args.save_to.endswith('.json'):
+            group_stats.reset_index().to_json(args.save_to, orient='records', indent=1)
+        else:
+            group_stats.to_csv(args.save_to)
+
+    print("Pinisi accuracy of {} players over {} levels, grouped by {}".format(len(users), len(LEVEL_IDS), group_by))
+    print()
+    print("Most accurate players")
+    print("---------------------")
+    print(user_stats.sort_values('rank').head(num_top).join(users[['OS', 'OS_generic', 'is_mobile']]))
+    print()
+    print("Groups")
+    print("------")
+    with pd.option_context('display.max_rows', None, 'display.width', None):
+        print(group_stats.round({'mean': 4, 'std': 4, 'z': 3}))
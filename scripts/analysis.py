@@ -1,14 +1,16 @@
 import argparse
-import json
 import math
+import numbers
 import os
 
-import matplotlib.pyplot as plt
 import pandas as pd
-import scipy as scp
-import seaborn as sns
 
+import bootstrap
 import functions
+import incremental
+import loader
+import profiling
+import render
 
 
 # Constants
@@ -26,35 +28,37 @@ XLABEL = 'Jarak'
 YLABEL = 'Jumlah pemain'
 NUM_IQR = 2.0
 
-sns.set_style('white')
-
 # Functions
 def plot_level(dist_points, dist_expert, level_id, is_hist=True, bw=None, num_bins=NUM_BINS,
 	col_points=COL_POINTS, col_expert=COL_EXPERT, lw_expert=LW_EXPERT,
-	title=None, xlabel=None, ylabel=None, save_to=None):
+	title=None, xlabel=None, ylabel=None, save_to=None, ax=None):
+	import matplotlib.pyplot as plt
+	import seaborn as sns
+
+	ax = plt.gca() if ax is None else ax
 	if is_hist:
-		ax = dist_points.plot.hist(bins=num_bins, color=col_points)
+		dist_points.plot.hist(bins=num_bins, color=col_points, ax=ax)
 	else:
 		if bw:
-			ax = sns.kdeplot(dist_points, bw=bw, color=col_points)
+			sns.kdeplot(dist_points, bw=bw, color=col_points, ax=ax)
 		else:
-			ax = sns.kdeplot(dist_points, color=col_points)
+			sns.kdeplot(dist_points, color=col_points, ax=ax)
 
-	plt.axvline(dist_expert, 0, len(dist_points), color=col_expert, lw=LW_EXPERT)
+	ax.axvline(dist_expert, 0, len(dist_points), color=col_expert, lw=LW_EXPERT)
 
-	plt.title(title or "Distribusi jarak pemain - Level {}".format(level_id))
-	plt.xlabel(xlabel or XLABEL)
+	ax.set_title(title or "Distribusi jarak pemain - Level {}".format(level_id))
+	ax.set_xlabel(xlabel or XLABEL)
 	if ylabel:
-		plt.ylabel(ylabel)
+		ax.set_ylabel(ylabel)
 	else:
-		plt.ylabel("Jumlah pemain" if is_hist else "Distribusi")
+		ax.set_ylabel("Jumlah pemain" if is_hist else "Distribusi")
 
 	if save_to:
 		try:
 			os.makedirs(save_to)
 		except:
 			pass
-		plt.savefig(os.path.join(save_to, 'level{}.png'.format(level_id)))
+		ax.figure.savefig(os.path.join(save_to, 'level{}.png'.format(level_id)))
 
 	return ax
 
@@ -65,20 +69,43 @@ def calc_test_stat_and_pvalue(X, ref, alternative='unequal'):
 		Returns : float, float
 		    Statistic and p-value of the test
 	"""
-	n = len(X)
-	mean, se = X.mean(), X.std()/math.sqrt(n)
+	return calc_test_stat_and_pvalue_moments(len(X), X.mean(), X.std(), ref, alternative=alternative)
+
+
+def calc_test_stat_and_pvalue_moments(n, mean, std, ref, alternative='unequal'):
+	""" Same as calc_test_stat_and_pvalue, from the size, mean and standard deviation of the points,
+		e.g. kept by incremental.LevelStats.
+	"""
+	se = std/math.sqrt(n)
 	test_stat = (mean - ref)/se
 	
 	if alternative == 'unequal':
-		pvalue = scp.stats.norm.pdf(test_stat)
+		pvalue = norm_pdf(test_stat)
 	elif alternative == 'greater':
-		pvalue = 1.0 - scp.stats.norm.cdf(test_stat)
+		pvalue = 1.0 - norm_cdf(test_stat)
 	elif alternative == 'less':
-		pvalue = scp.stats.norm.cdf(test_stat)
+		pvalue = norm_cdf(test_stat)
 	
 	return test_stat, pvalue
 
 
+def norm_pdf(x):
+	""" Standard normal density, without importing scipy. """
+	return math.exp(-0.5*x*x) / math.sqrt(2*math.pi)
+
+
+def norm_cdf(x):
+	""" Standard normal cumulative distribution of a number or an array.
+
+		Numbers go through math.erfc, which keeps full precision in the lower tail, without importing scipy.
+		Arrays go through scipy.special.ndtr in one vectorised call.
+	"""
+	if isinstance(x, numbers.Real):
+		return 0.5*math.erfc(-x/math.sqrt(2))
+	from scipy.special import ndtr
+	return ndtr(x)
+
+
 def test_signif(test_stat, pvalue, alpha=0.05, alternative='unequal'):
 	""" Decides whether test statistic and p-value is significance for the given significance level and alternative hypothesis.
 
@@ -105,20 +132,35 @@ def format_pvalue(pvalue):
 	return ("%.3f" % pvalue)
 
 
+def save_results(results, save_to):
+	""" Write the results table to save_to, as JSON keyed by level if it ends with '.json', else as CSV. """
+	if save_to.endswith('.json'):
+		results.to_json(save_to, orient='index', indent=1)
+	else:
+		results.to_csv(save_to)
+
+
 def parse_and_assert_args():
 	arg_parser = argparse.ArgumentParser(prog='pinisi', description="Statistical analysis for Pinisi data", usage="")
 
 	arg_parser.add_argument('-a', dest='alpha', help='Significance level of the z-test (default: {})'.format(ALPHA))
 	arg_parser.add_argument('-d', dest='direction', help="Direction of alternative hypothesis of the z-test. One of 'unequal', 'greater', or 'less' (default '{}')".format(DIRECTION))
 	arg_parser.add_argument('-r', dest='filter_rect', action='store_true', help='Filter data points only inside rectangle. Takes precedence over num_iqr')
+	arg_parser.add_argument('-g', dest='filter_polygon', action='store_true', help='Filter data points only inside level polygon. Takes precedence over filter_rect and num_iqr (default: False)')
 	arg_parser.add_argument('-i', dest='num_iqr', help='Filter data points outside num_iqr * IQR. Set to 0 to prevent filtering (default: {})'.format(NUM_IQR))
 	arg_parser.add_argument('-p', dest='is_format_pvalue', action='store_true', help='Format p-value to be more readable (default: False)')
 	arg_parser.add_argument('-s', dest='save_to', help='Directory for saving plots (default: None)')
+	arg_parser.add_argument('-b', dest='num_resamples', help='Compute p-values and confidence intervals from this many bootstrap resamples instead of the z-test (default: None)')
+	arg_parser.add_argument('-o', dest='save_results', help="Write the results table to this file, as JSON if it ends with '.json', else as CSV (default: None)")
+	arg_parser.add_argument('-u', dest='state_path', help='Keep per-level running statistics in this JSON file and only fold points added since the last run into them. Unfiltered z-test only: needs num_iqr 0 and cannot be used with filter_rect, filter_polygon, save_to or num_resamples (default: None)')
+	arg_parser.add_argument('--profile', dest='profile', help="Write a JSON report of stage timings and memory to this file, or folded stacks if it ends with '.folded' (default: None)")
+	arg_parser.add_argument('--seed', dest='seed', help='Seed of the bootstrap resamples (default: {})'.format(bootstrap.SEED))
 	
 	args = arg_parser.parse_args()
 	alpha = args.alpha
 	num_iqr = args.num_iqr
 	direction = args.direction
+	num_resamples = args.num_resamples
 	if alpha is not None:
 		alpha = float(alpha)
 		assert (alpha >= 0.0) and (alpha <= 1.0), "alpha must be between 0 and 1"
@@ -127,6 +169,12 @@ def parse_and_assert_args():
 		assert num_iqr >= 0.0, "num_iqr must be >= 0"
 	if direction is not None:
 		assert direction in VALID_DIRECTIONS, "direction must be one of {}".format(VALID_DIRECTIONS)
+	if num_resamples is not None:
+		num_resamples = int(num_resamples)
+		assert num_resamples > 0, "num_resamples must be > 0"
+	if args.state_path:
+		assert num_iqr == 0.0, "state_path needs num_iqr 0, since the running statistics are not filtered"
+		assert not (args.filter_rect or args.filter_polygon or args.save_to or num_resamples), "state_path cannot be used with filter_rect, filter_polygon, save_to or num_resamples"
 	return args
 
 
@@ -135,56 +183,98 @@ if __name__ == '__main__':
 	alpha = float(args.alpha) if args.alpha else ALPHA
 	direction = args.direction or DIRECTION
 	filter_rect = args.filter_rect
+	filter_polygon = args.filter_polygon
 	num_iqr = float(args.num_iqr) if args.num_iqr else NUM_IQR
 	is_format_pvalue = args.is_format_pvalue
 	save_to = args.save_to
-
-	TRUTH_ID = int(open('../data/truth_ID').read())
-	EXPERT_ID = int(open('../data/expert_ID').read())
-
-	points = pd.read_csv('../data/clean/points.psv', sep='|', index_col='id')
-	users = pd.read_csv('../data/clean/users.psv', sep='|', index_col='id')
-	levels = json.load(open('../data/levels.json', 'r'))['maps']
-	rects = {level['level']: functions.get_rect(level['polygon']) for level in levels}
-
-	points_truth = points[points.user_id == TRUTH_ID].reset_index(drop=True)
-	points_expert = points[points.user_id == EXPERT_ID].reset_index(drop=True)
-	points = points[~points.user_id.isin([TRUTH_ID, EXPERT_ID])].reset_index(drop=True)
-
-	dists = {level_id: functions.get_dist_level(points_truth, points_expert, points, level_id) for level_id in LEVEL_IDS}
-	dists_points = {level_id: d[0] for level_id, d in dists.items()}
-	dists_expert = {level_id: d[1] for level_id, d in dists.items()}
-
-	for level_id, dist_points in dists_points.items():
-		if filter_rect:
-			points_idx = functions.get_points_level(points, rects, level_id).index
-			dist_points = dist_points[points_idx]
-			dists_points[level_id] = dist_points
-		elif num_iqr:
-			dist_points = functions.filter_iqr(dist_points, num_iqr)
-			dists_points[level_id] = dist_points
-
-		dist_expert = dists_expert[level_id]
-		plot_level(dist_points, dist_expert, level_id, save_to=save_to)
-		plt.clf()
-	
-	stats_pvalues = {level_id: calc_test_stat_and_pvalue(dist_points, dists_expert[level_id], alternative=direction) for level_id, dist_points in dists_points.items()}
-	is_signifs = {level_id: test_signif(test_stat, pvalue, alpha=alpha, alternative=direction) for level_id, (test_stat, pvalue) in stats_pvalues.items()}
+	num_resamples = int(args.num_resamples) if args.num_resamples else None
+	seed = int(args.seed) if args.seed else bootstrap.SEED
+	state_path = args.state_path
+	if args.profile:
+		profiling.enable()
+
+	with profiling.stage('load') as stage:
+		points, users, levels, rects, TRUTH_ID, EXPERT_ID = loader.load_data()
+
+		points_truth = points[points.user_id == TRUTH_ID].reset_index(drop=True)
+		points_expert = points[points.user_id == EXPERT_ID].reset_index(drop=True)
+		points = points[~points.user_id.isin([TRUTH_ID, EXPERT_ID])]
+		point_ids = points.index.values
+		points = points.reset_index(drop=True)
+		stage.set_rows(len(points))
+
+	if state_path:
+		with profiling.stage('incremental') as stage:
+			level_stats, num_folded, is_rebuilt = incremental.refresh_level_stats(state_path, points, point_ids, points_truth, rects, LEVEL_IDS)
+			stage.set_rows(num_folded)
+
+		with profiling.stage('stats', rows=len(LEVEL_IDS)):
+			dists_expert = functions.get_dist_levels(points_truth, points_expert, points_expert)[1].to_dict()
+			stats_pvalues = {level_id: calc_test_stat_and_pvalue_moments(stats.n, stats.mean, stats.std, dists_expert[level_id], alternative=direction) for level_id, stats in level_stats.items()}
+			is_signifs = {level_id: test_signif(test_stat, pvalue, alpha=alpha, alternative=direction) for level_id, (test_stat, pvalue) in stats_pvalues.items()}
+	else:
+		with profiling.stage('distance', rows=len(points)):
+			dists, dists_expert = functions.get_dist_levels(points_truth, points_expert, points)
+			dists_levels = dists.groupby(points.level.values)
+			dists_points = {level_id: dists_levels.get_group(level_id) for level_id in LEVEL_IDS}
+			dists_expert = dists_expert.to_dict()
+
+		with profiling.stage('filter', rows=len(points)):
+			if filter_polygon:
+				in_polygon = functions.get_polygon_mask(points, functions.get_polygon_index(levels))
+
+			for level_id, dist_points in dists_points.items():
+				if filter_polygon:
+					points_idx = points.index[in_polygon & (points.level == level_id).values]
+					dists_points[level_id] = dist_points[points_idx]
+				elif filter_rect:
+					points_idx = functions.get_points_level(points, rects, level_id).index
+					dists_points[level_id] = dist_points[points_idx]
+				elif num_iqr:
+					dists_points[level_id] = functions.filter_iqr(dist_points, num_iqr)
+
+		with profiling.stage('plot'):
+			if save_to:
+				import seaborn as sns
+				sns.set_style('white')
+				plot_jobs = [render.Job(plot_level, (dist_points, dists_expert[level_id], level_id), {}, os.path.join(save_to, 'level{}.png'.format(level_id)))
+				             for level_id, dist_points in dists_points.items()]
+				render.render_all(plot_jobs)
+
+		with profiling.stage('stats', rows=sum(len(dist_points) for dist_points in dists_points.values())):
+			stats_pvalues = {level_id: calc_test_stat_and_pvalue(dist_points, dists_expert[level_id], alternative=direction) for level_id, dist_points in dists_points.items()}
+			if num_resamples:
+				boot_means = bootstrap.bootstrap_means(dists_points, num_resamples, seed=seed)
+				boot_pvalues_cis = {level_id: bootstrap.calc_bootstrap_pvalue_and_ci(dist_points, dists_expert[level_id], boot_means[level_id], alternative=direction, alpha=alpha) for level_id, dist_points in dists_points.items()}
+				stats_pvalues = {level_id: (test_stat, boot_pvalues_cis[level_id][0]) for level_id, (test_stat, pvalue) in stats_pvalues.items()}
+			is_signifs = {level_id: test_signif(test_stat, pvalue, alpha=alpha, alternative=direction) for level_id, (test_stat, pvalue) in stats_pvalues.items()}
 	results = pd.DataFrame({
 		'Test statistic': {level_id: test_stat for level_id, (test_stat, pvalue) in stats_pvalues.items()},
 		'P-value': {level_id: pvalue for level_id, (test_stat, pvalue) in stats_pvalues.items()},
 		'Significant?': {level_id: is_signif for level_id, is_signif in is_signifs.items()},
 	}, index=LEVEL_IDS)[['Test statistic', 'P-value', 'Significant?']]
 	
+	if num_resamples:
+		results['CI lower'] = pd.Series({level_id: ci[0] for level_id, (pvalue, ci) in boot_pvalues_cis.items()}).round(3)
+		results['CI upper'] = pd.Series({level_id: ci[1] for level_id, (pvalue, ci) in boot_pvalues_cis.items()}).round(3)
+
 	results.index.name = 'Level'
 	results['Test statistic'] = results['Test statistic'].round(3)
+	if args.save_results:
+		save_results(results, args.save_results)
 	if is_format_pvalue:
 		results['P-value'] = results['P-value'].apply(format_pvalue)
 
 	print("Pinisi data analysis with parameters:")
 	print("Alpha       = {}".format(alpha))
 	print("Alternative = {}".format(direction))
-	if filter_rect:
+	if state_path:
+		print("Test        = z-test on running statistics ({} points folded into {}{})".format(num_folded, state_path, ', rebuilt since folded points changed' if is_rebuilt else ''))
+	else:
+		print("Test        = {}".format("bootstrap ({} resamples, seed {})".format(num_resamples, seed) if num_resamples else 'z-test'))
+	if filter_polygon:
+		print("Filter      = level polygon")
+	elif filter_rect:
 		print("Filter      = level rectangle")
 	else:
 		print("Filter      = {}".format("{}x IQR".format(num_iqr) if num_iqr else 'None'))
@@ -193,3 +283,6 @@ if __name__ == '__main__':
 	print("Results")
 	print("-------")
 	print(results)
+
+	if args.profile:
+		profiling.report(args.profile)
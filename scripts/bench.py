@@ -0,0 +1,147 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import resource
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import clean
+import functions
+import synth
+
+
+# Constants
+SIZES = [10**4, 10**6, 10**7]
+PLAYS_PER_USER = 6.2    # average raw points per user of synth.generate
+CHUNKSIZE = 10**6
+REGRESSION_RATIO = 1.2
+
+
+# Functions
+def measure(func, *args, **kwargs):
+    """ Run func, recording wall time and CPU time, then run it again under tracemalloc for peak memory.
+
+        The memory run is separate because tracing slows down allocation-heavy Python code a lot.
+
+        Returns : result of func, dict
+    """
+    gc.collect()
+    start, start_cpu = time.perf_counter(), time.process_time()
+    result = func(*args, **kwargs)
+    seconds, cpu_seconds = time.perf_counter() - start, time.process_time() - start_cpu
+    del result
+
+    gc.collect()
+    tracemalloc.start()
+    result = func(*args, **kwargs)
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, {'seconds': seconds, 'cpu_seconds': cpu_seconds, 'peak_bytes': peak_bytes}
+
+
+def run_size(num_rows, levels, agents, seed=synth.SEED):
+    """ Benchmark every hot path and clean.py stage on synthetic data of about num_rows raw points.
+
+        Returns : list of dict
+            One record per stage with name, rows, seconds, cpu_seconds and peak_bytes
+    """
+    records = []
+
+    def bench(name, rows, func, *args, **kwargs):
+        result, stats = measure(func, *args, **kwargs)
+        records.append(dict(name=name, rows=rows, **stats))
+        print("{:>10} rows  {:<22} {:9.3f}s  {:9.1f} MB".format(rows, name, stats['seconds'], stats['peak_bytes'] / 2**20))
+        return result
+
+    num_users = max(2, int(num_rows / PLAYS_PER_USER))
+    rects = {level['level']: functions.get_rect(level['polygon']) for level in levels}
+    with tempfile.TemporaryDirectory() as data_dir:
+        points, users = bench('generate', num_rows, synth.generate, num_users, levels, agents, seed=seed)
+        bench('write_raw', len(points), synth.write_data_dir, points, users, levels, data_dir)
+        del points, users
+
+        points_path, users_path = os.path.join(data_dir, 'raw/points.psv'), os.path.join(data_dir, 'raw/users.psv')
+        points = bench('read_points', num_rows, pd.read_csv, points_path, sep='|', index_col='id')
+        users = bench('read_users', num_users, pd.read_csv, users_path, sep='|', index_col='id')
+        bench('stream_clean_points', len(points), clean.stream_clean_points, points_path, CHUNKSIZE)
+
+    points = bench('clean_points', len(points), clean.clean_points, points)
+    bench('browser_to_os', len(users), users['browser'].map, functions.browser_to_os)
+    functions.classify_agent.cache_clear()
+    bench('classify_agents', len(users), functions.classify_agents, users['browser'])
+    bench('clean_users', len(users), clean.clean_users, users, points['user_id'].unique())
+
+    points_truth = points[points.user_id == synth.TRUTH_ID]
+    points_expert = points[points.user_id == synth.EXPERT_ID]
+    points = points[~points.user_id.isin([synth.TRUTH_ID, synth.EXPERT_ID])]
+    level_id = int(points.level.iloc[0])
+
+    bench('get_points_level', len(points), functions.get_points_level, points, rects, level_id)
+    bench('get_bins', len(points), functions.get_bins, points, rects, level_id)
+    bench('get_bins_levels', len(points), functions.get_bins_levels, points, rects)
+    dist_points, dist_expert = bench('get_dist_level', len(points), functions.get_dist_level, points_truth, points_expert, points, level_id)
+    bench('get_dist_levels', len(points), functions.get_dist_levels, points_truth, points_expert, points)
+    bench('get_consensus_levels', len(points), functions.get_consensus_levels, points_truth, points, rects)
+    bench('filter_iqr', len(dist_points), functions.filter_iqr, dist_points, 2.0)
+    bench('filter_iqr_sketch', len(dist_points), functions.filter_iqr, dist_points, 2.0, method='sketch')
+    return records
+
+
+def compare(results, baseline, ratio=REGRESSION_RATIO):
+    """ Print the time ratio of each (name, rows) stage against a baseline run and flag regressions. """
+    base = {(r['name'], r['rows']): r for r in baseline['results']}
+    print("{:<22} {:>10} {:>10} {:>10} {:>7}".format('stage', 'rows', 'base (s)', 'new (s)', 'ratio'))
+    for r in results['results']:
+        b = base.get((r['name'], r['rows']))
+        if b is None:
+            continue
+        r_ratio = r['seconds'] / max(b['seconds'], 1e-9)
+        flag = '  REGRESSION' if r_ratio > ratio else ''
+        print("{:<22} {:>10} {:>10.3f} {:>10.3f} {:>7.2f}{}".format(r['name'], r['rows'], b['seconds'], r['seconds'], r_ratio, flag))
+
+
+def parse_and_assert_args():
+    arg_parser = argparse.ArgumentParser(prog='pinisi', description="Benchmark Pinisi hot paths on synthetic data", usage="")
+
+    arg_parser.add_argument('-n', dest='sizes', help='Comma-separated numbers of raw points (default: {})'.format(','.join(map(str, SIZES))))
+    arg_parser.add_argument('-o', dest='save_to', help='JSON file to write results to (default: None)')
+    arg_parser.add_argument('-c', dest='baseline', help='JSON results of a previous run to compare with (default: None)')
+    arg_parser.add_argument('--seed', dest='seed', help='Random seed of the synthetic data (default: {})'.format(synth.SEED))
+
+    args = arg_parser.parse_args()
+    if args.sizes is not None:
+        args.sizes = [int(size) for size in args.sizes.split(',')]
+        assert all(size >= 20 for size in args.sizes), "sizes must be >= 20"
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_and_assert_args()
+    sizes = args.sizes or SIZES
+    seed = int(args.seed) if args.seed else synth.SEED
+
+    levels, agents = synth.load_levels_and_agents()
+    records = []
+    for size in sizes:
+        records += run_size(size, levels, agents, seed=seed)
+
+    results = {
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'results': records,
+    }
+    if args.save_to:
+        with open(args.save_to, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.baseline:
+        compare(results, json.load(open(args.baseline, 'r')))
@@ -0,0 +1,153 @@
+import concurrent.futures
+import os
+
+import numpy as np
+
+
+# Constants
+MEMORY_BUDGET = 256 * 2**20    # bytes of resample indices and values per block
+SEED = 0
+MAX_POSITIONS = 500    # number of sample sizes kept per running mean curve
+
+
+# Functions
+def bootstrap_means(X, num_resamples, seed=SEED, memory_budget=MEMORY_BUDGET, max_workers=None):
+    """ Bootstrap the mean of one or several samples in fixed-memory blocks, spread over a process pool.
+
+        Every (sample, block) pair gets its own RNG stream spawned from seed, so the result only depends
+        on seed, num_resamples and memory_budget, not on the number of workers.
+
+        X             : dict of key -> array-like
+            Samples to resample, e.g. distances per level
+        num_resamples : int
+        seed          : int (default: SEED)
+        memory_budget : int (default: MEMORY_BUDGET)
+            Maximum bytes of resample indices and values held by a worker at a time
+        max_workers   : int (default: None)
+            Size of the process pool, None for os.cpu_count(). Set to 1 to run in this process
+
+        Returns : dict of key -> np.array of shape (num_resamples,)
+            Bootstrap means of each sample
+    """
+    samples = {key: np.asarray(x, dtype=np.float64) for key, x in X.items()}
+    seeds = np.random.SeedSequence(seed).spawn(len(samples))
+
+    tasks = []
+    for (key, x), key_seed in zip(samples.items(), seeds):
+        block_size = max(1, memory_budget // (16 * max(len(x), 1)))
+        starts = list(range(0, num_resamples, block_size))
+        for start, block_seed in zip(starts, key_seed.spawn(len(starts))):
+            tasks.append((key, start, min(block_size, num_resamples - start), block_seed))
+
+    means = {key: np.empty(num_resamples) for key in samples}
+    max_workers = max_workers or os.cpu_count() or 1
+    if max_workers == 1:
+        for key, start, size, block_seed in tasks:
+            means[key][start:start + size] = _resample_block(samples[key], size, block_seed)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(_resample_block, samples[key], size, block_seed): (key, start, size)
+                       for key, start, size, block_seed in tasks}
+            for future in concurrent.futures.as_completed(futures):
+                key, start, size = futures[future]
+                means[key][start:start + size] = future.result()
+    return means
+
+
+def _resample_block(x, size, seed):
+    rng = np.random.default_rng(seed)
+    return x[rng.integers(0, len(x), size=(size, len(x)))].mean(axis=1)
+
+
+def available_memory_budget(fraction=0.25, default=MEMORY_BUDGET):
+    """ A fraction of the currently available physical memory in bytes, or default if it cannot be read. """
+    try:
+        return int(os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') * fraction)
+    except (AttributeError, ValueError, OSError):
+        return default
+
+
+def running_means_orderings(x, num_orderings, seed=SEED, memory_budget=None, max_workers=1, max_positions=MAX_POSITIONS):
+    """ Running means of x over num_orderings random orderings, computed as blocked 2D cumsums.
+
+        Each block shuffles every row of a (block_size, len(x)) matrix independently and takes the cumsum
+        along the rows. Only the running means at up to max_positions evenly spaced sample sizes are kept,
+        so the result has a fixed size whatever len(x) is.
+
+        x             : array-like
+        num_orderings : int
+        seed          : int (default: SEED)
+        memory_budget : int (default: None)
+            Maximum bytes of a block, None for available_memory_budget()
+        max_workers   : int (default: 1)
+            Size of the process pool, 1 to run in this process
+        max_positions : int (default: MAX_POSITIONS)
+
+        Returns : np.array of int, np.array of shape (num_orderings, len(positions))
+            Sample sizes and running means of each ordering at those sizes
+    """
+    x = np.asarray(x, dtype=np.float64)
+    positions = np.unique(np.linspace(1, len(x), min(len(x), max_positions)).round().astype(np.int64))
+    memory_budget = memory_budget or available_memory_budget()
+    block_size = int(max(1, min(num_orderings, memory_budget // (8 * max(len(x), 1)))))
+
+    starts = list(range(0, num_orderings, block_size))
+    seeds = np.random.SeedSequence(seed).spawn(len(starts))
+    tasks = [(start, min(block_size, num_orderings - start), block_seed) for start, block_seed in zip(starts, seeds)]
+
+    means = np.empty((num_orderings, len(positions)), dtype=np.float32)
+    if max_workers == 1:
+        for start, size, block_seed in tasks:
+            means[start:start + size] = _running_means_block(x, size, positions, block_seed)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(_running_means_block, x, size, positions, block_seed): (start, size)
+                       for start, size, block_seed in tasks}
+            for future in concurrent.futures.as_completed(futures):
+                start, size = futures[future]
+                means[start:start + size] = future.result()
+    return positions, means
+
+
+def _running_means_block(x, size, positions, seed):
+    rng = np.random.default_rng(seed)
+    block = rng.permuted(np.tile(x, (size, 1)), axis=1)
+    np.cumsum(block, axis=1, out=block)
+    return block[:, positions - 1] / positions
+
+
+def calc_bootstrap_pvalue_and_ci(X, ref, means, alternative='unequal', alpha=0.05):
+    """ Bootstrap p-value of mean(X) == ref and percentile confidence interval of mean(X).
+
+        The null distribution is the bootstrap distribution shifted to have mean ref. For 'unequal' the
+        smaller tail is returned, to be compared with alpha/2 as in analysis.test_signif.
+
+        X           : array-like
+        ref         : float
+        means       : np.array
+            Bootstrap means of X, from bootstrap_means
+        alternative : str (default: 'unequal')
+            One of 'unequal', 'greater', or 'less'
+        alpha       : float (default: 0.05)
+            Significance level, the interval has confidence 1 - alpha
+
+        Returns : float, (float, float)
+            P-value and (lower, upper) confidence interval
+    """
+    mean = np.mean(X)
+    null_means = means - mean + ref
+    n = len(means)
+    pvalue_greater = (np.count_nonzero(null_means >= mean) + 1) / (n + 1)
+    pvalue_less = (np.count_nonzero(null_means <= mean) + 1) / (n + 1)
+
+    if alternative == 'unequal':
+        pvalue = min(pvalue_greater, pvalue_less)
+    elif alternative == 'greater':
+        pvalue = pvalue_greater
+    elif alternative == 'less':
+        pvalue = pvalue_less
+    else:
+        raise AssertionError("Alternative must be one of 'unequal', 'greater', or 'less'")
+
+    ci = tuple(np.percentile(means, [100*alpha/2, 100*(1 - alpha/2)]))
+    return pvalue, ci
@@ -1,52 +1,246 @@
-import json
+import argparse
+import os
+import time
 
+import numpy as np
 import pandas as pd
 
 import functions
+import loader
+import profiling
+import store
 
 
 ### Constants
 LEVEL_IDS = list(range(1, 7))
+FULL_LEVEL_MASK = sum(1 << (level_id - 1) for level_id in LEVEL_IDS)
 
+RAW_POINTS = os.path.join(loader.DATA_DIR, 'raw/points.psv')
+RAW_USERS = os.path.join(loader.DATA_DIR, 'raw/users.psv')
+CLEAN_POINTS = os.path.join(loader.DATA_DIR, 'clean/points.psv')
+CLEAN_USERS = os.path.join(loader.DATA_DIR, 'clean/users.psv')
 
-### Read data
-points = pd.read_csv('../data/raw/points.psv', sep='|', index_col='id')
-users = pd.read_csv('../data/raw/users.psv', sep='|', index_col='id')
 
-### Merge data
-points.index = points['id']
-users.index = users['id']
-del points['id']
-del users['id']
+### Functions
+def clean_points(points):
+    """ Keep the last point of each (user_id, level) and only users that completed the game.
 
-### Clean data
-## Points
-# Sort points by user_id and timestamp
-points.sort_values(by=['user_id', 'timestamp'], inplace=True)
-points['timestamp'] = pd.to_datetime(points['timestamp'])
+        Returns : pd.DataFrame
+            Cleaned points sorted by user_id and timestamp
+    """
+    # Sort points by user_id and timestamp
+    points = points.sort_values(by=['user_id', 'timestamp'])
+    points['timestamp'] = pd.to_datetime(points['timestamp'])
 
-# Remove duplicated (user_id, level) and take the last
-points = points[~points.duplicated(['user_id', 'level'], keep='last')]
+    # Remove duplicated (user_id, level) and take the last
+    points = points[~points.duplicated(['user_id', 'level'], keep='last')]
 
-# Filter only for users that completed the game (# plays == 6)
-user_play_counts = points.groupby('user_id')['level'].nunique()
-users_lt_6_plays = user_play_counts[user_play_counts < 6].index
-points = points[~points['user_id'].isin(users_lt_6_plays)]
-assert all(points.groupby('user_id').size() == 6)
+    # Filter only for users that completed the game (# plays == 6)
+    user_play_counts = points.groupby('user_id')['level'].nunique()
+    users_lt_6_plays = user_play_counts[user_play_counts < 6].index
+    points = points[~points['user_id'].isin(users_lt_6_plays)]
+    assert all(points.groupby('user_id').size() == 6)
+    return points
 
 
-## Users
-# Remove users who didn't play or didn't play all levels
-users = users[~users.index.isin(users_lt_6_plays)]
-users = users[users.index.isin(points['user_id'].unique())]
+def clean_users(users, user_ids, strict=True):
+    """ Keep users in user_ids and derive OS columns from the browser agent string.
 
-# Get OS from browser agent string
-users['timestamp'] = pd.to_datetime(users['timestamp'])
-users['OS'] = users['browser'].map(functions.browser_to_os)
-users['OS_generic'] = users['OS'].map(functions.os_to_generic)
-users['is_mobile'] = users['OS_generic'].map(functions.is_mobile)
+        strict : bool (default: True)
+            Raise on unknown agent strings, otherwise classify them as functions.UNKNOWN
+    """
+    # Remove users who didn't play or didn't play all levels
+    users = users[users.index.isin(user_ids)].copy()
 
+    # Get OS from browser agent string
+    users['timestamp'] = pd.to_datetime(users['timestamp'])
+    agents = functions.classify_agents(users['browser'], strict=strict)
+    users[['OS', 'OS_generic', 'is_mobile']] = agents
+    return users
 
-### Write cleaned data
-points.to_csv('../data/clean/points.psv', sep='|')
-users.to_csv('../data/clean/users.psv', sep='|')
+
+def stream_clean_points(path, chunksize):
+    """ Clean points by reading them in chunks, keeping only the last point per (user_id, level).
+
+        The state kept between chunks is one row per (user_id, level) and a bitmask of the played levels
+        per user, both in arrays addressed through dicts. Only the incoming chunk is sorted and merged
+        into the state, so each chunk costs O(chunksize) whatever was read before it.
+
+        Returns : pd.DataFrame, int
+            Cleaned points (same as clean_points) and number of rows read
+    """
+    key_rows = {}     # (user_id, level) -> row of the state arrays
+    user_rows = {}    # user_id -> entry of level_masks
+    ids, columns, level_masks = None, None, np.zeros(0, dtype=np.int64)
+    n_rows = 0
+    for chunk in pd.read_csv(path, sep='|', index_col='id', chunksize=chunksize):
+        n_rows += len(chunk)
+        chunk['timestamp'] = pd.to_datetime(chunk['timestamp'])
+        if columns is None:
+            ids = np.zeros(0, dtype=chunk.index.dtype)
+            columns = {name: np.zeros(0, dtype=chunk[name].values.dtype) for name in chunk.columns}
+
+        # Last point per (user_id, level) of the chunk; the stable sort keeps the later row in the file on equal timestamps
+        chunk = chunk.sort_values(by=['user_id', 'level', 'timestamp'], kind='mergesort')
+        chunk = chunk[~chunk.duplicated(['user_id', 'level'], keep='last')]
+        user_ids, levels = chunk['user_id'].values, chunk['level'].values
+
+        # Replace the stored point of a key with a point not older, which is later in the file
+        n_keys = len(key_rows)
+        rows = np.fromiter((key_rows.setdefault(key, len(key_rows)) for key in zip(user_ids.tolist(), levels.tolist())), dtype=np.int64, count=len(chunk))
+        ids = _grow(ids, len(key_rows))
+        columns = {name: _grow(values, len(key_rows)) for name, values in columns.items()}
+        is_new = rows >= n_keys
+        replace = np.flatnonzero(is_new | (chunk['timestamp'].values >= columns['timestamp'][rows]))
+        ids[rows[replace]] = chunk.index.values[replace]
+        for name, values in columns.items():
+            values[rows[replace]] = chunk[name].values[replace]
+
+        # Bitmask of played levels per user, only new keys add a level
+        users = np.fromiter((user_rows.setdefault(user_id, len(user_rows)) for user_id in user_ids[is_new].tolist()), dtype=np.int64, count=int(is_new.sum()))
+        level_masks = _grow(level_masks, len(user_rows), fill=0)
+        np.bitwise_or.at(level_masks, users, np.left_shift(1, levels[is_new].astype(np.int64) - 1))
+
+    if columns is None:
+        return pd.DataFrame(columns=['user_id', 'level', 'lat', 'lng', 'timestamp']), n_rows
+
+    n_keys = len(key_rows)
+    points = pd.DataFrame({name: values[:n_keys] for name, values in columns.items()}, index=pd.Index(ids[:n_keys], name='id'))
+    complete_users = np.fromiter(user_rows, dtype=np.int64, count=len(user_rows))[level_masks[:len(user_rows)] == FULL_LEVEL_MASK]
+    points = points[points['user_id'].isin(complete_users)]
+
+    # Sorted by user_id and timestamp, then level as the previous per-key order did
+    order = np.lexsort((points['level'].values, points['timestamp'].values, points['user_id'].values))
+    points = points.iloc[order]
+    assert all(points.groupby('user_id').size() == 6)
+    return points, n_rows
+
+
+def _grow(values, size, fill=None):
+    """ values with at least size entries, doubling its length when it is too short. """
+    if len(values) >= size:
+        return values
+    grown = np.empty(max(size, 2 * len(values)), dtype=values.dtype)
+    if fill is not None:
+        grown.fill(fill)
+    grown[:len(values)] = values
+    return grown
+
+
+def stream_clean_users(path, user_ids, save_to, chunksize, strict=True):
+    """ Clean users by reading them in chunks and appending each cleaned chunk to save_to.
+
+        Returns : int
+            Number of rows read
+    """
+    n_rows = 0
+    for i, chunk in enumerate(pd.read_csv(path, sep='|', index_col='id', chunksize=chunksize)):
+        n_rows += len(chunk)
+        clean_users(chunk, user_ids, strict).to_csv(save_to, sep='|', mode='w' if i == 0 else 'a', header=(i == 0))
+    return n_rows
+
+
+def upsert_raw(conn, points_path, users_path, chunksize=None, strict=True):
+    """ Upsert a raw export into the SQLite store, in chunks if chunksize is set.
+
+        Only the rows of the export are cleaned: the store keeps the last point of each (user_id, level)
+        and flags complete users itself, see store.upsert_points.
+
+        Returns : int, int
+            Number of points and users read
+    """
+    n_points, n_users = 0, 0
+    for chunk in _read_chunks(points_path, chunksize):
+        store.upsert_points(conn, chunk, LEVEL_IDS)
+        n_points += len(chunk)
+    for chunk in _read_chunks(users_path, chunksize):
+        store.upsert_users(conn, clean_users(chunk, chunk.index, strict))
+        n_users += len(chunk)
+    return n_points, n_users
+
+
+def _read_chunks(path, chunksize):
+    if chunksize:
+        return pd.read_csv(path, sep='|', index_col='id', chunksize=chunksize)
+    return [pd.read_csv(path, sep='|', index_col='id')]
+
+
+def parse_and_assert_args():
+    arg_parser = argparse.ArgumentParser(prog='pinisi', description="Clean raw Pinisi data", usage="")
+
+    arg_parser.add_argument('-c', dest='chunksize', help='Stream raw data in chunks of this many rows instead of loading it all into memory (default: None)')
+    arg_parser.add_argument('-u', dest='allow_unknown', action='store_true', help="Classify unknown agent strings as '{}' instead of failing (default: False)".format(functions.UNKNOWN))
+    arg_parser.add_argument('-d', dest='store_path', help='Also upsert the raw data into this SQLite store, see store.py (default: None)')
+    arg_parser.add_argument('-a', dest='append_dir', help='Only upsert the raw export in this directory (points.psv and users.psv) into the store of -d, without cleaning the full raw data again (default: None)')
+    arg_parser.add_argument('--profile', dest='profile', help="Write a JSON report of stage timings and memory to this file, or folded stacks if it ends with '.folded' (default: None)")
+
+    args = arg_parser.parse_args()
+    if args.chunksize is not None:
+        args.chunksize = int(args.chunksize)
+        assert args.chunksize > 0, "chunksize must be > 0"
+    assert (args.append_dir is None) or (args.store_path is not None), "append_dir needs store_path"
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_and_assert_args()
+    chunksize = args.chunksize
+    strict = not args.allow_unknown
+
+    if args.profile:
+        profiling.enable()
+
+    if args.append_dir:
+        ### Upsert a new raw export into the store only
+        start = time.time()
+        with profiling.stage('upsert') as stage:
+            conn = store.connect(args.store_path)
+            n_points, n_users = upsert_raw(conn, os.path.join(args.append_dir, 'points.psv'), os.path.join(args.append_dir, 'users.psv'), chunksize, strict)
+            stage.set_rows(n_points + n_users)
+        print("Upserted {} points and {} users into {} in {:.2f}s".format(n_points, n_users, args.store_path, time.time() - start))
+    elif chunksize:
+        ### Stream and clean data
+        start = time.time()
+        with profiling.stage('clean_points') as stage:
+            points, n_points = stream_clean_points(RAW_POINTS, chunksize)
+            stage.set_rows(n_points)
+        with profiling.stage('write_points', rows=len(points)):
+            points.to_csv(CLEAN_POINTS, sep='|')
+        with profiling.stage('clean_users') as stage:
+            n_users = stream_clean_users(RAW_USERS, points['user_id'].unique(), CLEAN_USERS, chunksize, strict)
+            stage.set_rows(n_users)
+        elapsed = time.time() - start
+
+        print("Cleaned {} points and {} users in {:.2f}s ({:.0f} rows/s)".format(
+            n_points, n_users, elapsed, (n_points + n_users) / max(elapsed, 1e-9)))
+
+        if args.store_path:
+            with profiling.stage('upsert'):
+                upsert_raw(store.connect(args.store_path), RAW_POINTS, RAW_USERS, chunksize, strict)
+    else:
+        ### Read data
+        with profiling.stage('load') as stage:
+            points = pd.read_csv(RAW_POINTS, sep='|', index_col='id')
+            users = pd.read_csv(RAW_USERS, sep='|', index_col='id')
+            stage.set_rows(len(points) + len(users))
+
+        ### Store data
+        if args.store_path:
+            with profiling.stage('upsert', rows=len(points) + len(users)):
+                conn = store.connect(args.store_path)
+                store.upsert_points(conn, points, LEVEL_IDS)
+                store.upsert_users(conn, clean_users(users, users.index, strict))
+
+        ### Clean data
+        with profiling.stage('clean_points', rows=len(points)):
+            points = clean_points(points)
+        with profiling.stage('clean_users', rows=len(users)):
+            users = clean_users(users, points['user_id'].unique(), strict)
+
+        ### Write cleaned data
+        with profiling.stage('write', rows=len(points) + len(users)):
+            points.to_csv(CLEAN_POINTS, sep='|')
+            users.to_csv(CLEAN_USERS, sep='|')
+
+    if args.profile:
+        profiling.report(args.profile)
@@ -1,23 +1,114 @@
+import collections
+import functools
 import math
 
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-import seaborn as sns
+
+import sketch
+
+# matplotlib, seaborn and images (PIL) are imported by the plot functions, so that scripts which only
+# compute statistics load NumPy and pandas only
 
 
 FIG_AREA = 48
 GRID_AREA = 96
+POLYGON_GRID = 64
+EARTH_RADIUS = 6371008.8
+CONSENSUS_TOL = 1e-9    # degrees
+CONSENSUS_MAX_ITER = 200
 
 COLOR_GRID = 'lightgrey'
 GRID_LW = 0.5
+RASTER_CMAP = 'inferno'
+KERNEL_TRUNCATE = 4.0    # kernel radius in bandwidths
+DENSITY_SUBDIVISIONS = 4    # lattice cells per get_grids cell and axis
 
 
 # Data processing functions
-def filter_iqr(X, num_iqr):
-    median = X.median()
-    iqr = X.quantile(0.75) - X.quantile(0.25)
-    return X[(X >= median - iqr*num_iqr) & (X <= median + iqr*num_iqr)]
+def filter_iqr(X, num_iqr, method='exact', eps=sketch.EPS):
+    """ Keep the values of X within num_iqr * IQR of the median.
+
+        method : str (default: 'exact')
+            'exact' or 'sketch', see get_iqr_bounds
+        eps    : float (default: sketch.EPS)
+            Rank error of the 'sketch' method
+    """
+    lower, upper = get_iqr_bounds(X, num_iqr, method=method, eps=eps)
+    values = np.asarray(X)
+    return X[(values >= lower) & (values <= upper)]
+
+
+def get_iqr_bounds(X, num_iqr, method='exact', eps=sketch.EPS):
+    """ Lower and upper bounds of filter_iqr: median -/+ num_iqr * IQR.
+
+        X       : array-like
+        num_iqr : float
+        method  : str (default: 'exact')
+            'exact' partitions the values once for all three quartiles, with the linear interpolation of
+            pd.Series.quantile. 'sketch' reads them from a sketch.QuantileSketch, in O(1/eps) memory
+        eps     : float (default: sketch.EPS)
+            Rank error of the 'sketch' method, as a fraction of the number of values
+
+        Returns : float, float
+    """
+    if method == 'exact':
+        q1, median, q3 = calc_quantiles(X, [0.25, 0.5, 0.75])
+    elif method == 'sketch':
+        q1, median, q3 = sketch.QuantileSketch(eps=eps, seed=0).update(X).quantile([0.25, 0.5, 0.75])
+    else:
+        raise ValueError("method must be one of 'exact' or 'sketch'")
+    iqr = q3 - q1
+    return median - iqr*num_iqr, median + iqr*num_iqr
+
+
+def get_iqr_bounds_chunks(chunks, num_iqr, eps=sketch.EPS, seed=None):
+    """ Approximate filter_iqr bounds of every group, from chunks of values that are never held together.
+
+        Each chunk is grouped by key and folded into one quantile sketch per key, so memory is O(1/eps)
+        per key whatever the number of values.
+
+        chunks  : iterable of (array-like, array-like)
+            Group keys, e.g. levels, and values of each chunk
+        num_iqr : float
+        eps     : float (default: sketch.EPS)
+        seed    : int (default: None)
+
+        Returns : dict of key -> (float, float)
+    """
+    sketches = {}
+    for keys, values in chunks:
+        for key, group in pd.Series(np.asarray(values, dtype=np.float64)).groupby(np.asarray(keys)):
+            if key not in sketches:
+                sketches[key] = sketch.QuantileSketch(eps=eps, seed=seed)
+            sketches[key].update(group.values)
+
+    bounds = {}
+    for key, key_sketch in sketches.items():
+        q1, median, q3 = key_sketch.quantile([0.25, 0.5, 0.75])
+        iqr = q3 - q1
+        bounds[key] = (median - iqr*num_iqr, median + iqr*num_iqr)
+    return bounds
+
+
+def calc_quantiles(X, qs):
+    """ Quantiles of X with linear interpolation, as pd.Series.quantile and pd.Series.median for q = 0.5,
+        from a single partition of the values.
+
+        NaN values are ignored. Returns an array of NaN if X has no value.
+    """
+    x = np.asarray(X, dtype=np.float64)
+    x = x[~np.isnan(x)]
+    if not len(x):
+        return np.full(len(qs), np.nan)
+    positions = np.asarray(qs, dtype=np.float64) * (len(x) - 1)
+    lo, hi = np.floor(positions).astype(np.int64), np.ceil(positions).astype(np.int64)
+    x = np.partition(x, np.unique(np.concatenate([lo, hi])))
+    # Interpolate from the nearer end as np.quantile does, and take the median as the midpoint of the
+    # middle values as np.median does, to get the very same floats as pandas
+    below, above, frac = x[lo], x[hi], positions - lo
+    quantiles = np.where(frac >= 0.5, above - (above - below)*(1 - frac), below + (above - below)*frac)
+    return np.where(np.asarray(qs) == 0.5, (below + above) / 2, quantiles)
 
 
 def dist(p_ref, points):
@@ -34,42 +125,203 @@ def dist(p_ref, points):
     return ((points.lat - p_ref[0])**2 + (points.lng - p_ref[1])**2)**0.5
 
 
+def dist_haversine(lat_ref, lng_ref, lat, lng, radius=EARTH_RADIUS):
+    """ Great-circle distance in metres between reference coordinates and points (all in degrees). """
+    lat_ref, lng_ref, lat, lng = np.radians(lat_ref), np.radians(lng_ref), np.radians(lat), np.radians(lng)
+    a = np.sin((lat - lat_ref)/2)**2 + np.cos(lat_ref)*np.cos(lat)*np.sin((lng - lng_ref)/2)**2
+    return 2*radius*np.arcsin(np.sqrt(a))
+
+
+def get_dist_levels(points_ref, points_expert, points, metric='degree', float32=False):
+    """ Compute distance of every point to the reference point of its level, for all levels at once.
+
+        The reference coordinates are gathered with the level as an array index, so points can be in
+        any order and no per-level filtering is needed.
+
+        points_ref    : pd.DataFrame with (level, lat, lng) columns, one row per level
+        points_expert : pd.DataFrame with (level, lat, lng) columns, one row per level
+        points        : pd.DataFrame with (level, lat, lng) columns
+        metric        : str (default: 'degree')
+            'degree' for planar distance in degrees as dist, 'haversine' for great-circle metres
+        float32       : bool (default: False)
+            Compute in float32 to halve memory traffic
+
+        Returns : pd.Series with same index as points, pd.Series indexed by level
+            Distance of points and of the expert to the reference point
+    """
+    dtype = np.float32 if float32 else np.float64
+    size = int(max(points_ref['level'].max(), points['level'].max() if len(points) else 0, points_expert['level'].max())) + 1
+    ref_lat, ref_lng = np.full(size, np.nan, dtype=dtype), np.full(size, np.nan, dtype=dtype)
+    ref_lat[points_ref['level'].values] = points_ref['lat'].values
+    ref_lng[points_ref['level'].values] = points_ref['lng'].values
+
+    def dist_to_ref(ps):
+        levels = ps['level'].values
+        lat, lng = ps['lat'].values.astype(dtype, copy=False), ps['lng'].values.astype(dtype, copy=False)
+        if metric == 'degree':
+            return np.sqrt((lat - ref_lat[levels])**2 + (lng - ref_lng[levels])**2)
+        elif metric == 'haversine':
+            return dist_haversine(ref_lat[levels], ref_lng[levels], lat, lng)
+        raise ValueError("metric must be one of 'degree' or 'haversine'")
+
+    dists = pd.Series(dist_to_ref(points), index=points.index)
+    dists_expert = pd.Series(dist_to_ref(points_expert), index=points_expert['level'].values)
+    return dists, dists_expert
+
+
 def get_dist_level(points_ref, points_expert, points, level_id):
-    p_ref = points_ref[points_ref.level == level_id]
-    p_ref = (p_ref.lat.iloc[0], p_ref.lng.iloc[0])
-    p_expert = points_expert[points_expert.level == level_id]
-    ps = points[points.level == level_id]
-    return dist(p_ref, ps), dist(p_ref, p_expert).iloc[0]
+    dists, dists_expert = get_dist_levels(points_ref, points_expert, points[points.level == level_id])
+    return dists, dists_expert[level_id]
+
+
+def get_consensus_levels(points_ref, points, rects=None, grid_area=GRID_AREA, fig_area=FIG_AREA, tol=CONSENSUS_TOL, max_iter=CONSENSUS_MAX_ITER):
+    """ Estimate the crowd consensus location of every level at once, and its distance to the reference point.
+
+        Estimates are the mean, the coordinate-wise median, the geometric median (point minimizing the sum
+        of distances) and the centre of the densest get_bins cell. The geometric median is computed by
+        Weiszfeld iterations on all levels together, starting from the coordinate-wise median.
+
+        points_ref : pd.DataFrame with (level, lat, lng) columns, one row per level
+        points     : pd.DataFrame with (level, lat, lng) columns
+        rects      : dict of level_id -> rect (default: None)
+            Needed for the density peak, which is left out if None
+        grid_area  : int or dict of level_id -> int (default: GRID_AREA)
+        fig_area   : int (default: FIG_AREA)
+        tol        : float (default: CONSENSUS_TOL)
+            Weiszfeld stops when no level estimate moves by more than tol (in degrees)
+        max_iter   : int (default: CONSENSUS_MAX_ITER)
+
+        Returns : pd.DataFrame
+            lat, lng and dist (planar distance to the reference point, as dist) indexed by (level, method),
+            method being one of 'mean', 'median', 'geometric_median' or 'density_peak'
+    """
+    # Points sorted by level once, so that each level is a contiguous slice
+    levels = points['level'].values
+    order = np.argsort(levels, kind='stable')
+    lat, lng = points['lat'].values[order].astype(np.float64), points['lng'].values[order].astype(np.float64)
+    level_counts = np.bincount(levels)
+    level_ids = np.flatnonzero(level_counts)
+    counts = level_counts[level_ids]
+    starts = np.cumsum(counts) - counts
+    n_levels = len(level_ids)
+    estimates = collections.OrderedDict()
+
+    estimates['mean'] = np.add.reduceat(lat, starts) / counts, np.add.reduceat(lng, starts) / counts
+    estimates['median'] = (np.array([np.median(lat[start:start + count]) for start, count in zip(starts, counts)]),
+                           np.array([np.median(lng[start:start + count]) for start, count in zip(starts, counts)]))
+
+    # Weiszfeld: the next estimate is the mean of points weighted by their inverse distance to the
+    # estimate. Levels that have converged are dropped from the arrays
+    est_lat, est_lng = estimates['median'][0].copy(), estimates['median'][1].copy()
+    active, n_active = np.arange(n_levels), 0
+    for _ in range(max_iter):
+        if len(active) != n_active:
+            n_active = len(active)
+            active_lat = np.concatenate([lat[starts[k]:starts[k] + counts[k]] for k in active])
+            active_lng = np.concatenate([lng[starts[k]:starts[k] + counts[k]] for k in active])
+            active_inv = np.repeat(np.arange(n_active), counts[active])
+            active_starts = np.cumsum(counts[active]) - counts[active]
+
+        d_lat, d_lng = active_lat - est_lat[active][active_inv], active_lng - est_lng[active][active_inv]
+        weights = 1.0 / np.maximum(np.sqrt(d_lat*d_lat + d_lng*d_lng), tol)
+        weight_sums = np.add.reduceat(weights, active_starts)
+        new_lat = np.add.reduceat(weights*active_lat, active_starts) / weight_sums
+        new_lng = np.add.reduceat(weights*active_lng, active_starts) / weight_sums
+        steps = np.hypot(new_lat - est_lat[active], new_lng - est_lng[active])
+        est_lat[active], est_lng[active] = new_lat, new_lng
+        active = active[steps >= tol]
+        if not len(active):
+            break
+    estimates['geometric_median'] = est_lat, est_lng
+
+    if rects is not None:
+        peak_lat, peak_lng = np.full(n_levels, np.nan), np.full(n_levels, np.nan)
+        bin_level_ids = [level_id for level_id in level_ids if level_id in rects]
+        grid_areas = grid_area if isinstance(grid_area, dict) else {level_id: grid_area for level_id in bin_level_ids}
+        coord_bins = get_bins_levels(points, rects, bin_level_ids, grid_areas, fig_area)
+        for level_id, bins in coord_bins.items():
+            i, j = np.unravel_index(np.argmax(bins.values), bins.shape)
+            grid_horiz, grid_vertic = get_grids(rects, level_id, grid_areas[level_id], fig_area)
+            edges_lat, edges_lng = np.sort(grid_horiz)[::-1], np.sort(grid_vertic)    # same order as bins
+            k = np.searchsorted(level_ids, level_id)
+            peak_lat[k], peak_lng[k] = (edges_lat[i] + edges_lat[i + 1]) / 2, (edges_lng[j] + edges_lng[j + 1]) / 2
+        estimates['density_peak'] = peak_lat, peak_lng
+
+    ref = points_ref.set_index('level').reindex(level_ids)
+    consensus = pd.concat({
+        method: pd.DataFrame({'lat': est_lat, 'lng': est_lng}, index=pd.Index(level_ids, name='level'))
+        for method, (est_lat, est_lng) in estimates.items()}, names=['method'])
+    consensus = consensus.swaplevel().sort_index(level='level', sort_remaining=False)
+    consensus['dist'] = np.hypot(consensus['lat'].values - ref['lat'].reindex(consensus.index.get_level_values('level')).values,
+                                 consensus['lng'].values - ref['lng'].reindex(consensus.index.get_level_values('level')).values)
+    return consensus
+
+
+def get_consensus_level(points_ref, points, level_id, rects=None, grid_area=GRID_AREA, fig_area=FIG_AREA):
+    consensus = get_consensus_levels(points_ref, points[points.level == level_id], rects, grid_area, fig_area)
+    return consensus.loc[level_id]
 
 
 def calc_rect_area(rect):
     return (rect[0][0] - rect[1][0]) * (rect[1][1] - rect[0][1])
 
 
+def calc_cum_dist(dist_points):
+    """ Running mean of distances in the order of dist_points, indexed from 0. """
+    return dist_points.cumsum() / pd.Series(range(1, len(dist_points) + 1))
+
+
 # Plotting functions
-def plot_scatter(points, rects, level_id, fig_area=FIG_AREA, grid_area=GRID_AREA, with_axis=False, with_img=True, img_alpha=1.0):
+def plot_scatter(points, rects, level_id, fig_area=FIG_AREA, grid_area=GRID_AREA, with_axis=False, with_img=True, img_alpha=1.0,
+                 backend='matplotlib', cmap=RASTER_CMAP, color_scale='log', ax=None):
+    """ Scatter plot of a level's points over the level image.
+
+        backend     : str (default: 'matplotlib')
+            'matplotlib' draws one marker per point. 'raster' accumulates points into a pixel buffer of
+            the size of the axes in display pixels and draws it as a single image, which stays fast for
+            millions of points. Counts are spread to the empty pixels around them, see dilate_counts
+        cmap        : str (default: RASTER_CMAP)
+            Colour map of point counts for the 'raster' backend
+        color_scale : str (default: 'log')
+            'log' or 'linear' scaling of point counts for the 'raster' backend
+    """
+    import matplotlib.pyplot as plt
+    from matplotlib.collections import LineCollection
+    import images
+
     rect = rects[level_id]
     top_lat, top_lng, bot_lat, bot_lng = get_rect_bounds(rect)
+    width, height = get_rect_width_height(rect)
+    fig_width, fig_height = get_fig_width_height(width, height, fig_area)
 
+    ax = plt.gca() if ax is None else ax
+    ax.figure.set_size_inches(fig_width, fig_height)
+    shape = (max(1, int(round(fig_height*ax.figure.dpi))), max(1, int(round(fig_width*ax.figure.dpi))))
     plevel = get_points_level(points, rects, level_id)
-    ax = plevel.plot('lng', 'lat', 'scatter')
-    plt.xlim(left=top_lng, right=bot_lng)
-    plt.ylim(top=top_lat, bottom=bot_lat)
+    if backend == 'raster':
+        # One buffer pixel per display pixel of the axes, once imshow's equal aspect is applied
+        ax.set_xlim(left=top_lng, right=bot_lng)
+        ax.set_ylim(top=top_lat, bottom=bot_lat)
+        ax.set_aspect('equal')
+        ax.apply_aspect()
+        bbox = ax.get_window_extent()
+        counts = get_raster_counts(plevel, rect, (max(1, int(round(bbox.height))), max(1, int(round(bbox.width)))))
+        ax.imshow(colorize_counts(dilate_counts(counts), cmap, color_scale), zorder=1, interpolation='nearest', extent=[top_lng, bot_lng, bot_lat, top_lat])
+    elif backend == 'matplotlib':
+        plevel.plot.scatter('lng', 'lat', ax=ax)
+    else:
+        raise ValueError("backend must be one of 'matplotlib' or 'raster'")
+    ax.set_xlim(left=top_lng, right=bot_lng)
+    ax.set_ylim(top=top_lat, bottom=bot_lat)
 
     if with_img:
-        img = plt.imread('/data/images/level%s.png' % level_id)
-        plt.imshow(img, zorder=0, alpha=img_alpha, extent=[top_lng, bot_lng, bot_lat, top_lat])
-
-    width, height = get_rect_width_height(rect)
-    fig_width, fig_height = get_fig_width_height(width, height, fig_area)
-    plt.gcf().set_size_inches(fig_width, fig_height)
+        img = images.load_level_image(level_id, shape)
+        ax.imshow(img, zorder=0, alpha=img_alpha, extent=[top_lng, bot_lng, bot_lat, top_lat])
 
     if grid_area:
         grid_horiz, grid_vertic = get_grids(rects, level_id, grid_area, fig_area)
-        for lat in grid_horiz:
-            plt.axhline(lat, color=COLOR_GRID, lw=GRID_LW)
-        for lng in grid_vertic:
-            plt.axvline(lng, color=COLOR_GRID, lw=GRID_LW)
+        segments = [[(top_lng, lat), (bot_lng, lat)] for lat in grid_horiz] + [[(lng, bot_lat), (lng, top_lat)] for lng in grid_vertic]
+        ax.add_collection(LineCollection(segments, colors=COLOR_GRID, linewidths=GRID_LW, zorder=2))
 
     if not with_axis:
         ax.set_axis_off()
@@ -79,16 +331,26 @@ def plot_scatter(points, rects, level_id, fig_area=FIG_AREA, grid_area=GRID_AREA
     return ax
 
 
-def plot_heatmap(points, rects, level_id, grid_area=GRID_AREA, fig_area=FIG_AREA, cmap=None):
+def plot_heatmap(points, rects, level_id, grid_area=GRID_AREA, fig_area=FIG_AREA, cmap=None, bw=None, ax=None):
+    """ Heatmap of a level's points counted in the cells of get_grids.
+
+        bw : str, float or (float, float) (default: None)
+            Plot the Gaussian smoothed counts of get_density_bins with this bandwidth instead of raw counts
+    """
+    import seaborn as sns
+
     rect = rects[level_id]
     top_lat, top_lng, bot_lat, bot_lng = get_rect_bounds(rect)
 
-    bins = get_bins(points, rects, level_id, grid_area, fig_area)
+    if bw is None:
+        bins = get_bins(points, rects, level_id, grid_area, fig_area)
+    else:
+        bins = get_density_bins(points, rects, level_id, grid_area, fig_area, bw=bw)
     
-    ax = sns.heatmap(bins, cbar=False, xticklabels=False, yticklabels=False, cmap=cmap)
+    ax = sns.heatmap(bins, cbar=False, xticklabels=False, yticklabels=False, cmap=cmap, ax=ax)
     width, height = get_rect_width_height(rect)
     fig_width, fig_height = get_fig_width_height(width, height, fig_area)
-    plt.gcf().set_size_inches(fig_width, fig_height)
+    ax.figure.set_size_inches(fig_width, fig_height)
 
     return ax
 
@@ -104,6 +366,59 @@ def get_points_level(points, rects, level_id):
     return plevel
 
 
+def get_raster_counts(points, rect, shape):
+    """ Count points per pixel of a raster covering rect.
+
+        points : pd.DataFrame with (lat, lng) columns
+        rect   : ((top_lat, top_lng), (bot_lat, bot_lng))
+        shape  : (int, int)
+            Number of pixel rows and columns, the first row being the top latitude
+
+        Returns : np.array of int with given shape
+    """
+    top_lat, top_lng, bot_lat, bot_lng = get_rect_bounds(rect)
+    n_rows, n_cols = shape
+    rows = np.floor((top_lat - points['lat'].values) / (top_lat - bot_lat) * n_rows).astype(np.int64)
+    cols = np.floor((points['lng'].values - top_lng) / (bot_lng - top_lng) * n_cols).astype(np.int64)
+    inside = (rows >= 0) & (rows <= n_rows) & (cols >= 0) & (cols <= n_cols)
+    rows, cols = np.minimum(rows[inside], n_rows - 1), np.minimum(cols[inside], n_cols - 1)
+    return np.bincount(rows*n_cols + cols, minlength=n_rows*n_cols).reshape(shape)
+
+
+def dilate_counts(counts, radius=1):
+    """ Counts with each empty pixel set to the largest count within radius pixels, so that a single
+        point is drawn as a (2*radius + 1) square instead of one hardly visible pixel.
+
+        Returns : np.array of the same shape as counts
+    """
+    n_rows, n_cols = counts.shape
+    padded = np.pad(counts, radius)
+    neighbours = counts.copy()
+    for d_row in range(2*radius + 1):
+        for d_col in range(2*radius + 1):
+            np.maximum(neighbours, padded[d_row:d_row + n_rows, d_col:d_col + n_cols], out=neighbours)
+    return np.where(counts > 0, counts, neighbours)
+
+
+def colorize_counts(counts, cmap=RASTER_CMAP, color_scale='log', vmax=None):
+    """ RGBA uint8 image of counts, transparent where there is no point.
+
+        vmax : float (default: None)
+            Count of the top colour, to share a colour scale between images. None for the maximum of counts
+    """
+    import matplotlib.pyplot as plt
+
+    counts = np.asarray(counts, dtype=np.float64)
+    vmax = counts.max() if vmax is None else float(vmax)
+    if color_scale == 'log':
+        counts, vmax = np.log1p(counts), np.log1p(vmax)
+    elif color_scale != 'linear':
+        raise ValueError("color_scale must be one of 'log' or 'linear'")
+    rgba = plt.get_cmap(cmap)(np.minimum(counts / max(vmax, 1e-12), 1.0), bytes=True)
+    rgba[..., 3] = np.where(counts > 0, 255, 0)
+    return rgba
+
+
 def get_fig_width_height(width, height, fig_area):
     c_area = math.sqrt(fig_area / (width*height))
     fig_width  = width*c_area
@@ -146,25 +461,278 @@ def get_grids(rects, level_id, grid_area, fig_area):
 
 
 def get_bins(points, rects, level_id, grid_area=GRID_AREA, fig_area=FIG_AREA):
-    plevel = get_points_level(points, rects, level_id)
-    bins = get_grids(rects, level_id, grid_area, fig_area)
-    bins_lat = pd.Series(pd.Categorical(pd.cut(plevel.lat, sorted(bins[0]), include_lowest=True), ordered=True))
-    bins_lng = pd.Series(pd.Categorical(pd.cut(plevel.lng, sorted(bins[1]), include_lowest=True), ordered=True))
-
-    coord_bins = pd.DataFrame(0, index=bins_lat.values.categories, columns=bins_lng.values.categories)
-    coord_counts = (bins_lat.astype(str) + '|' + bins_lng.astype(str)).value_counts()
-    for coord in coord_counts.index:
-        lat, lng = coord.split('|')
-        coord_bins.loc[lat, lng] += coord_counts[coord]
-    assert coord_bins.sum().sum() == len(plevel)
-
-    coord_bins.index = [float(i[1:i.index(',')]) for i in coord_bins.index]
-    coord_bins.columns = [float(i[1:i.index(',')]) for i in coord_bins.columns]
-    coord_bins = coord_bins.loc[coord_bins.index[::-1]]    # reverse latitude (positive should be upper)
+    """ Count points of a level inside each cell of the grid from get_grids.
+
+        Returns : pd.DataFrame
+            Counts with latitude bins as index (descending) and longitude bins as columns,
+            both labelled by the lower edge of the bin
+    """
+    return get_bins_levels(points, rects, [level_id], grid_area, fig_area)[level_id]
+
+
+def get_bins_levels(points, rects, level_ids=None, grid_area=GRID_AREA, fig_area=FIG_AREA):
+    """ Count points inside each grid cell for several levels in one pass, like a 2D histogram.
+
+        points    : pd.DataFrame with (level, lat, lng) columns
+        rects     : dict of level_id -> rect
+        level_ids : list of int (default: all levels in rects)
+        grid_area : int or dict of level_id -> int
+            Grid area of get_grids, can be set per level
+
+        Returns : dict of level_id -> pd.DataFrame
+            Same layout as get_bins
+    """
+    level_ids = sorted(rects) if level_ids is None else list(level_ids)
+    grid_areas = grid_area if isinstance(grid_area, dict) else {level_id: grid_area for level_id in level_ids}
+
+    plevels = points[get_rect_mask(points, rects, level_ids)]
+    levels = plevels['level'].values
+    order = np.argsort(levels, kind='stable')
+    levels = levels[order]
+    lats = plevels['lat'].values[order]
+    lngs = plevels['lng'].values[order]
+
+    edges, offsets, flat_idx = {}, {}, np.empty(len(levels), dtype=np.int64)
+    n_cells = 0
+    for level_id in level_ids:
+        grid_horiz, grid_vertic = get_grids(rects, level_id, grid_areas[level_id], fig_area)
+        edges_lat, edges_lng = np.sort(grid_horiz), np.sort(grid_vertic)
+        edges[level_id] = edges_lat, edges_lng
+        offsets[level_id] = n_cells
+
+        start, end = np.searchsorted(levels, level_id, side='left'), np.searchsorted(levels, level_id, side='right')
+        idx_lat = _bin_index(edges_lat, lats[start:end])
+        idx_lng = _bin_index(edges_lng, lngs[start:end])
+        flat_idx[start:end] = n_cells + idx_lat*(len(edges_lng) - 1) + idx_lng
+        n_cells += (len(edges_lat) - 1) * (len(edges_lng) - 1)
+
+    counts = np.bincount(flat_idx, minlength=n_cells)
+    assert counts.sum() == len(plevels)
+
+    coord_bins = {}
+    for level_id in level_ids:
+        edges_lat, edges_lng = edges[level_id]
+        n_lat, n_lng = len(edges_lat) - 1, len(edges_lng) - 1
+        grid = counts[offsets[level_id]:offsets[level_id] + n_lat*n_lng].reshape(n_lat, n_lng)
+        coord_bins[level_id] = pd.DataFrame(
+            grid[::-1],    # reverse latitude (positive should be upper)
+            index=_bin_labels(edges_lat)[::-1],
+            columns=_bin_labels(edges_lng))
     return coord_bins
 
+
+def get_density_bins(points, rects, level_id, grid_area=GRID_AREA, fig_area=FIG_AREA, bw='scott', subdivisions=DENSITY_SUBDIVISIONS):
+    """ Gaussian kernel density of a level's points on the grid of get_grids, as smoothed counts.
+
+        Points are counted on a lattice splitting every cell of get_grids into subdivisions x subdivisions
+        cells, the lattice is convolved with a Gaussian kernel by FFT, and the smoothed counts are summed
+        back into the cells of get_bins. The bandwidth is thus not limited to the display grid, and the
+        cost is O(N + G log G) for N points and G lattice cells instead of O(N G) for a direct KDE. With
+        bw=0 the result equals get_bins. Divide by the number of points and the cell area for a
+        probability density.
+
+        bw           : str, float or (float, float) (default: 'scott')
+            Bandwidth in degrees: 'scott' (n**(-1/6) * standard deviation of each axis), 'silverman' (the
+            same with min(std, IQR/1.349), robust to outliers), a float for both axes or (lat, lng)
+        subdivisions : int (default: DENSITY_SUBDIVISIONS)
+
+        Returns : pd.DataFrame
+            Same layout as get_bins
+    """
+    plevel = get_points_level(points, rects, level_id)
+    bw_lat, bw_lng = get_bandwidth(plevel, bw)
+    grid_horiz, grid_vertic = get_grids(rects, level_id, grid_area, fig_area)
+    edges_lat, edges_lng = np.sort(grid_horiz), np.sort(grid_vertic)
+    n_lat, n_lng = len(edges_lat) - 1, len(edges_lng) - 1
+
+    # The lattice keeps the edges of get_grids, so every point falls in a sub-cell of its get_bins cell
+    fine_lat, fine_lng = _subdivide_edges(edges_lat, subdivisions), _subdivide_edges(edges_lng, subdivisions)
+    flat_idx = _bin_index(fine_lat, plevel['lat'].values)*(len(fine_lng) - 1) + _bin_index(fine_lng, plevel['lng'].values)
+    lattice = np.bincount(flat_idx, minlength=(len(fine_lat) - 1)*(len(fine_lng) - 1)).astype(np.float64)
+    lattice = lattice.reshape(len(fine_lat) - 1, len(fine_lng) - 1)
+
+    width, height = get_rect_width_height(rects[level_id])
+    sigma_rows, sigma_cols = bw_lat / (height/(n_lat*subdivisions)), bw_lng / (width/(n_lng*subdivisions))
+    smoothed = _gaussian_smooth_fft(lattice, sigma_rows, sigma_cols)
+    density = smoothed.reshape(n_lat, subdivisions, n_lng, subdivisions).sum(axis=(1, 3))
+    return pd.DataFrame(density[::-1],    # reverse latitude (positive should be upper)
+                        index=_bin_labels(edges_lat)[::-1], columns=_bin_labels(edges_lng))
+
+
+def _subdivide_edges(edges, subdivisions):
+    steps = np.arange(subdivisions) / subdivisions
+    inner = (edges[:-1, None] + (edges[1:] - edges[:-1])[:, None]*steps).ravel()
+    return np.append(inner, edges[-1])
+
+
+def get_bandwidth(points, bw='scott'):
+    """ Kernel bandwidth (lat, lng) in degrees for points, by rule name or as given. See get_density_bins. """
+    if isinstance(bw, str):
+        coords = points[['lat', 'lng']].values.astype(np.float64)
+        factor = max(len(coords), 1) ** (-1.0/6)
+        scale = coords.std(axis=0, ddof=1) if len(coords) > 1 else np.zeros(2)
+        if bw == 'silverman':
+            q_lat, q_lng = calc_quantiles(coords[:, 0], [0.25, 0.75]), calc_quantiles(coords[:, 1], [0.25, 0.75])
+            iqr = np.array([q_lat[1] - q_lat[0], q_lng[1] - q_lng[0]]) / 1.349
+            scale = np.where(iqr > 0, np.minimum(scale, iqr), scale)
+        elif bw != 'scott':
+            raise ValueError("bw must be one of 'scott' or 'silverman', a float or a pair of floats")
+        return tuple(factor * scale)
+    if np.ndim(bw) == 0:
+        return float(bw), float(bw)
+    return float(bw[0]), float(bw[1])
+
+
+def _gaussian_smooth_fft(grid, sigma_rows, sigma_cols, truncate=KERNEL_TRUNCATE):
+    # Zero-pad each axis by the kernel radius so that the circular convolution does not wrap around
+    radii = [int(math.ceil(truncate*sigma)) if sigma > 0 else 0 for sigma in (sigma_rows, sigma_cols)]
+    shape = tuple(n + radius for n, radius in zip(grid.shape, radii))
+    kernels = []
+    for size, sigma, radius in zip(shape, (sigma_rows, sigma_cols), radii):
+        offsets = np.minimum(np.arange(size), size - np.arange(size))    # circular distance to 0
+        if sigma > 0:
+            kernel = np.where(offsets <= radius, np.exp(-0.5*(offsets/sigma)**2), 0.0)
+        else:
+            kernel = (offsets == 0).astype(np.float64)
+        kernels.append(kernel / kernel.sum())
+    kernel_fft = np.fft.rfft2(np.outer(*kernels))
+    smoothed = np.fft.irfft2(np.fft.rfft2(grid, shape) * kernel_fft, shape)[:grid.shape[0], :grid.shape[1]]
+    return np.maximum(smoothed, 0.0)
+
+
+def get_rect_mask(points, rects, level_ids=None):
+    """ Boolean mask of points lying inside the rect of their own level, for all levels at once. """
+    level_ids = sorted(rects) if level_ids is None else list(level_ids)
+    size = max(max(level_ids), int(points['level'].max()) if len(points) else 0) + 1
+    bounds = np.full((4, size), np.nan)
+    for level_id in level_ids:
+        bounds[:, level_id] = get_rect_bounds(rects[level_id])
+    top_lat, top_lng, bot_lat, bot_lng = bounds[:, points['level'].values]
+
+    lat, lng = points['lat'].values, points['lng'].values
+    return (lng >= top_lng) & (lng <= bot_lng) & (lat >= bot_lat) & (lat <= top_lat)
+
+
+def _bin_index(edges, values):
+    # Right-closed bins with the lowest edge included, as pd.cut(..., include_lowest=True)
+    return np.clip(np.searchsorted(edges, values, side='left') - 1, 0, len(edges) - 2)
+
+
+def _bin_labels(edges):
+    # Lower edges as labelled by pd.cut (rounded, lowest one adjusted by include_lowest)
+    return list(pd.cut(edges[:1], edges, include_lowest=True).categories.left)
+
+PolygonIndex = collections.namedtuple('PolygonIndex', ['bounds', 'cells', 'edges'])
+
+CELL_OUTSIDE, CELL_INSIDE, CELL_BOUNDARY = 0, 1, 2
+
+
+def get_polygon_index(levels, n_grid=POLYGON_GRID):
+    """ Precompute per-level structures for get_polygon_mask.
+
+        Each level's polygon bounding box is split into n_grid x n_grid cells. Cells not crossed by any
+        polygon edge are entirely inside or outside the polygon; only points in the remaining boundary
+        cells need an exact point-in-polygon test.
+
+        levels : list of dict with (level, polygon) keys, as in levels.json
+        n_grid : int (default: POLYGON_GRID)
+
+        Returns : PolygonIndex
+            bounds : np.array (4, max_level + 1) of bot_lat, top_lng, top_lat, bot_lng (NaN for missing levels)
+            cells  : np.array (max_level + 1, n_grid, n_grid) of CELL_OUTSIDE, CELL_INSIDE or CELL_BOUNDARY
+            edges  : dict of level_id -> (lat1, lng1, lat2, lng2) arrays
+    """
+    size = max(level['level'] for level in levels) + 1
+    bounds = np.full((4, size), np.nan)
+    cells = np.zeros((size, n_grid, n_grid), dtype=np.int8)
+    edges = {}
+
+    for level in levels:
+        level_id = level['level']
+        polygon = np.asarray(level['polygon'], dtype=np.float64)
+        lat1, lng1 = polygon[:, 0], polygon[:, 1]
+        lat2, lng2 = np.roll(lat1, -1), np.roll(lng1, -1)
+        edges[level_id] = lat1, lng1, lat2, lng2
+
+        bot_lat, top_lng, top_lat, bot_lng = lat1.min(), lng1.min(), lat1.max(), lng1.max()
+        bounds[:, level_id] = bot_lat, top_lng, top_lat, bot_lng
+
+        # Classify cell centers exactly, then mark every cell overlapped by an edge's bounding box
+        centers_lat = bot_lat + (np.arange(n_grid) + 0.5) * (top_lat - bot_lat) / n_grid
+        centers_lng = top_lng + (np.arange(n_grid) + 0.5) * (bot_lng - top_lng) / n_grid
+        grid_lat, grid_lng = np.meshgrid(centers_lat, centers_lng, indexing='ij')
+        level_cells = _points_in_polygon(grid_lat.ravel(), grid_lng.ravel(), edges[level_id]).reshape(n_grid, n_grid)
+        level_cells = level_cells.astype(np.int8)
+
+        lat_idx = _cell_index(np.stack([lat1, lat2]), bot_lat, top_lat, n_grid)
+        lng_idx = _cell_index(np.stack([lng1, lng2]), top_lng, bot_lng, n_grid)
+        for i0, i1, j0, j1 in zip(lat_idx.min(axis=0), lat_idx.max(axis=0), lng_idx.min(axis=0), lng_idx.max(axis=0)):
+            level_cells[i0:i1 + 1, j0:j1 + 1] = CELL_BOUNDARY
+        cells[level_id] = level_cells
+
+    return PolygonIndex(bounds, cells, edges)
+
+
+def get_polygon_mask(points, polygon_index):
+    """ Boolean mask of points lying inside the polygon of their own level, for all levels in one pass.
+
+        points        : pd.DataFrame with (level, lat, lng) columns
+        polygon_index : PolygonIndex from get_polygon_index
+
+        Returns : np.array of bool with same length as points
+    """
+    bounds, cells, edges = polygon_index
+    n_grid = cells.shape[1]
+    levels = points['level'].values.astype(np.int64)
+    lat, lng = points['lat'].values, points['lng'].values
+
+    known = (levels >= 0) & (levels < cells.shape[0])
+    levels = np.where(known, levels, 0)
+    bot_lat, top_lng, top_lat, bot_lng = bounds[:, levels]
+    in_bounds = known & (lat >= bot_lat) & (lat <= top_lat) & (lng >= top_lng) & (lng <= bot_lng)
+
+    # Accept or reject whole cells; NaN bounds of missing levels are already out of bounds
+    with np.errstate(invalid='ignore'):
+        lat_idx = _cell_index(lat, bot_lat, top_lat, n_grid)
+        lng_idx = _cell_index(lng, top_lng, bot_lng, n_grid)
+    state = np.where(in_bounds, cells[levels, lat_idx, lng_idx], CELL_OUTSIDE)
+    mask = state == CELL_INSIDE
+
+    # Exact test for points in boundary cells, grouped by level
+    boundary = np.flatnonzero(state == CELL_BOUNDARY)
+    boundary = boundary[np.argsort(levels[boundary], kind='stable')]
+    boundary_levels = levels[boundary]
+    for level_id in np.unique(boundary_levels):
+        start, end = np.searchsorted(boundary_levels, level_id, side='left'), np.searchsorted(boundary_levels, level_id, side='right')
+        idx = boundary[start:end]
+        mask[idx] = _points_in_polygon(lat[idx], lng[idx], edges[level_id])
+    return mask
+
+
+def _cell_index(values, low, high, n_grid):
+    idx = np.floor((values - low) / (high - low) * n_grid)
+    return np.clip(np.nan_to_num(idx), 0, n_grid - 1).astype(np.int64)
+
+
+def _points_in_polygon(lat, lng, edges):
+    # Even-odd rule: count crossings of a ray going from each point towards increasing lng
+    inside = np.zeros(len(lat), dtype=bool)
+    for lat1, lng1, lat2, lng2 in zip(*edges):
+        crosses = (lat1 > lat) != (lat2 > lat)
+        if not crosses.any():
+            continue
+        lng_cross = lng1 + (lat[crosses] - lat1) * (lng2 - lng1) / (lat2 - lat1)
+        inside[crosses] ^= lng[crosses] < lng_cross
+    return inside
+
+
 # Dataset-specific functions
-def browser_to_os(browser):
+UNKNOWN = 'Unknown'
+AGENT_CACHE_SIZE = 4096
+
+def _match_agent(browser):
+    # Plain substring checks on the agent lowercased once, in the order of the original if/elif chain.
+    # iPhones without a known iOS version map to None.
     browser = browser.lower()
 
     # Ubuntu
@@ -190,7 +758,7 @@ def browser_to_os(browser):
     # OS X
     elif ("intel mac os x" in browser):
         return "OS X"
-    
+
     # iPhone
     elif ("cpu iphone" in browser) or ("wp-iphone" in browser):
         if ("os 9" in browser):
@@ -199,6 +767,7 @@ def browser_to_os(browser):
             return "iPhone iOS 8"
         elif ("os 7" in browser):
             return "iPhone iOS 7"
+        return None
 
     # Android
     elif "android 5" in browser:
@@ -218,8 +787,54 @@ def browser_to_os(browser):
     elif "linux" in browser:
         return "Other Linux"
 
-    else:
-        raise ValueError("Unknown agent string: %s" % browser)
+    return UNKNOWN
+
+
+def browser_to_os(browser):
+    os_name = _match_agent(browser)
+    if os_name == UNKNOWN:
+        raise ValueError("Unknown agent string: %s" % browser.lower())
+    return os_name
+
+
+@functools.lru_cache(maxsize=AGENT_CACHE_SIZE)
+def classify_agent(browser, strict=True):
+    """ Classify an agent string into (OS, OS_generic, is_mobile). Results are LRU-cached.
+
+        strict : bool (default: True)
+            Raise ValueError on unknown agents, otherwise classify them as UNKNOWN
+    """
+    os_name = _match_agent(browser) if isinstance(browser, str) else UNKNOWN
+    if (os_name is None) or (os_name == UNKNOWN):
+        if strict:
+            raise ValueError("Unknown agent string: %s" % browser)
+        return UNKNOWN, UNKNOWN, False
+    os_generic = os_to_generic(os_name)
+    return os_name, os_generic, is_mobile(os_generic)
+
+
+def classify_agents(browsers, strict=True):
+    """ Classify a column of agent strings, looking at each distinct agent only once.
+
+        browsers : pd.Series of str
+        strict   : bool (default: True)
+            Raise ValueError on unknown agents, otherwise classify them as UNKNOWN
+
+        Returns : pd.DataFrame with same index as browsers
+            Categorical OS and OS_generic columns and a boolean is_mobile column
+    """
+    codes, uniques = pd.factorize(browsers, use_na_sentinel=False)
+    os_names, os_generics, mobiles = zip(*[classify_agent(b, strict) for b in uniques]) if len(uniques) else ((), (), ())
+
+    def categorical(values):
+        value_codes, categories = pd.factorize(pd.Index(values, dtype=object))
+        return pd.Categorical.from_codes(value_codes[codes], categories)
+
+    return pd.DataFrame({
+        'OS': categorical(os_names),
+        'OS_generic': categorical(os_generics),
+        'is_mobile': np.asarray(mobiles, dtype=bool)[codes],
+    }, index=browsers.index)
 
 
 def os_to_generic(os_name):
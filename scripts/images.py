@@ -0,0 +1,78 @@
+import functools
+import glob
+import os
+
+import numpy as np
+from PIL import Image
+
+import loader
+
+
+# Constants
+DATA_DIR = loader.DATA_DIR
+IMAGE_PATH = 'images/level{}.png'
+CACHE_DIR = 'cache/images'
+
+
+# Functions
+def load_level_image(level_id, shape=None, data_dir=DATA_DIR):
+    """ Decoded background image of a level as a read-only RGBA uint8 array.
+
+        Each decoded (and downsampled) image is stored once as .npy under data_dir/cache/images and
+        memory-mapped afterwards, so repeated and parallel plot calls share the same pages without
+        decoding or copying. Cached arrays are rebuilt when the source PNG changes (mtime or size).
+
+        level_id : int
+        shape    : (int, int) (default: None)
+            Rows and columns to downsample to, e.g. the rendered size in pixels. The image is never
+            upsampled; None for full resolution
+        data_dir : str (default: DATA_DIR)
+
+        Returns : np.memmap of shape (rows, cols, 4)
+    """
+    path = os.path.join(data_dir, IMAGE_PATH.format(level_id))
+    st = os.stat(path)
+    return _load_cached(path, st.st_mtime_ns, st.st_size, tuple(shape) if shape else None, os.path.join(data_dir, CACHE_DIR))
+
+
+@functools.lru_cache(maxsize=64)
+def _load_cached(path, mtime_ns, size, shape, cache_dir):
+    stamp = '%x-%x' % (mtime_ns, size)
+    name = os.path.splitext(os.path.basename(path))[0]
+    with Image.open(path) as img:
+        full_shape = (img.height, img.width)
+        shape = _fit_shape(full_shape, shape)
+        cache_path = os.path.join(cache_dir, '%s.%s.%dx%d.npy' % (name, stamp, shape[0], shape[1]))
+        if not os.path.exists(cache_path):
+            img = img.convert('RGBA')
+            if shape != full_shape:
+                img = img.resize((shape[1], shape[0]), Image.BOX)
+            _save_atomic(cache_path, np.asarray(img, dtype=np.uint8))
+            _remove_stale(cache_dir, name, stamp)
+    return np.load(cache_path, mmap_mode='r')
+
+
+def _fit_shape(full_shape, shape):
+    # Downsample keeping the aspect ratio of the source image, never upsample
+    if shape is None:
+        return full_shape
+    scale = min(1.0, shape[0] / full_shape[0], shape[1] / full_shape[1])
+    return max(1, int(round(full_shape[0]*scale))), max(1, int(round(full_shape[1]*scale)))
+
+
+def _save_atomic(cache_path, arr):
+    if not os.path.isdir(os.path.dirname(cache_path)):
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.save(f, arr)
+    os.replace(tmp_path, cache_path)
+
+
+def _remove_stale(cache_dir, name, stamp):
+    for path in glob.glob(os.path.join(cache_dir, '%s.*.npy' % name)):
+        if os.path.basename(path).split('.')[1] != stamp:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
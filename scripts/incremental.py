@@ -0,0 +1,181 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+import functions
+import sketch
+
+
+class LevelStats(object):
+    """ Incrementally updated statistics of one level: heatmap bin counts, Welford mean and variance of
+        distances to the truth point, and a quantile sketch of the distances for filter_iqr bounds.
+
+        Updating costs O(len(batch)); states built over disjoint batches can be merged.
+
+        level_id  : int
+        p_ref     : (float, float)
+            lat, lng coordinates of the truth point of the level
+        rects     : dict of level_id -> rect
+        grid_area : int (default: functions.GRID_AREA)
+        fig_area  : int (default: functions.FIG_AREA)
+        eps       : float (default: sketch.EPS)
+            Rank error of the quantile sketch
+    """
+    def __init__(self, level_id, p_ref, rects, grid_area=functions.GRID_AREA, fig_area=functions.FIG_AREA, eps=sketch.EPS):
+        self.level_id = level_id
+        self.p_ref = tuple(p_ref)
+        self.rect = rects[level_id]
+        self.grid_area = grid_area
+        self.fig_area = fig_area
+
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.bins = self._get_bins(pd.DataFrame({'level': [], 'lat': [], 'lng': []}))
+        self.sketch = sketch.QuantileSketch(eps=eps)
+
+    def update(self, batch):
+        """ Fold a batch of new points of this level.
+
+            batch : pd.DataFrame with (lat, lng) columns
+
+            Returns : pd.Series with same index as batch
+                Running mean of distances continuing over the batch, as functions.calc_cum_dist
+        """
+        dists = functions.dist(self.p_ref, batch)
+        self.bins += self._get_bins(batch).values
+        self.sketch.update(dists.values)
+
+        n_before, sum_before = self.n, self.mean*self.n
+        self._merge_moments(len(dists), dists.mean() if len(dists) else 0.0, ((dists - dists.mean())**2).sum() if len(dists) else 0.0)
+        return (sum_before + dists.cumsum()) / np.arange(n_before + 1, n_before + len(dists) + 1)
+
+    def merge(self, other):
+        """ Fold the state of other, built over different points of the same level. """
+        assert (other.level_id == self.level_id) and (other.p_ref == self.p_ref), "can only merge states of the same level"
+        assert other.bins.shape == self.bins.shape, "can only merge states with the same grid"
+        self.bins += other.bins.values
+        self.sketch.merge(other.sketch)
+        self._merge_moments(other.n, other.mean, other.m2)
+        return self
+
+    @property
+    def std(self):
+        """ Sample standard deviation of distances (ddof=1, as pd.Series.std). """
+        return (self.m2 / (self.n - 1))**0.5 if self.n > 1 else np.nan
+
+    def iqr_bounds(self, num_iqr):
+        """ Approximate (lower, upper) bounds used by functions.filter_iqr. """
+        q1, median, q3 = self.sketch.quantile([0.25, 0.5, 0.75])
+        iqr = q3 - q1
+        return median - iqr*num_iqr, median + iqr*num_iqr
+
+    def snapshot(self):
+        """ JSON-serializable state, to be passed to restore. """
+        return {
+            'level_id': self.level_id, 'p_ref': list(self.p_ref), 'grid_area': self.grid_area, 'fig_area': self.fig_area,
+            'n': self.n, 'mean': self.mean, 'm2': self.m2,
+            'bins': self.bins.values.tolist(), 'sketch': self.sketch.snapshot(),
+        }
+
+    @classmethod
+    def restore(cls, snapshot, rects):
+        stats = cls(snapshot['level_id'], snapshot['p_ref'], rects, snapshot['grid_area'], snapshot['fig_area'], eps=snapshot['sketch']['eps'])
+        stats.n, stats.mean, stats.m2 = snapshot['n'], snapshot['mean'], snapshot['m2']
+        stats.bins[:] = np.asarray(snapshot['bins'], dtype=stats.bins.values.dtype)
+        stats.sketch = sketch.QuantileSketch.restore(snapshot['sketch'])
+        return stats
+
+    def _get_bins(self, batch):
+        batch = batch.assign(level=self.level_id)
+        return functions.get_bins_levels(batch, {self.level_id: self.rect}, [self.level_id], self.grid_area, self.fig_area)[self.level_id]
+
+    def _merge_moments(self, n, mean, m2):
+        # Chan et al. parallel update of Welford's mean and sum of squared deviations
+        if n == 0:
+            return
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta**2 * self.n * n / total
+        self.n = total
+
+
+def get_level_stats(points_ref, rects, level_ids=None, **kwargs):
+    """ Empty LevelStats for each level, keyed by level_id. kwargs are passed to LevelStats. """
+    level_ids = sorted(rects) if level_ids is None else level_ids
+    p_refs = points_ref.set_index('level')
+    return {level_id: LevelStats(level_id, (p_refs.lat[level_id], p_refs.lng[level_id]), rects, **kwargs) for level_id in level_ids}
+
+
+def update_level_stats(level_stats, batch):
+    """ Fold a batch of points of any levels into the LevelStats of their level. """
+    for level_id, plevel in batch.groupby('level'):
+        if level_id in level_stats:
+            level_stats[level_id].update(plevel)
+    return level_stats
+
+
+def load_level_stats(path, points_ref, rects, level_ids=None):
+    """ LevelStats saved by save_level_stats, or empty ones if path does not exist or was built for other
+        truth points.
+
+        Returns : dict of level_id -> LevelStats, int, str
+            Stats, the largest point id folded into them (-1 if none) and the ids_digest of the folded ids
+    """
+    level_stats = get_level_stats(points_ref, rects, level_ids)
+    try:
+        with open(path, 'r') as f:
+            saved = json.load(f)
+    except (IOError, ValueError):
+        return level_stats, -1, ids_digest([])
+
+    restored = {snapshot['level_id']: LevelStats.restore(snapshot, rects) for snapshot in saved['levels']}
+    if any((level_id not in restored) or (restored[level_id].p_ref != stats.p_ref) for level_id, stats in level_stats.items()):
+        return level_stats, -1, ids_digest([])
+    return {level_id: restored[level_id] for level_id in level_stats}, saved['last_id'], saved.get('ids_digest')
+
+
+def save_level_stats(path, level_stats, last_id, digest):
+    """ Write the snapshots of level_stats, the largest point id folded into them and the ids_digest of the
+        folded ids to path, as JSON.
+    """
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'last_id': int(last_id), 'ids_digest': digest, 'levels': [stats.snapshot() for stats in level_stats.values()]}, f)
+    os.replace(path + '.tmp', path)
+
+
+def ids_digest(point_ids):
+    """ Hash of a set of point ids, whatever their order. """
+    return hashlib.sha1(np.sort(np.asarray(point_ids, dtype=np.int64)).tobytes()).hexdigest()
+
+
+def refresh_level_stats(path, points, point_ids, points_ref, rects, level_ids=None):
+    """ Fold the points added since the state in path was saved, and save it again.
+
+        Clean point ids are not append-only: a replayed level replaces a point already folded, and a
+        player completing the game later brings in points with ids below the last folded one. The points
+        with ids up to the saved last id must therefore be exactly the folded ones, which is checked
+        against the saved ids_digest. Otherwise the stats are rebuilt from all points.
+
+        points    : pd.DataFrame with (level, lat, lng) columns
+        point_ids : np.array
+            Clean point id of each row of points
+
+        Returns : dict of level_id -> LevelStats, int, bool
+            Stats, number of points folded and whether the state was rebuilt
+    """
+    point_ids = np.asarray(point_ids, dtype=np.int64)
+    level_stats, last_id, digest = load_level_stats(path, points_ref, rects, level_ids)
+    is_new = point_ids > last_id
+    is_rebuilt = (last_id >= 0) and (digest != ids_digest(point_ids[~is_new]))
+    if is_rebuilt:
+        level_stats = get_level_stats(points_ref, rects, level_ids)
+        is_new[:] = True
+
+    update_level_stats(level_stats, points[is_new])
+    save_level_stats(path, level_stats, int(point_ids.max()) if len(point_ids) else -1, ids_digest(point_ids))
+    return level_stats, int(is_new.sum()), is_rebuilt
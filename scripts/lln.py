@@ -1,15 +1,15 @@
 import argparse
-import json
 import math
 import os
 
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-import scipy as scp
-import seaborn as sns
 
+import bootstrap
 import functions
+import loader
+import profiling
+import render
 
 
 # Constants
@@ -21,82 +21,160 @@ BG_COLOR = 'tan'
 XLABEL = 'Jumlah pemain'
 YLABEL = 'Rata-rata jarak'
 NUM_IQR = 2.0
+BAND_PERCENTILES = [(5, 95), (25, 75)]
+BAND_ALPHA = 0.3
 
-sns.set_style('white')
 
 # Functions
-def plot_cum_dist(dist_points, level_id, line_col=None, lw=None, bg_color=None, show_mean=False, title=None, xlabel=None, ylabel=None, save_to=None):
-    cum_dist = calc_cum_dist(dist_points)
-    ax = cum_dist.plot.line(color=line_col or LINE_COL, lw=lw or LW)
-    ax.set_axis_bgcolor(bg_color or BG_COLOR)
+def plot_cum_dist(dist_points, level_id, line_col=None, lw=None, bg_color=None, show_mean=False, title=None, xlabel=None, ylabel=None, save_to=None, ax=None):
+    import matplotlib.pyplot as plt
+
+    ax = plt.gca() if ax is None else ax
+    cum_dist = functions.calc_cum_dist(dist_points)
+    cum_dist.plot.line(color=line_col or LINE_COL, lw=lw or LW, ax=ax)
+    ax.set_facecolor(bg_color or BG_COLOR)
 
     if show_mean:
-        plt.axhline(dist_points.mean(), 0, len(dist_points), linestyle='--', color=LINE_COL)
+        ax.axhline(dist_points.mean(), 0, len(dist_points), linestyle='--', color=LINE_COL)
 
-    plt.title(title or "Rata-rata jarak pemain terhadap jumlah pemain - Level {}".format(level_id))
-    plt.xlabel(xlabel or XLABEL)
-    plt.ylabel(ylabel or YLABEL)
+    ax.set_title(title or "Rata-rata jarak pemain terhadap jumlah pemain - Level {}".format(level_id))
+    ax.set_xlabel(xlabel or XLABEL)
+    ax.set_ylabel(ylabel or YLABEL)
 
     if save_to:
         try:
             os.makedirs(save_to)
         except:
             pass
-        plt.savefig(os.path.join(save_to, 'level{}.png'.format(level_id)))
+        ax.figure.savefig(os.path.join(save_to, 'level{}.png'.format(level_id)))
 
     return ax
 
 
-def calc_cum_dist(dist_points):
-    return dist_points.cumsum() / pd.Series(range(1, len(dist_points) + 1))
+def plot_cum_dist_bands(dist_points, cum_dists, level_id, num_orderings, line_col=None, lw=None, bg_color=None, show_mean=False, title=None, xlabel=None, ylabel=None, save_to=None, ax=None):
+    import matplotlib.pyplot as plt
+
+    ax = plt.gca() if ax is None else ax
+    for lower, upper in BAND_PERCENTILES:
+        ax.fill_between(cum_dists.index, cum_dists[lower], cum_dists[upper], color=line_col or LINE_COL, alpha=BAND_ALPHA, lw=0)
+    cum_dists['mean'].plot.line(ax=ax, color=line_col or LINE_COL, lw=lw or LW)
+    ax.set_facecolor(bg_color or BG_COLOR)
+
+    if show_mean:
+        ax.axhline(dist_points.mean(), 0, len(dist_points), linestyle='--', color=LINE_COL)
+
+    ax.set_title(title or "Rata-rata jarak pemain terhadap jumlah pemain ({} urutan) - Level {}".format(num_orderings, level_id))
+    ax.set_xlabel(xlabel or XLABEL)
+    ax.set_ylabel(ylabel or YLABEL)
+
+    if save_to:
+        try:
+            os.makedirs(save_to)
+        except:
+            pass
+        ax.figure.savefig(os.path.join(save_to, 'level{}.png'.format(level_id)))
+
+    return ax
+
+
+def calc_cum_dist_bands(dist_points, num_orderings, seed=None, max_workers=1):
+    """ Running mean of distances over num_orderings random player orderings.
+
+        Returns : pd.DataFrame indexed by number of players
+            'mean' column with the mean running mean, and one column per percentile in BAND_PERCENTILES
+    """
+    seed = bootstrap.SEED if seed is None else seed
+    positions, cum_dists = bootstrap.running_means_orderings(dist_points.values, num_orderings, seed=seed, max_workers=max_workers)
+    percentiles = sorted(set(p for band in BAND_PERCENTILES for p in band))
+    bands = pd.DataFrame(np.percentile(cum_dists, percentiles, axis=0).T, index=positions, columns=percentiles)
+    bands['mean'] = cum_dists.mean(axis=0)
+    return bands
 
 
 def parse_and_assert_args():
     arg_parser = argparse.ArgumentParser(prog='pinisi', description="Law of large numbers simulation with Pinisi data", usage="")
 
     arg_parser.add_argument('-r', dest='filter_rect', action='store_true', help='Filter data points only inside rectangle. Takes precedence over num_iqr (default: False)')
+    arg_parser.add_argument('-g', dest='filter_polygon', action='store_true', help='Filter data points only inside level polygon. Takes precedence over filter_rect and num_iqr (default: False)')
     arg_parser.add_argument('-i', dest='num_iqr', help='Filter data points outside num_iqr * IQR. Set to 0 to prevent filtering (default: {})'.format(NUM_IQR))
     arg_parser.add_argument('-m', dest='show_mean', action='store_true', help='Show mean line (default: False)')
     arg_parser.add_argument('-s', dest='save_to', help='Directory for saving plots (default: None)')
+    arg_parser.add_argument('-k', dest='num_orderings', help='Plot percentile bands over this many random player orderings instead of the file order (default: None)')
+    arg_parser.add_argument('-w', dest='max_workers', help='Number of processes for the random orderings (default: 1)')
+    arg_parser.add_argument('--profile', dest='profile', help="Write a JSON report of stage timings and memory to this file, or folded stacks if it ends with '.folded' (default: None)")
+    arg_parser.add_argument('--seed', dest='seed', help='Seed of the random orderings (default: {})'.format(bootstrap.SEED))
     
     args = arg_parser.parse_args()
     num_iqr = args.num_iqr
     if num_iqr is not None:
         num_iqr = float(num_iqr)
         assert num_iqr >= 0.0, "num_iqr must be >= 0"
+    if args.num_orderings is not None:
+        assert int(args.num_orderings) > 0, "num_orderings must be > 0"
+    if args.max_workers is not None:
+        assert int(args.max_workers) > 0, "max_workers must be > 0"
     return args
 
 
 if __name__ == '__main__':
     args = parse_and_assert_args()
     filter_rect = args.filter_rect
+    filter_polygon = args.filter_polygon
     num_iqr = float(args.num_iqr) if args.num_iqr else NUM_IQR
     show_mean = args.show_mean
     save_to = args.save_to
-
-    TRUTH_ID = int(open('../data/truth_ID').read())
-    EXPERT_ID = int(open('../data/expert_ID').read())
-
-    points = pd.read_csv('../data/clean/points.psv', sep='|', index_col='id')
-    users = pd.read_csv('../data/clean/users.psv', sep='|', index_col='id')
-    levels = json.load(open('../data/levels.json', 'r'))['maps']
-    rects = {level['level']: functions.get_rect(level['polygon']) for level in levels}
-    areas = {level_id: functions.calc_rect_area(rect) for level_id, rect in rects.items()}
-
-    points_truth = points[points.user_id == TRUTH_ID].reset_index(drop=True)
-    points_expert = points[points.user_id == EXPERT_ID].reset_index(drop=True)
-    points = points[~points.user_id.isin([TRUTH_ID, EXPERT_ID])].reset_index(drop=True)
-
-    dists = {level_id: functions.get_dist_level(points_truth, points_expert, points, level_id) for level_id in LEVEL_IDS}
-    dists_points = {level_id: d[0] for level_id, d in dists.items()}
-    
-    for level_id, dist_points in dists_points.items():
-        if filter_rect:
-            points_idx = functions.get_points_level(points, rects, level_id).index
-            dist_points = dist_points[points_idx]
-        elif num_iqr:
-            dist_points = functions.filter_iqr(dist_points, num_iqr)
-
-        dist_points = dist_points.reset_index(drop=True)
-        plot_cum_dist(dist_points, level_id, show_mean=show_mean, save_to=save_to)
-        plt.clf()
+    num_orderings = int(args.num_orderings) if args.num_orderings else None
+    max_workers = int(args.max_workers) if args.max_workers else 1
+    seed = int(args.seed) if args.seed else bootstrap.SEED
+
+    if args.profile:
+        profiling.enable()
+
+    with profiling.stage('load') as stage:
+        points, users, levels, rects, TRUTH_ID, EXPERT_ID = loader.load_data()
+        areas = {level_id: functions.calc_rect_area(rect) for level_id, rect in rects.items()}
+
+        points_truth = points[points.user_id == TRUTH_ID].reset_index(drop=True)
+        points_expert = points[points.user_id == EXPERT_ID].reset_index(drop=True)
+        points = points[~points.user_id.isin([TRUTH_ID, EXPERT_ID])].reset_index(drop=True)
+        stage.set_rows(len(points))
+
+    with profiling.stage('distance', rows=len(points)):
+        dists, dists_expert = functions.get_dist_levels(points_truth, points_expert, points)
+        dists_levels = dists.groupby(points.level.values)
+        dists_points = {level_id: dists_levels.get_group(level_id) for level_id in LEVEL_IDS}
+
+    with profiling.stage('filter', rows=len(points)):
+        if filter_polygon:
+            in_polygon = functions.get_polygon_mask(points, functions.get_polygon_index(levels))
+
+        for level_id, dist_points in dists_points.items():
+            if filter_polygon:
+                points_idx = points.index[in_polygon & (points.level == level_id).values]
+                dist_points = dist_points[points_idx]
+            elif filter_rect:
+                points_idx = functions.get_points_level(points, rects, level_id).index
+                dist_points = dist_points[points_idx]
+            elif num_iqr:
+                dist_points = functions.filter_iqr(dist_points, num_iqr)
+            dists_points[level_id] = dist_points.reset_index(drop=True)
+
+    plot_jobs = []
+    if save_to and num_orderings:
+        with profiling.stage('orderings', rows=sum(len(dist_points) for dist_points in dists_points.values())):
+            for level_id, dist_points in dists_points.items():
+                cum_dists = calc_cum_dist_bands(dist_points, num_orderings, seed=seed, max_workers=max_workers)
+                plot_jobs.append(render.Job(plot_cum_dist_bands, (dist_points, cum_dists, level_id, num_orderings), {'show_mean': show_mean},
+                                            os.path.join(save_to, 'level{}.png'.format(level_id))))
+    elif save_to:
+        plot_jobs = [render.Job(plot_cum_dist, (dist_points, level_id), {'show_mean': show_mean}, os.path.join(save_to, 'level{}.png'.format(level_id)))
+                     for level_id, dist_points in dists_points.items()]
+
+    with profiling.stage('plot'):
+        if plot_jobs:
+            import seaborn as sns
+            sns.set_style('white')
+        render.render_all(plot_jobs)
+
+    if args.profile:
+        profiling.report(args.profile)
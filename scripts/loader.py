@@ -0,0 +1,124 @@
+import collections
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+import functions
+
+
+# Constants
+ROOT_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+DATA_DIR = os.path.join(ROOT_DIR, 'data')    # independent of the working directory
+CACHE_VERSION = 1
+
+POINTS_DTYPES = {'id': np.int32, 'user_id': np.int32, 'level': np.int8, 'lat': np.float64, 'lng': np.float64}
+USERS_DTYPES = {'id': np.int32, 'is_mobile': np.bool_}
+USERS_CATEGORIES = ['browser', 'OS', 'OS_generic']
+
+SOURCES = ['clean/points.psv', 'clean/users.psv', 'levels.json', 'truth_ID', 'expert_ID']
+
+Dataset = collections.namedtuple('Dataset', ['points', 'users', 'levels', 'rects', 'truth_id', 'expert_id'])
+
+
+# Functions
+def load_data(data_dir=DATA_DIR, use_cache=True, float32=False):
+    """ Load cleaned points and users, levels, rects and truth/expert IDs.
+
+        The tables are cached as one .npy file per column under data_dir/cache and loaded memory-mapped.
+        The cache is rebuilt whenever a source file changes (mtime or size).
+
+        data_dir  : str
+            Directory containing clean/, levels.json, truth_ID and expert_ID
+        use_cache : bool (default: True)
+            Set to False to always parse the text files
+        float32   : bool (default: False)
+            Store lat, lng as float32 to halve memory
+
+        Returns : Dataset
+    """
+    if not use_cache:
+        return _parse_data(data_dir, float32)
+
+    cache_dir = os.path.join(data_dir, 'cache', 'f32' if float32 else 'f64')
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    stamp = _source_stamp(data_dir)
+    try:
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+    except (IOError, ValueError):
+        meta = None
+
+    if (meta is None) or (meta['stamp'] != stamp):
+        dataset = _parse_data(data_dir, float32)
+        _write_cache(dataset, cache_dir, stamp)
+        return dataset
+    return _read_cache(cache_dir, meta)
+
+
+def _source_stamp(data_dir):
+    stamp = {'version': CACHE_VERSION}
+    for source in SOURCES:
+        st = os.stat(os.path.join(data_dir, source))
+        stamp[source] = [st.st_mtime_ns, st.st_size]
+    return stamp
+
+
+def _parse_data(data_dir, float32):
+    coord_dtype = np.float32 if float32 else np.float64
+    points = pd.read_csv(os.path.join(data_dir, 'clean/points.psv'), sep='|',
+                         dtype=dict(POINTS_DTYPES, lat=coord_dtype, lng=coord_dtype), parse_dates=['timestamp'])
+    points = points.set_index('id')
+    users = pd.read_csv(os.path.join(data_dir, 'clean/users.psv'), sep='|',
+                        dtype=dict(USERS_DTYPES, **{col: 'category' for col in USERS_CATEGORIES}), parse_dates=['timestamp'])
+    users = users.set_index('id')
+
+    levels = json.load(open(os.path.join(data_dir, 'levels.json'), 'r'))['maps']
+    rects = {level['level']: functions.get_rect(level['polygon']) for level in levels}
+    truth_id = int(open(os.path.join(data_dir, 'truth_ID')).read())
+    expert_id = int(open(os.path.join(data_dir, 'expert_ID')).read())
+    return Dataset(points, users, levels, rects, truth_id, expert_id)
+
+
+def _write_cache(dataset, cache_dir, stamp):
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    meta = {'stamp': stamp, 'levels': dataset.levels, 'truth_id': dataset.truth_id, 'expert_id': dataset.expert_id,
+            'rects': [[level_id, rect] for level_id, rect in dataset.rects.items()], 'tables': {}}
+    for name, table in [('points', dataset.points), ('users', dataset.users)]:
+        columns = {}
+        np.save(os.path.join(cache_dir, '%s.%s.npy' % (name, table.index.name)), table.index.values)
+        for col in table.columns:
+            values = table[col]
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                columns[col] = [str(c) for c in values.cat.categories]
+                values = values.cat.codes
+            else:
+                columns[col] = None
+            np.save(os.path.join(cache_dir, '%s.%s.npy' % (name, col)), values.values)
+        meta['tables'][name] = {'index': table.index.name, 'columns': columns}
+
+    # Write meta last, so a partially written cache is never considered valid
+    meta_tmp = os.path.join(cache_dir, 'meta.json.tmp')
+    with open(meta_tmp, 'w') as f:
+        json.dump(meta, f)
+    os.replace(meta_tmp, os.path.join(cache_dir, 'meta.json'))
+
+
+def _read_cache(cache_dir, meta):
+    tables = {}
+    for name, table_meta in meta['tables'].items():
+        load = lambda col: np.load(os.path.join(cache_dir, '%s.%s.npy' % (name, col)), mmap_mode='r')
+        data = {}
+        for col, categories in table_meta['columns'].items():
+            if categories is None:
+                data[col] = load(col)
+            else:
+                data[col] = pd.Categorical.from_codes(load(col), categories)
+        index = pd.Index(load(table_meta['index']), name=table_meta['index'])
+        tables[name] = pd.DataFrame(data, index=index, copy=False)
+
+    rects = {level_id: (tuple(rect[0]), tuple(rect[1])) for level_id, rect in meta['rects']}
+    return Dataset(tables['points'], tables['users'], meta['levels'], rects, meta['truth_id'], meta['expert_id'])
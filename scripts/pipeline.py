@@ -0,0 +1,455 @@
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import json
+import multiprocessing
+import os
+import pickle
+import re
+import threading
+import time
+
+import pandas as pd
+
+import analysis
+import functions
+import loader
+import render
+
+
+# Constants
+PIPELINE_VERSION = 1
+CACHE_DIR = os.path.join(loader.DATA_DIR, 'cache', 'pipeline')
+LEVEL_IDS = analysis.LEVEL_IDS
+PLOT_KINDS = ['hist', 'lln', 'scatter', 'heatmap']
+HEATMAP_GRID_AREAS = {6: 384}    # grid area of plot.py heatmaps, 192 for other levels
+
+Node = collections.namedtuple('Node', ['name', 'func', 'deps', 'params', 'cache', 'process', 'files'], defaults=[(), {}, True, False, False])
+Node.__doc__ = """ A stage of the pipeline, computed as func(*outputs of deps, **params).
+
+    cache   : bool
+        Keep the output on disk, keyed by the hash of func, params and the content of deps. Uncached nodes
+        are only run when a downstream node has to be computed, and are keyed by their inputs only
+    process : bool
+        Run func in the process pool instead of a thread, for plots and other GIL-bound stages
+    files   : bool
+        The output is the path, or list of paths, of files written by func. The cached output is only
+        valid while all of them exist
+"""
+
+
+# Functions
+def run(nodes, targets=None, cache_dir=CACHE_DIR, max_workers=None, force=False):
+    """ Compute the targets of a DAG of nodes, reusing cached outputs whose inputs are unchanged.
+
+        Nodes are resolved as soon as all their deps are: the key of a node is the hash of its function,
+        its params and the content hashes of its deps. A cached node whose key has a file in cache_dir is
+        not run, and its output is only loaded if a downstream node needs it. Since the key depends on the
+        content of the deps and not on their keys, a recomputed node whose output is unchanged does not
+        invalidate the nodes below it.
+
+        nodes       : list of Node
+        targets     : list of str (default: None)
+            Names of the nodes to compute, None for the nodes no other node depends on
+        cache_dir   : str (default: CACHE_DIR)
+        max_workers : int (default: None)
+            Number of threads, and of processes for process nodes, None for os.cpu_count()
+        force       : bool (default: False)
+            Recompute every cached node
+
+        Returns : dict of str -> object, dict of str -> int
+            Output of every target, and number of nodes per status ('run', 'cached', 'skipped')
+    """
+    nodes = collections.OrderedDict((node.name, node) for node in nodes)
+    order = _toposort(nodes)
+    if targets is None:
+        deps = set(dep for node in nodes.values() for dep in node.deps)
+        targets = [name for name in order if name not in deps]
+    needed = _ancestors(nodes, targets)
+    order = [name for name in order if name in needed]
+
+    max_workers = max_workers or os.cpu_count() or 1
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    # forkserver, since forking a process that runs threads can deadlock
+    processes = None
+    if any(nodes[name].process for name in order):
+        processes = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('forkserver'))
+    state = _State(nodes, cache_dir, force, processes)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as threads:
+            running = {}
+            pending = list(order)
+            while pending or running:
+                for name in [name for name in pending if all(dep in state.hashes for dep in nodes[name].deps)]:
+                    pending.remove(name)
+                    running[threads.submit(state.resolve, name)] = name
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    del running[future]
+                    future.result()
+            outputs = {name: state.materialize(name) for name in targets}
+    finally:
+        if processes is not None:
+            processes.shutdown()
+
+    counts = collections.Counter(state.status[name] for name in order)
+    return outputs, {status: counts[status] for status in ['run', 'cached', 'skipped']}
+
+
+def node_key(node, dep_hashes, memo=None):
+    """ Hash of a node's function and the repo helpers it calls (see render.func_digest), its params and
+        the content hashes of its deps.
+    """
+    h = hashlib.sha1()
+    h.update(repr((PIPELINE_VERSION, node.name, node.func.__qualname__, dep_hashes)).encode())
+    h.update(render.func_digest(node.func, memo))
+    h.update(render.hash_value(sorted(node.params.items())).encode())
+    return h.hexdigest()
+
+
+def _toposort(nodes):
+    order, visiting, done = [], set(), set()
+
+    def visit(name, path):
+        assert name in nodes, "unknown node '{}' required by '{}'".format(name, path[-1] if path else None)
+        if name in done:
+            return
+        assert name not in visiting, "cycle through {}".format(' -> '.join(path + [name]))
+        visiting.add(name)
+        for dep in nodes[name].deps:
+            visit(dep, path + [name])
+        visiting.remove(name)
+        done.add(name)
+        order.append(name)
+
+    for name in nodes:
+        visit(name, [])
+    return order
+
+
+def _ancestors(nodes, targets):
+    needed, stack = set(), list(targets)
+    while stack:
+        name = stack.pop()
+        assert name in nodes, "unknown target '{}'".format(name)
+        if name not in needed:
+            needed.add(name)
+            stack.extend(nodes[name].deps)
+    return needed
+
+
+class _State(object):
+    """ Keys, content hashes and outputs of the nodes of one run, shared by the worker threads. """
+
+    def __init__(self, nodes, cache_dir, force, processes):
+        self.nodes = nodes
+        self.cache_dir = cache_dir
+        self.force = force
+        self.processes = processes
+        self.keys = {}
+        self.hashes = {}
+        self.outputs = {}
+        self.status = {}
+        self.digests = {}
+        self.locks = collections.defaultdict(threading.Lock)
+
+    def resolve(self, name):
+        node = self.nodes[name]
+        key = node_key(node, [self.hashes[dep] for dep in node.deps], self.digests)
+        self.keys[name] = key
+        if not node.cache:
+            self.status[name] = 'skipped'
+            self.hashes[name] = key
+            return
+
+        meta = None if self.force else _read_meta(self._path(name, key, '.json'))
+        if (meta is not None) and os.path.exists(self._path(name, key, '.pkl')) and all(os.path.exists(path) for path in meta.get('files', [])):
+            self.status[name] = 'cached'
+            self.hashes[name] = meta['hash']
+            return
+
+        output = self.materialize(name)
+        content_hash = render.hash_value(output)
+        self._save(name, key, output, content_hash, _output_files(output) if node.files else [])
+        self.hashes[name] = content_hash
+
+    def materialize(self, name):
+        """ Output of a resolved node, computing it, or loading it from the cache, on first use. """
+        with self.locks[name]:
+            if name in self.outputs:
+                return self.outputs[name]
+
+            node = self.nodes[name]
+            if self.status.get(name) == 'cached':
+                with open(self._path(name, self.keys[name], '.pkl'), 'rb') as f:
+                    output = pickle.load(f)
+            else:
+                args = [self.materialize(dep) for dep in node.deps]
+                if node.process and self.processes is not None:
+                    output = self.processes.submit(node.func, *args, **node.params).result()
+                else:
+                    output = node.func(*args, **node.params)
+                self.status[name] = 'run'
+            self.outputs[name] = output
+            return output
+
+    def _path(self, name, key, ext):
+        return os.path.join(self.cache_dir, '{}.{}{}'.format(name, key, ext))
+
+    def _save(self, name, key, output, content_hash, files):
+        # Output first, then its sidecar, so that a sidecar always has a complete output
+        for ext, mode, write in [('.pkl', 'wb', lambda f: pickle.dump(output, f, protocol=pickle.HIGHEST_PROTOCOL)),
+                                 ('.json', 'w', lambda f: json.dump({'name': name, 'key': key, 'hash': content_hash, 'files': files}, f))]:
+            path = self._path(name, key, ext)
+            with open(path + '.tmp', mode) as f:
+                write(f)
+            os.replace(path + '.tmp', path)
+
+        # Outputs of the same node for other inputs are stale
+        stale = re.compile(r'^{}\.(?!{}\.)[0-9a-f]{{40}}\.(pkl|json)$'.format(re.escape(name), key))
+        for filename in os.listdir(self.cache_dir):
+            if stale.match(filename):
+                os.remove(os.path.join(self.cache_dir, filename))
+
+
+def _output_files(output):
+    return [output] if isinstance(output, str) else list(output)
+
+
+def _read_meta(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+# Nodes
+def file_stamps(paths):
+    """ mtime and size of files, to key nodes reading them. """
+    return {os.path.basename(path): [os.stat(path).st_mtime_ns, os.stat(path).st_size] for path in paths}
+
+
+def clean_files(raw_stamps, raw_points, raw_users, clean_points, clean_users, strict=True):
+    """ Clean the raw points and users as clean.py and write them to the clean files.
+
+        raw_stamps : dict
+            file_stamps of the raw files, only keying the node on their content
+
+        Returns : dict
+            file_stamps of the clean files
+    """
+    import clean
+
+    points = pd.read_csv(raw_points, sep='|', index_col='id')
+    users = pd.read_csv(raw_users, sep='|', index_col='id')
+    points = clean.clean_points(points)
+    users = clean.clean_users(users, points['user_id'].unique(), strict)
+    points.to_csv(clean_points, sep='|')
+    users.to_csv(clean_users, sep='|')
+    return file_stamps([clean_points, clean_users])
+
+
+def load(*upstream, data_dir=loader.DATA_DIR, stamps=None):
+    """ loader.load_data, keyed on the stamps of its sources or on the clean node upstream. """
+    return loader.load_data(data_dir)
+
+
+def split(dataset):
+    """ Points of the truth, of the expert and of the players, and the levels and rects. """
+    points, users, levels, rects, truth_id, expert_id = dataset
+    return {
+        'truth': points[points.user_id == truth_id].reset_index(drop=True),
+        'expert': points[points.user_id == expert_id].reset_index(drop=True),
+        'players': points[~points.user_id.isin([truth_id, expert_id])].reset_index(drop=True),
+        'levels': levels,
+        'rects': rects,
+    }
+
+
+def data_part(data, part):
+    return data[part]
+
+
+def level_points(data, level_id):
+    points = data['players']
+    return points[points['level'].values == level_id]
+
+
+def distances(data):
+    """ Distances of the players of every level to the truth, and of the expert, as analysis.py. """
+    dists, dists_expert = functions.get_dist_levels(data['truth'], data['expert'], data['players'])
+    dists_levels = dists.groupby(data['players'].level.values)
+    return {'points': {level_id: dists_levels.get_group(level_id) for level_id in LEVEL_IDS}, 'expert': dists_expert.to_dict()}
+
+
+def filter_level(dists, points, shapes=None, level_id=None, method='iqr', num_iqr=analysis.NUM_IQR):
+    """ Distances of one level filtered as analysis.py, by 'polygon', 'rect', 'iqr' or 'none'.
+
+        shapes : list of dict or dict of level_id -> rect
+            The levels for 'polygon', the rects for 'rect', unused otherwise
+    """
+    dist_points = dists['points'][level_id]
+    if method == 'polygon':
+        in_polygon = functions.get_polygon_mask(points, functions.get_polygon_index(shapes))
+        return dist_points[points.index[in_polygon]]
+    elif method == 'rect':
+        return dist_points[functions.get_points_level(points, shapes, level_id).index]
+    elif method == 'iqr':
+        return functions.filter_iqr(dist_points, num_iqr)
+    return dist_points
+
+
+def test_level(dist_points, dists, level_id, alpha=analysis.ALPHA, direction=analysis.DIRECTION):
+    test_stat, pvalue = analysis.calc_test_stat_and_pvalue(dist_points, dists['expert'][level_id], alternative=direction)
+    return {'Test statistic': test_stat, 'P-value': pvalue,
+            'Significant?': analysis.test_signif(test_stat, pvalue, alpha=alpha, alternative=direction)}
+
+
+def report(*rows, level_ids=LEVEL_IDS):
+    """ Results table of analysis.py from the test_level rows of every level. """
+    results = pd.DataFrame(list(rows), index=pd.Index(level_ids, name='Level'))[['Test statistic', 'P-value', 'Significant?']]
+    results['Test statistic'] = results['Test statistic'].round(3)
+    return results
+
+
+def plot(*inputs, kind, level_id, save_to):
+    """ Render one plot of a level, as analysis.py (hist), lln.py (lln) or plot.py (scatter, heatmap).
+
+        Returns : str
+            Path of the plot
+    """
+    if kind == 'hist':
+        import seaborn as sns
+        sns.set_style('white')
+        dist_points, dists = inputs
+        job = render.Job(analysis.plot_level, (dist_points, dists['expert'][level_id], level_id), {}, save_to)
+    elif kind == 'lln':
+        import lln
+        import seaborn as sns
+        sns.set_style('white')
+        dist_points, = inputs
+        job = render.Job(lln.plot_cum_dist, (dist_points.reset_index(drop=True), level_id), {}, save_to)
+    elif kind == 'scatter':
+        points, rects = inputs
+        job = render.Job(functions.plot_scatter, (points, rects, level_id), {'grid_area': None}, save_to)
+    else:
+        points, rects = inputs
+        job = render.Job(functions.plot_heatmap, (points, rects, level_id),
+                         {'grid_area': HEATMAP_GRID_AREAS.get(level_id, 192)}, save_to)
+    render.render(job)
+    return save_to
+
+
+def get_nodes(data_dir=loader.DATA_DIR, alpha=analysis.ALPHA, direction=analysis.DIRECTION, filter_rect=False, filter_polygon=False,
+              num_iqr=analysis.NUM_IQR, save_to=None, plot_kinds=PLOT_KINDS, clean=False, strict=True, level_ids=LEVEL_IDS):
+    """ The analysis of Pinisi data as a DAG: clean -> load -> split -> distances -> filter -> test -> report,
+        with the plots of every level hanging off the split points and the filtered distances.
+
+        Each node only gets the parameters it depends on, so that e.g. a new alpha recomputes the tests and
+        the report but reuses the distances and the filtered distances.
+
+        Returns : list of Node
+    """
+    nodes = []
+    if clean:
+        raw = [os.path.join(data_dir, 'raw/points.psv'), os.path.join(data_dir, 'raw/users.psv')]
+        nodes.append(Node('clean', clean_files, (), {'raw_stamps': file_stamps(raw), 'raw_points': raw[0], 'raw_users': raw[1],
+                                                     'clean_points': os.path.join(data_dir, 'clean/points.psv'),
+                                                     'clean_users': os.path.join(data_dir, 'clean/users.psv'), 'strict': strict}))
+        nodes.append(Node('load', load, ('clean',), {'data_dir': data_dir,
+                                                     'stamps': file_stamps([os.path.join(data_dir, source) for source in loader.SOURCES[2:]])}, cache=False))
+    else:
+        nodes.append(Node('load', load, (), {'data_dir': data_dir,
+                                             'stamps': file_stamps([os.path.join(data_dir, source) for source in loader.SOURCES])}, cache=False))
+    nodes.append(Node('split', split, ('load',), cache=False))
+    nodes.append(Node('distances', distances, ('split',)))
+
+    # Filters and plots only depend on the shapes they use, so that process jobs do not carry all points
+    if filter_polygon:
+        filter_params, filter_shapes = {'method': 'polygon'}, ('levels',)
+    elif filter_rect:
+        filter_params, filter_shapes = {'method': 'rect'}, ('rects',)
+    else:
+        filter_params, filter_shapes = {'method': 'iqr', 'num_iqr': num_iqr} if num_iqr else {'method': 'none'}, ()
+
+    for level_id in level_ids:
+        nodes.append(Node('points.{}'.format(level_id), level_points, ('split',), {'level_id': level_id}, cache=False))
+        nodes.append(Node('filter.{}'.format(level_id), filter_level, ('distances', 'points.{}'.format(level_id)) + filter_shapes,
+                          dict(filter_params, level_id=level_id)))
+        nodes.append(Node('test.{}'.format(level_id), test_level, ('filter.{}'.format(level_id), 'distances'),
+                          {'level_id': level_id, 'alpha': alpha, 'direction': direction}))
+    nodes.append(Node('report', report, tuple('test.{}'.format(level_id) for level_id in level_ids), {'level_ids': list(level_ids)}))
+
+    if save_to:
+        plot_deps = {
+            'hist': lambda level_id: ('filter.{}'.format(level_id), 'distances'),
+            'lln': lambda level_id: ('filter.{}'.format(level_id),),
+            'scatter': lambda level_id: ('points.{}'.format(level_id), 'rects'),
+            'heatmap': lambda level_id: ('points.{}'.format(level_id), 'rects'),
+        }
+        for kind in plot_kinds:
+            for level_id in level_ids:
+                nodes.append(Node('{}.{}'.format(kind, level_id), plot, plot_deps[kind](level_id),
+                                  {'kind': kind, 'level_id': level_id, 'save_to': os.path.join(save_to, kind, 'level{}.png'.format(level_id))},
+                                  process=True, files=True))
+
+    # Shapes only as nodes when used, since unused nodes would be targets
+    used = set(dep for node in nodes for dep in node.deps)
+    nodes.extend(Node(part, data_part, ('split',), {'part': part}, cache=False) for part in ['levels', 'rects'] if part in used)
+    return nodes
+
+
+def parse_and_assert_args():
+    arg_parser = argparse.ArgumentParser(prog='pinisi', description="Run the Pinisi analysis and plots as a cached pipeline", usage="")
+
+    arg_parser.add_argument('-a', dest='alpha', help='Significance level of the z-test (default: {})'.format(analysis.ALPHA))
+    arg_parser.add_argument('-d', dest='direction', help="Direction of alternative hypothesis of the z-test. One of {} (default '{}')".format(analysis.VALID_DIRECTIONS, analysis.DIRECTION))
+    arg_parser.add_argument('-r', dest='filter_rect', action='store_true', help='Filter data points only inside rectangle. Takes precedence over num_iqr (default: False)')
+    arg_parser.add_argument('-g', dest='filter_polygon', action='store_true', help='Filter data points only inside level polygon. Takes precedence over filter_rect and num_iqr (default: False)')
+    arg_parser.add_argument('-i', dest='num_iqr', help='Filter data points outside num_iqr * IQR. Set to 0 to prevent filtering (default: {})'.format(analysis.NUM_IQR))
+    arg_parser.add_argument('-s', dest='save_to', help='Directory for saving plots, one subdirectory per plot kind (default: None)')
+    arg_parser.add_argument('-p', dest='plot_kinds', help='Comma-separated plot kinds, of {} (default: all)'.format(PLOT_KINDS))
+    arg_parser.add_argument('-c', dest='clean', action='store_true', help='Clean the raw data first, rewriting the clean files when the raw ones change (default: False)')
+    arg_parser.add_argument('-w', dest='max_workers', help='Number of threads and processes (default: os.cpu_count())')
+    arg_parser.add_argument('-f', dest='force', action='store_true', help='Recompute every stage even if it is cached (default: False)')
+
+    args = arg_parser.parse_args()
+    if args.alpha is not None:
+        assert (float(args.alpha) >= 0.0) and (float(args.alpha) <= 1.0), "alpha must be between 0 and 1"
+    if args.direction is not None:
+        assert args.direction in analysis.VALID_DIRECTIONS, "direction must be one of {}".format(analysis.VALID_DIRECTIONS)
+    if args.num_iqr is not None:
+        assert float(args.num_iqr) >= 0.0, "num_iqr must be >= 0"
+    if args.plot_kinds is not None:
+        assert all(kind in PLOT_KINDS for kind in args.plot_kinds.split(',')), "plot_kinds must be of {}".format(PLOT_KINDS)
+    if args.max_workers is not None:
+        assert int(args.max_workers) >= 1, "max_workers must be >= 1"
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_and_assert_args()
+    nodes = get_nodes(
+        alpha=float(args.alpha) if args.alpha else analysis.ALPHA,
+        direction=args.direction or analysis.DIRECTION,
+        filter_rect=args.filter_rect,
+        filter_polygon=args.filter_polygon,
+        num_iqr=float(args.num_iqr) if args.num_iqr else analysis.NUM_IQR,
+        save_to=args.save_to,
+        plot_kinds=args.plot_kinds.split(',') if args.plot_kinds else PLOT_KINDS,
+        clean=args.clean,
+    )
+
+    start = time.time()
+    outputs, counts = run(nodes, max_workers=int(args.max_workers) if args.max_workers else None, force=args.force)
+    elapsed = time.time() - start
+
+    print("Results")
+    print("-------")
+    print(outputs['report'])
+    print()
+    print("Ran {} of {} stages in {:.2f}s, {} cached".format(counts['run'], sum(counts.values()), elapsed, counts['cached']))
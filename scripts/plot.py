@@ -1,21 +1,48 @@
-import json
-
-import pandas as pd
+import argparse
+import os
 
 import functions
+import loader
+import profiling
+import render
+
+
+SAVE_TO = os.path.join(loader.ROOT_DIR, 'plots')
+
+
+def parse_and_assert_args():
+    arg_parser = argparse.ArgumentParser(prog='pinisi', description="Plot scatter and heatmap of Pinisi data points", usage="")
+
+    arg_parser.add_argument('--profile', dest='profile', help="Write a JSON report of stage timings and memory to this file, or folded stacks if it ends with '.folded' (default: None)")
+
+    return arg_parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_and_assert_args()
+    if args.profile:
+        profiling.enable()
 
+    with profiling.stage('load') as stage:
+        points, users, levels, rects, TRUTH_ID, EXPERT_ID = loader.load_data()
 
-TRUTH_ID = int(open('../data/truth_ID').read())
-EXPERT_ID = int(open('../data/expert_ID').read())
+        points = points[~points.user_id.isin([TRUTH_ID, EXPERT_ID])].reset_index(drop=True)
+        stage.set_rows(len(points))
 
-points = pd.read_csv('../data/clean/points.psv', sep='|', index_col='id')
-users = pd.read_csv('../data/clean/users.psv', sep='|', index_col='id')
-levels = json.load(open('../data/levels.json', 'r'))['maps']
-rects = {level['level']: functions.get_rect(level['polygon']) for level in levels}
+    # Each job is pickled to a worker and hashed, so it only gets the points of its level
+    points_levels = {level_id: points[points['level'].values == level_id] for level_id in sorted(rects)}
+    plot_jobs = []
+    for level_id, points_level in points_levels.items():
+        plot_jobs.append(render.Job(functions.plot_scatter, (points_level, rects, level_id), {'grid_area': None},
+                                    os.path.join(SAVE_TO, 'scatter', 'level{}.png'.format(level_id))))
+    for level_id, points_level in points_levels.items():
+        plot_jobs.append(render.Job(functions.plot_heatmap, (points_level, rects, level_id), {'grid_area': 192 if level_id != 6 else 384},
+                                    os.path.join(SAVE_TO, 'heatmap', 'level{}.png'.format(level_id))))
 
-points = points[~points.user_id.isin([TRUTH_ID, EXPERT_ID])].reset_index(drop=True)
+    with profiling.stage('plot', rows=len(plot_jobs)) as stage:
+        rendered = render.render_all(plot_jobs)
+        stage.set_rows(len(rendered))
+    print("Rendered {} of {} plots".format(len(rendered), len(plot_jobs)))
 
-for level_id in LEVEL_IDS:
-    functions.plot_scatter(points, rects, level_id, grid_area=None)
-for level_id in LEVEL_IDS:
-    functions.plot_heatmap(points, rects, level_id, grid_area=192 if level_id != 6 else 384)
+    if args.profile:
+        profiling.report(args.profile)
@@ -0,0 +1,147 @@
+import functools
+import json
+import os
+import resource
+import time
+
+
+# Constants
+ENABLED = False
+
+_records = []
+_stack = []
+
+
+# Functions
+def enable():
+    """ Start recording stages. Until this is called, stage() and profiled() cost one function call. """
+    global ENABLED
+    ENABLED = True
+
+
+def stage(name, rows=None):
+    """ Context manager recording wall time, CPU time, row count and memory of a pipeline stage.
+
+        CPU time includes the child processes reaped during the stage, e.g. a process pool shut down in
+        it. Memory is the RSS at the start and end of the stage and its growth. The process peak RSS is
+        only known for the whole process, so it is reported as new_peak_rss_bytes only when the stage
+        raised it, and None otherwise.
+
+        Stages can be nested; the row count can also be set inside the block with set_rows.
+
+            with profiling.stage('load') as s:
+                points = ...
+                s.set_rows(len(points))
+    """
+    if not ENABLED:
+        return _NULL_STAGE
+    return _Stage(name, rows)
+
+
+def profiled(name=None):
+    """ Decorator recording every call of a function as a stage, named after the function by default. """
+    def decorator(func):
+        stage_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            with _Stage(stage_name, None):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_records():
+    return list(_records)
+
+
+def report(save_to):
+    """ Write recorded stages to save_to: a JSON report, or folded stacks for flame graph tools when
+        save_to ends with '.folded' (one 'outer;inner microseconds' line per stage, self time only).
+    """
+    if save_to.endswith('.folded'):
+        lines = ['%s %d' % (';'.join(record['stack']), round(record['self_seconds'] * 1e6)) for record in _records]
+        with open(save_to, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+    else:
+        with open(save_to, 'w') as f:
+            json.dump({'pid': os.getpid(), 'stages': _records}, f, indent=1)
+
+
+def _rss_bytes():
+    # Current resident set size, only available on Linux
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def _max_rss_bytes():
+    # Peak RSS over the lifetime of the process
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if os.uname().sysname == 'Darwin' else max_rss * 1024
+
+
+def _children_cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class _Stage(object):
+    __slots__ = ['name', 'rows', 'start', 'start_cpu', 'start_children_cpu', 'start_rss', 'start_max_rss', 'child_seconds']
+
+    def __init__(self, name, rows):
+        self.name = name
+        self.rows = rows
+        self.child_seconds = 0.0
+
+    def set_rows(self, rows):
+        self.rows = rows
+
+    def __enter__(self):
+        _stack.append(self)
+        self.start_rss, self.start_max_rss = _rss_bytes(), _max_rss_bytes()
+        self.start_children_cpu = _children_cpu_seconds()
+        self.start, self.start_cpu = time.perf_counter(), time.process_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds, cpu_seconds = time.perf_counter() - self.start, time.process_time() - self.start_cpu
+        children_cpu_seconds = _children_cpu_seconds() - self.start_children_cpu
+        rss, max_rss = _rss_bytes(), _max_rss_bytes()
+        _stack.pop()
+        if _stack:
+            _stack[-1].child_seconds += seconds
+        _records.append({
+            'name': self.name,
+            'stack': [s.name for s in _stack] + [self.name],
+            'rows': self.rows,
+            'seconds': seconds,
+            'self_seconds': seconds - self.child_seconds,
+            'cpu_seconds': cpu_seconds + children_cpu_seconds,
+            'children_cpu_seconds': children_cpu_seconds,
+            'start_rss_bytes': self.start_rss,
+            'end_rss_bytes': rss,
+            'rss_growth_bytes': None if (rss is None) or (self.start_rss is None) else rss - self.start_rss,
+            'new_peak_rss_bytes': max_rss if max_rss > self.start_max_rss else None,
+        })
+        return False
+
+
+class _NullStage(object):
+    __slots__ = []
+
+    def set_rows(self, rows):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_STAGE = _NullStage()
@@ -0,0 +1,237 @@
+import collections
+import concurrent.futures
+import dis
+import hashlib
+import importlib
+import inspect
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+# Constants
+RENDER_VERSION = 1
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+MANIFEST = '.render-cache.json'
+
+Job = collections.namedtuple('Job', ['func', 'args', 'kwargs', 'save_to'])
+
+
+# Functions
+def render_all(jobs, max_workers=None, force=False):
+    """ Render plots to PNG files, each on its own figure with the Agg backend, in a process pool.
+
+        A plot is skipped when its file exists and the hash of its function, input arrays and parameters
+        is unchanged since the last render. The function hash covers the helpers of this repo that it
+        calls, see func_digest. Hashes are kept in a MANIFEST file next to the plots.
+
+        jobs        : list of Job
+            func(*args, ax=ax, **kwargs) draws on ax, and the figure is saved to save_to
+        max_workers : int (default: None)
+            Size of the process pool, None for os.cpu_count(). Set to 1 to render in this process
+        force       : bool (default: False)
+            Render every plot even if it is unchanged
+
+        Returns : list of str
+            Paths of the plots that were rendered
+    """
+    manifests = {}
+    memo = {}
+    pending = []
+    for job in jobs:
+        save_dir, name = os.path.split(os.path.abspath(job.save_to))
+        if save_dir not in manifests:
+            manifests[save_dir] = _read_manifest(save_dir)
+        key = render_key(job.func, job.args, job.kwargs, memo)
+        if force or (manifests[save_dir].get(name) != key) or not os.path.exists(job.save_to):
+            pending.append((job, save_dir, name, key))
+
+    max_workers = max_workers or os.cpu_count() or 1
+    if (max_workers == 1) or (len(pending) <= 1):
+        for job, save_dir, name, key in pending:
+            _render_job(*job)
+            manifests[save_dir][name] = key
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(max_workers, len(pending))) as executor:
+            futures = {executor.submit(_render_job, *job): (save_dir, name, key) for job, save_dir, name, key in pending}
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+                save_dir, name, key = futures[future]
+                manifests[save_dir][name] = key
+
+    for save_dir in set(save_dir for job, save_dir, name, key in pending):
+        _write_manifest(save_dir, manifests[save_dir])
+    return [job.save_to for job, save_dir, name, key in pending]
+
+
+def render_key(func, args, kwargs, memo=None):
+    """ Hash of a plot function and the repo helpers it calls, its inputs and its parameters.
+
+        memo : dict (default: None)
+            Digests of arrays already hashed, keyed by id, to hash inputs shared by several plots once
+    """
+    memo = {} if memo is None else memo
+    h = hashlib.sha1()
+    h.update(repr((RENDER_VERSION, func.__module__, func.__qualname__)).encode())
+    h.update(func_digest(func, memo))
+    _update_hash(h, args, memo)
+    _update_hash(h, sorted(kwargs.items()), memo)
+    return h.hexdigest()
+
+
+def hash_value(value, memo=None):
+    """ Hash of nested lists, tuples, dicts, arrays, DataFrames, Series and scalars, as used by render_key.
+
+        Returns : str
+    """
+    h = hashlib.sha1()
+    _update_hash(h, value, {} if memo is None else memo)
+    return h.hexdigest()
+
+
+def render(job):
+    """ Render one Job in this process, without reading or writing the manifest. """
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib.figure import Figure
+
+    fig = Figure()
+    job.func(*job.args, ax=fig.add_subplot(), **job.kwargs)
+    save_dir = os.path.dirname(job.save_to)
+    if save_dir and not os.path.isdir(save_dir):
+        os.makedirs(save_dir, exist_ok=True)
+    fig.savefig(job.save_to)
+
+
+def func_digest(func, memo=None):
+    """ Hash of the source of func and of the functions and classes of this repo that it references.
+
+        References are followed through the global names and module attributes used in the code of
+        func, recursively, and kept when they are defined in a module of the scripts directory. Editing a
+        helper that a plot function calls, such as functions.get_bins, therefore changes the digest, while
+        library code does not. The bytecode and constants are used when the source is not available, and
+        the fields of classes built at runtime such as namedtuples.
+
+        memo : dict (default: None)
+            Digests already computed, keyed by function
+
+        Returns : bytes
+    """
+    memo = {} if memo is None else memo
+    if ('func', func) not in memo:
+        h = hashlib.sha1()
+        for obj in sorted(_repo_references(func), key=lambda obj: (_module_name(obj), obj.__qualname__)):
+            h.update(repr((_module_name(obj), obj.__qualname__)).encode())
+            try:
+                h.update(inspect.getsource(obj).encode())
+            except (OSError, TypeError):
+                if inspect.isfunction(obj):
+                    h.update(obj.__code__.co_code + repr(obj.__code__.co_consts).encode())
+                else:
+                    h.update(repr(getattr(obj, '_fields', None)).encode())    # e.g. namedtuples
+        memo[('func', func)] = h.digest()
+    return memo[('func', func)]
+
+
+def _repo_references(func):
+    found, stack = set(), [func]
+    while stack:
+        obj = stack.pop()
+        if obj in found:
+            continue
+        found.add(obj)
+        if not inspect.isfunction(obj):
+            continue
+
+        # Global names, and attributes of the repo modules among them or imported inside the function,
+        # e.g. functions.get_bins
+        scope = obj.__globals__
+        names, imports = _code_names(obj.__code__)
+        modules = [scope.get(name) for name in names] + [_import_repo(name) for name in imports]
+        modules = [module for module in modules if inspect.ismodule(module) and _is_repo(module)]
+        for name in names:
+            for ref in [scope.get(name)] + [getattr(module, name, None) for module in modules]:
+                if (inspect.isfunction(ref) or inspect.isclass(ref)) and _is_repo(ref):
+                    stack.append(ref)
+    return found
+
+
+def _code_names(code):
+    # Names used and modules imported by code and by the lambdas, comprehensions and functions nested in it
+    names = set(code.co_names)
+    imports = set(instruction.argval for instruction in dis.get_instructions(code) if instruction.opname == 'IMPORT_NAME')
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            nested_names, nested_imports = _code_names(const)
+            names |= nested_names
+            imports |= nested_imports
+    return names, imports
+
+
+def _import_repo(name):
+    if os.path.exists(os.path.join(SCRIPTS_DIR, name + '.py')):
+        return importlib.import_module(name)
+    return None
+
+
+def _module_name(obj):
+    # Name of the module of obj, also when it is run as a script
+    if obj.__module__ == '__main__':
+        return os.path.splitext(os.path.basename(inspect.getfile(obj)))[0]
+    return obj.__module__
+
+
+def _is_repo(obj):
+    try:
+        path = obj.__file__ if inspect.ismodule(obj) else inspect.getfile(obj)
+    except (AttributeError, TypeError):
+        return False
+    return os.path.dirname(os.path.abspath(path)) == SCRIPTS_DIR
+
+
+def _update_hash(h, value, memo):
+    if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray)):
+        if id(value) not in memo:
+            memo[id(value)] = (value, _hash_array(value))    # keep value alive so its id is not reused
+        h.update(memo[id(value)][1])
+    elif isinstance(value, dict):
+        _update_hash(h, sorted(value.items(), key=lambda item: repr(item[0])), memo)
+    elif isinstance(value, (list, tuple)):
+        h.update(('%s%d' % (type(value).__name__, len(value))).encode())
+        for v in value:
+            _update_hash(h, v, memo)
+    else:
+        h.update(repr(value).encode())
+
+
+def _hash_array(value):
+    h = hashlib.sha1()
+    if isinstance(value, np.ndarray):
+        h.update(repr((value.dtype.str, value.shape)).encode())
+        h.update(np.ascontiguousarray(value).tobytes())
+    else:
+        labels = list(value.columns) if isinstance(value, pd.DataFrame) else [value.name]
+        h.update(repr((type(value).__name__, value.shape, labels)).encode())
+        h.update(pd.util.hash_pandas_object(value, index=True).values.tobytes())
+    return h.digest()
+
+
+def _render_job(func, args, kwargs, save_to):
+    render(Job(func, args, kwargs, save_to))
+
+
+def _read_manifest(save_dir):
+    try:
+        with open(os.path.join(save_dir, MANIFEST), 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _write_manifest(save_dir, manifest):
+    path = os.path.join(save_dir, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
@@ -0,0 +1,374 @@
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import io
+import json
+import multiprocessing
+import os
+import time
+import urllib.parse
+
+import numpy as np
+
+import analysis
+import functions
+import loader
+import pipeline
+import render
+
+
+# Constants
+HOST = '127.0.0.1'
+PORT = 8000
+CACHE_SIZE = 256    # responses
+METRICS_WINDOW = 1000    # latest requests per route kept for latency percentiles
+VALID_FILTERS = ['none', 'iqr', 'rect', 'polygon']
+HEATMAP_GRID_AREA = 192
+MAX_REQUEST_LINE = 8192
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+Response = collections.namedtuple('Response', ['status', 'content_type', 'body'])
+DataState = collections.namedtuple('DataState', ['version', 'data', 'dists', 'points'])
+
+
+# Functions
+def parse_stats_params(query):
+    """ Normalised test parameters of a query, as analysis.py: alpha, direction, filter and num_iqr.
+
+        num_iqr only counts for the 'iqr' filter, which is the default, so that equivalent queries share
+        a cache entry.
+
+        Returns : tuple of (str, object)
+    """
+    alpha = float(query.get('alpha', analysis.ALPHA))
+    assert (alpha >= 0.0) and (alpha <= 1.0), "alpha must be between 0 and 1"
+    direction = query.get('direction', analysis.DIRECTION)
+    assert direction in analysis.VALID_DIRECTIONS, "direction must be one of {}".format(analysis.VALID_DIRECTIONS)
+    return (('alpha', alpha), ('direction', direction)) + parse_filter_params(query)
+
+
+def parse_filter_params(query):
+    method = query.get('filter', 'iqr')
+    assert method in VALID_FILTERS, "filter must be one of {}".format(VALID_FILTERS)
+    if method != 'iqr':
+        return (('filter', method),)
+    num_iqr = float(query.get('num_iqr', analysis.NUM_IQR))
+    assert num_iqr >= 0.0, "num_iqr must be >= 0"
+    return (('filter', 'iqr'), ('num_iqr', num_iqr)) if num_iqr else (('filter', 'none'),)
+
+
+def parse_grid_params(query, grid_area):
+    grid_area = int(query.get('grid_area', grid_area))
+    assert grid_area > 0, "grid_area must be > 0"
+    return (('grid_area', grid_area),)
+
+
+def data_version(data_dir=loader.DATA_DIR):
+    """ Short hash of the mtime and size of the loader sources. """
+    return render.hash_value(pipeline.file_stamps([os.path.join(data_dir, source) for source in loader.SOURCES]))[:12]
+
+
+def render_png(func, args, kwargs):
+    """ Draw func(*args, ax=ax, **kwargs) on its own Agg figure and return it as PNG bytes. """
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib.figure import Figure
+
+    fig = Figure()
+    func(*args, ax=fig.add_subplot(), **kwargs)
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png')
+    return buf.getvalue()
+
+
+class LRUCache(object):
+    """ Least recently used mapping of at most max_size entries. """
+
+    def __init__(self, max_size=CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def discard(self, key):
+        self.entries.pop(key, None)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class Metrics(object):
+    """ Request count, cache hits and latency percentiles of the latest METRICS_WINDOW requests, per route. """
+
+    def __init__(self, window=METRICS_WINDOW):
+        self.window = window
+        self.counts = collections.Counter()
+        self.hits = collections.Counter()
+        self.errors = collections.Counter()
+        self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=self.window))
+
+    def record(self, route, seconds, status, hit):
+        self.counts[route] += 1
+        self.hits[route] += bool(hit)
+        self.errors[route] += status >= 400
+        self.latencies[route].append(seconds)
+
+    def summary(self):
+        summary = {}
+        for route, latencies in sorted(self.latencies.items()):
+            ms = np.asarray(latencies) * 1e3
+            p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+            summary[route] = {'count': self.counts[route], 'cache_hits': self.hits[route], 'errors': self.errors[route],
+                              'mean_ms': float(ms.mean()), 'p50_ms': float(p50), 'p95_ms': float(p95), 'p99_ms': float(p99), 'max_ms': float(ms.max())}
+        return summary
+
+
+class Service(object):
+    """ Per-level statistics, grid counts, running means and heatmaps of the data loaded once.
+
+        Responses are cached by route, level, parameters and data version: when a source file changes, the
+        data is reloaded and older entries are never hit again. Concurrent identical requests share one
+        computation. NumPy work runs in the default thread pool and plots in a process pool.
+
+        data_dir    : str (default: loader.DATA_DIR)
+        cache_size  : int (default: CACHE_SIZE)
+        max_workers : int (default: None)
+            Size of the rendering process pool, None for os.cpu_count()
+    """
+
+    def __init__(self, data_dir=loader.DATA_DIR, cache_size=CACHE_SIZE, max_workers=None):
+        self.data_dir = data_dir
+        self.cache = LRUCache(cache_size)
+        self.metrics = Metrics()
+        self.processes = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('forkserver'))
+        self.routes = {'stats': self.get_stats, 'bins': self.get_bins, 'cumulative': self.get_cumulative, 'heatmap.png': self.get_heatmap}
+        self.reload_lock = asyncio.Lock()
+        self.load()
+
+    def load(self):
+        """ Load the data and publish it in one assignment, so that a request never mixes two versions. """
+        version = data_version(self.data_dir)
+        data = pipeline.split(loader.load_data(self.data_dir))
+        points = {level_id: pipeline.level_points(data, level_id) for level_id in data['rects']}
+        self.state = DataState(version, data, pipeline.distances(data), points)
+
+    async def refresh(self):
+        """ Reload the data if a source file has changed since it was loaded. """
+        if data_version(self.data_dir) != self.state.version:
+            async with self.reload_lock:
+                if data_version(self.data_dir) != self.state.version:
+                    await asyncio.get_running_loop().run_in_executor(None, self.load)
+
+    def close(self):
+        self.processes.shutdown()
+
+    async def handle(self, method, target):
+        """ Response to a request, and whether it came from the cache.
+
+            Routes are GET /levels/{level_id}/{stats,bins,cumulative,heatmap.png}?params and GET /metrics.
+
+            Returns : Response, bool
+        """
+        url = urllib.parse.urlsplit(target)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        parts = [part for part in url.path.split('/') if part]
+        if method != 'GET':
+            return _json_response(405, {'error': 'only GET is supported'}), False
+        if parts == ['metrics']:
+            return _json_response(200, {'version': self.state.version, 'cache_entries': len(self.cache), 'routes': self.metrics.summary()}), False
+        if (len(parts) != 3) or (parts[0] != 'levels') or (parts[2] not in self.routes):
+            return _json_response(404, {'error': 'no route {}'.format(url.path)}), False
+
+        await self.refresh()
+        state = self.state    # read once, computations and the cache key all use this version
+        try:
+            level_id = int(parts[1])
+            assert level_id in state.points, "no level {}".format(parts[1])
+        except (AssertionError, ValueError) as e:
+            return _json_response(404, {'error': str(e)}), False
+        try:
+            compute, params = self.routes[parts[2]](state, level_id, query)
+        except (AssertionError, ValueError) as e:
+            return _json_response(400, {'error': str(e)}), False
+
+        key = (state.version, parts[2], level_id, params)
+        future = self.cache.get(key)
+        hit = future is not None
+        if not hit:
+            future = asyncio.ensure_future(compute())
+            self.cache.put(key, future)
+        try:
+            return await asyncio.shield(future), hit
+        except Exception:
+            self.cache.discard(key)
+            raise
+
+    def get_stats(self, state, level_id, query):
+        params = parse_stats_params(query)
+
+        async def compute():
+            dist_points, test = await self._run(_test, state, level_id, params)
+            return _json_response(200, {'level': level_id, 'version': state.version, 'params': dict(params), 'n': len(dist_points),
+                                        'test_stat': float(test['Test statistic']), 'pvalue': float(test['P-value']),
+                                        'significant': bool(test['Significant?'])})
+        return compute, params
+
+    def get_bins(self, state, level_id, query):
+        params = parse_grid_params(query, functions.GRID_AREA)
+
+        async def compute():
+            bins = await self._run(functions.get_bins, state.points[level_id], state.data['rects'], level_id, dict(params)['grid_area'])
+            return _json_response(200, {'level': level_id, 'version': state.version, 'params': dict(params),
+                                        'lat': bins.index.tolist(), 'lng': bins.columns.tolist(), 'counts': bins.values.tolist()})
+        return compute, params
+
+    def get_cumulative(self, state, level_id, query):
+        params = parse_filter_params(query)
+
+        async def compute():
+            cum_dist = await self._run(_cumulative, state, level_id, params)
+            return _json_response(200, {'level': level_id, 'version': state.version, 'params': dict(params),
+                                        'mean': cum_dist.values.tolist()})
+        return compute, params
+
+    def get_heatmap(self, state, level_id, query):
+        params = parse_grid_params(query, pipeline.HEATMAP_GRID_AREAS.get(level_id, HEATMAP_GRID_AREA))
+
+        async def compute():
+            png = await asyncio.get_running_loop().run_in_executor(
+                self.processes, render_png, functions.plot_heatmap, (state.points[level_id], state.data['rects'], level_id), dict(params))
+            return Response(200, 'image/png', png)
+        return compute, params
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+def _filter(state, level_id, params):
+    params = dict(params)
+    shapes = {'polygon': state.data['levels'], 'rect': state.data['rects']}.get(params['filter'])
+    return pipeline.filter_level(state.dists, state.points[level_id], shapes, level_id, method=params['filter'], num_iqr=params.get('num_iqr', 0.0))
+
+
+def _cumulative(state, level_id, params):
+    return functions.calc_cum_dist(_filter(state, level_id, params).reset_index(drop=True))
+
+
+def _test(state, level_id, params):
+    dist_points = _filter(state, level_id, params)
+    return dist_points, pipeline.test_level(dist_points, state.dists, level_id, alpha=dict(params)['alpha'], direction=dict(params)['direction'])
+
+
+async def serve_connection(service, reader, writer):
+    """ Serve HTTP/1.1 requests of one connection, keeping it alive unless the client asks to close it. """
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            if len(request_line) > MAX_REQUEST_LINE:
+                await _write_response(writer, _json_response(400, {'error': 'request line too long'}), False, False)
+                break
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            start = time.perf_counter()
+            try:
+                method, target, version = request_line.decode('latin-1').split()
+            except ValueError:
+                await _write_response(writer, _json_response(400, {'error': 'malformed request line'}), False, False)
+                break
+            try:
+                response, hit = await service.handle(method, target)
+            except Exception as e:
+                response, hit = _json_response(500, {'error': repr(e)}), False
+
+            keep_alive = (version == 'HTTP/1.1') and (headers.get('connection', '').lower() != 'close')
+            await _write_response(writer, response, hit, keep_alive)
+            service.metrics.record(_route_name(target, response.status), time.perf_counter() - start, response.status, hit)
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+def _route_name(target, status):
+    parts = [part for part in urllib.parse.urlsplit(target).path.split('/') if part]
+    if status == 404:
+        return 'not_found'
+    return parts[-1] if parts else '/'
+
+
+def _json_response(status, value):
+    return Response(status, 'application/json', json.dumps(value).encode())
+
+
+async def _write_response(writer, response, hit, keep_alive):
+    head = ['HTTP/1.1 {} {}'.format(response.status, STATUS_TEXT.get(response.status, '')),
+            'Content-Type: {}'.format(response.content_type),
+            'Content-Length: {}'.format(len(response.body)),
+            'X-Cache: {}'.format('hit' if hit else 'miss'),
+            'Connection: {}'.format('keep-alive' if keep_alive else 'close')]
+    writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + response.body)
+    await writer.drain()
+
+
+async def main(host=HOST, port=PORT, cache_size=CACHE_SIZE, max_workers=None):
+    service = Service(cache_size=cache_size, max_workers=max_workers)
+    server = await asyncio.start_server(lambda reader, writer: serve_connection(service, reader, writer), host, port)
+    print("Serving Pinisi data version {} on http://{}:{}".format(service.state.version, host, port))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+
+def parse_and_assert_args():
+    arg_parser = argparse.ArgumentParser(prog='pinisi', description="Serve per-level Pinisi statistics and heatmaps over HTTP", usage="")
+
+    arg_parser.add_argument('-H', dest='host', help='Host to listen on (default: {})'.format(HOST))
+    arg_parser.add_argument('-p', dest='port', help='Port to listen on (default: {})'.format(PORT))
+    arg_parser.add_argument('-c', dest='cache_size', help='Number of responses kept in the LRU cache (default: {})'.format(CACHE_SIZE))
+    arg_parser.add_argument('-w', dest='max_workers', help='Number of processes rendering heatmaps (default: os.cpu_count())')
+
+    args = arg_parser.parse_args()
+    if args.port is not None:
+        assert 0 <= int(args.port) < 65536, "port must be between 0 and 65535"
+    if args.cache_size is not None:
+        assert int(args.cache_size) >= 1, "cache_size must be >= 1"
+    if args.max_workers is not None:
+        assert int(args.max_workers) >= 1, "max_workers must be >= 1"
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_and_assert_args()
+    try:
+        asyncio.run(main(
+            host=args.host or HOST,
+            port=int(args.port) if args.port else PORT,
+            cache_size=int(args.cache_size) if args.cache_size else CACHE_SIZE,
+            max_workers=int(args.max_workers) if args.max_workers else None,
+        ))
+    except KeyboardInterrupt:
+        pass
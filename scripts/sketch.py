@@ -0,0 +1,94 @@
+import math
+
+import numpy as np
+
+
+# Constants
+EPS = 0.01
+C = 2.0 / 3.0    # capacity decay of lower compactors
+
+
+class QuantileSketch(object):
+    """ Mergeable approximate quantile sketch (KLL).
+
+        Items are kept in compactors; compactor h holds items of weight 2**h. When a compactor is over
+        capacity it is sorted and every other item, starting at a random offset, is promoted to the
+        next one. The rank error is roughly eps * n with high probability, using O(1/eps) memory.
+
+        eps  : float (default: EPS)
+            Target rank error as a fraction of the number of items
+        seed : int (default: None)
+    """
+    def __init__(self, eps=EPS, seed=None):
+        self.eps = eps
+        self.k = max(8, int(math.ceil(4.0 / eps)))
+        self.n = 0
+        self.compactors = [np.empty(0)]
+        self._rng = np.random.default_rng(seed)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        self.n += len(values)
+        self.compactors[0] = np.concatenate([self.compactors[0], values])
+        self._compress()
+        return self
+
+    def merge(self, other):
+        """ Fold other into this sketch. Both sketches should use the same eps. """
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append(np.empty(0))
+        for h, items in enumerate(other.compactors):
+            self.compactors[h] = np.concatenate([self.compactors[h], items])
+        self.n += other.n
+        self._compress()
+        return self
+
+    def quantile(self, q):
+        """ Approximate q-quantile(s), q in [0, 1]. Returns NaN for an empty sketch. """
+        items, weights = self._weighted_items()
+        if not len(items):
+            return np.full(np.shape(q), np.nan) if np.ndim(q) else np.nan
+        order = np.argsort(items, kind='mergesort')
+        items, cum_weights = items[order], np.cumsum(weights[order])
+        ranks = np.asarray(q, dtype=np.float64) * cum_weights[-1]
+        idx = np.clip(np.searchsorted(cum_weights, ranks, side='left'), 0, len(items) - 1)
+        return items[idx]
+
+    def snapshot(self):
+        """ JSON-serializable state of the sketch. """
+        return {'eps': self.eps, 'n': self.n, 'compactors': [items.tolist() for items in self.compactors]}
+
+    @classmethod
+    def restore(cls, snapshot, seed=None):
+        sketch = cls(eps=snapshot['eps'], seed=seed)
+        sketch.n = snapshot['n']
+        sketch.compactors = [np.asarray(items, dtype=np.float64) for items in snapshot['compactors']]
+        return sketch
+
+    def __len__(self):
+        return self.n
+
+    def _capacity(self, h):
+        depth = len(self.compactors) - 1 - h
+        return max(2, int(math.ceil(self.k * C**depth)))
+
+    def _compress(self):
+        h = 0
+        while h < len(self.compactors):
+            items = self.compactors[h]
+            if len(items) > self._capacity(h):
+                if h + 1 == len(self.compactors):
+                    self.compactors.append(np.empty(0))
+                items = np.sort(items)
+                # Keep one item behind when the count is odd, so weights stay exact
+                keep, items = items[:len(items) % 2], items[len(items) % 2:]
+                promoted = items[self._rng.integers(2)::2]
+                self.compactors[h] = keep
+                self.compactors[h + 1] = np.concatenate([self.compactors[h + 1], promoted])
+            h += 1
+
+    def _weighted_items(self):
+        items = np.concatenate(self.compactors)
+        weights = np.concatenate([np.full(len(c), 2.0**h) for h, c in enumerate(self.compactors)])
+        return items, weights
@@ -0,0 +1,174 @@
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+import loader
+
+
+# Constants
+STORE_PATH = os.path.join(loader.DATA_DIR, 'pinisi.db')
+LEVEL_IDS = list(range(1, 7))
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'    # microseconds, as loader.load_data timestamps
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS points (
+    id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    level INTEGER NOT NULL,
+    lat REAL NOT NULL,
+    lng REAL NOT NULL,
+    timestamp TEXT NOT NULL,
+    complete INTEGER NOT NULL DEFAULT 0
+);
+CREATE UNIQUE INDEX IF NOT EXISTS points_user_level ON points (user_id, level);
+CREATE INDEX IF NOT EXISTS points_level ON points (level);
+CREATE INDEX IF NOT EXISTS points_timestamp ON points (timestamp);
+
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    browser TEXT,
+    timestamp TEXT,
+    OS TEXT,
+    OS_generic TEXT,
+    is_mobile INTEGER
+);
+"""
+
+UPSERT_POINTS = """
+INSERT INTO points (id, user_id, level, lat, lng, timestamp) VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (user_id, level) DO UPDATE SET
+    id = excluded.id, lat = excluded.lat, lng = excluded.lng, timestamp = excluded.timestamp
+WHERE excluded.timestamp >= points.timestamp
+"""
+
+UPSERT_USERS = """
+INSERT INTO users (id, browser, timestamp, OS, OS_generic, is_mobile) VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (id) DO UPDATE SET
+    browser = excluded.browser, timestamp = excluded.timestamp,
+    OS = excluded.OS, OS_generic = excluded.OS_generic, is_mobile = excluded.is_mobile
+"""
+
+POINTS_COLUMNS = 'id, user_id, level, lat, lng, timestamp'
+POINTS_RECORD = np.dtype([('id', np.int32), ('user_id', np.int32), ('level', np.int8),
+                          ('lat', np.float64), ('lng', np.float64), ('timestamp', 'U26')])
+FETCH_SIZE = 100000
+
+
+# Functions
+def connect(path=STORE_PATH):
+    """ Open the SQLite store at path, creating its tables and indexes if needed. """
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def upsert_points(conn, points, level_ids=LEVEL_IDS):
+    """ Insert raw or cleaned points, keeping the last point of each (user_id, level) as clean.clean_points.
+
+        A point replaces the stored one of its (user_id, level) only if it is not older, so raw exports can
+        be appended in any order without cleaning the whole raw file again. Points of users who have played
+        all level_ids are flagged complete, which is what load_level reads.
+
+        points    : pd.DataFrame with (user_id, level, lat, lng, timestamp) columns, indexed by id
+        level_ids : list of int (default: LEVEL_IDS)
+
+        Returns : int
+            Number of points written
+    """
+    points = points.sort_values(by=['user_id', 'level', 'timestamp'], kind='mergesort')
+    points = points[~points.duplicated(['user_id', 'level'], keep='last')]
+    rows = zip(points.index.values.tolist(), points['user_id'].values.tolist(), points['level'].values.tolist(),
+               points['lat'].values.tolist(), points['lng'].values.tolist(), _format_timestamps(points['timestamp']))
+
+    with conn:
+        conn.executemany(UPSERT_POINTS, rows)
+
+        # Only users of these points can have become complete
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS upserted_users (user_id INTEGER PRIMARY KEY)')
+        conn.execute('DELETE FROM upserted_users')
+        conn.executemany('INSERT INTO upserted_users VALUES (?)', ((user_id,) for user_id in points['user_id'].unique().tolist()))
+        conn.execute("""
+            UPDATE points SET complete = (SELECT COUNT(*) FROM points AS p WHERE p.user_id = points.user_id) = ?
+            WHERE user_id IN (SELECT user_id FROM upserted_users)
+        """, (len(level_ids),))
+    return len(points)
+
+
+def upsert_users(conn, users):
+    """ Insert or replace users, as cleaned by clean.clean_users.
+
+        users : pd.DataFrame with (browser, timestamp, OS, OS_generic, is_mobile) columns, indexed by id
+
+        Returns : int
+            Number of users written
+    """
+    rows = zip(users.index.values.tolist(), users['browser'].astype(object).tolist(), _format_timestamps(users['timestamp']),
+               users['OS'].astype(object).tolist(), users['OS_generic'].astype(object).tolist(), users['is_mobile'].astype(int).tolist())
+    with conn:
+        conn.executemany(UPSERT_USERS, rows)
+    return len(users)
+
+
+def load_level(conn, level_id):
+    """ Points of one level played by complete users, read through the level index.
+
+        Returns : pd.DataFrame
+            Same columns and dtypes as loader.load_data points, sorted by user_id
+    """
+    return fetch_points(conn, 'level = ? AND complete = 1', (level_id,))
+
+
+def load_user_points(conn, user_ids):
+    """ Points of the given users, read through the (user_id, level) index, e.g. the truth and expert. """
+    user_ids = [int(user_id) for user_id in user_ids]
+    return fetch_points(conn, 'user_id IN (%s)' % ', '.join('?' * len(user_ids)), user_ids)
+
+
+def load_truth_expert(conn, truth_id, expert_id):
+    """ Points of the truth and of the expert.
+
+        Returns : pd.DataFrame, pd.DataFrame
+    """
+    points = load_user_points(conn, [truth_id, expert_id])
+    return (points[points['user_id'].values == truth_id].reset_index(drop=True),
+            points[points['user_id'].values == expert_id].reset_index(drop=True))
+
+
+def load_users(conn):
+    """ All users, with the columns of clean/users.psv. """
+    users = pd.read_sql_query('SELECT id, browser, timestamp, OS, OS_generic, is_mobile FROM users ORDER BY id', conn, index_col='id')
+    users['timestamp'] = pd.to_datetime(users['timestamp']).astype('datetime64[us]')
+    users['is_mobile'] = users['is_mobile'].astype(bool)
+    return users
+
+
+def fetch_points(conn, where, params=()):
+    """ Points matching an SQL condition, fetched in bulk into NumPy arrays.
+
+        Rows are fetched FETCH_SIZE at a time and converted to a record array per batch, instead of one
+        Python object per value.
+
+        Returns : pd.DataFrame indexed by id
+    """
+    cursor = conn.execute('SELECT %s FROM points WHERE %s ORDER BY user_id, level' % (POINTS_COLUMNS, where), params)
+    batches = []
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        batches.append(np.array(rows, dtype=POINTS_RECORD))
+    records = np.concatenate(batches) if batches else np.empty(0, dtype=POINTS_RECORD)
+
+    points = pd.DataFrame({name: records[name] for name in POINTS_RECORD.names if name not in ('id', 'timestamp')},
+                          index=pd.Index(records['id'], name='id'))
+    points['timestamp'] = records['timestamp'].astype('datetime64[us]')
+    return points
+
+
+def _format_timestamps(timestamps):
+    # One fixed-width format for raw strings and parsed timestamps, so that stored timestamps compare as text
+    return pd.to_datetime(timestamps).dt.strftime(TIMESTAMP_FORMAT).tolist()
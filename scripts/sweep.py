@@ -0,0 +1,184 @@
+import argparse
+import math
+import time
+
+import numpy as np
+import pandas as pd
+
+import analysis
+import functions
+import loader
+
+
+# Constants
+LEVEL_IDS = analysis.LEVEL_IDS
+COLUMNS = ['Filter', 'Num IQR', 'Direction', 'Alpha', 'Level', 'N', 'Test statistic', 'P-value', 'Significant?']
+
+
+# Functions
+def calc_iqr_moments(X, num_iqrs):
+    """ Size, mean and standard deviation of X filtered by functions.filter_iqr with each multiplier.
+
+        X is sorted once: every filtered sample is then a contiguous slice of the sorted values, whose
+        sums are read off cumulative sums. A multiplier of 0 means no filtering, as in analysis.py.
+
+        X        : array-like
+        num_iqrs : list of float
+
+        Returns : np.array, np.array, np.array
+            Size, mean and standard deviation (ddof=1) for each multiplier
+    """
+    x = np.sort(np.asarray(X, dtype=np.float64))
+    q1, median, q3 = functions.calc_quantiles(x, [0.25, 0.5, 0.75])
+    iqr = q3 - q1
+    num_iqrs = np.asarray(num_iqrs, dtype=np.float64)
+    lo = np.where(num_iqrs > 0, np.searchsorted(x, median - iqr*num_iqrs, side='left'), 0)
+    hi = np.where(num_iqrs > 0, np.searchsorted(x, median + iqr*num_iqrs, side='right'), len(x))
+
+    # Sums of values centred on the median, to keep the variance precise
+    centred = x - median
+    sums = np.concatenate([[0.0], np.cumsum(centred)])
+    sq_sums = np.concatenate([[0.0], np.cumsum(centred*centred)])
+    n = hi - lo
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = (sums[hi] - sums[lo]) / n
+        var = (sq_sums[hi] - sq_sums[lo] - n*mean*mean) / (n - 1)
+    return n, mean + median, np.sqrt(np.maximum(var, 0.0))
+
+
+def calc_test_stats_and_pvalues(n, mean, std, ref, alternative='unequal'):
+    """ Vectorised analysis.calc_test_stat_and_pvalue_moments over arrays of sizes, means and standard deviations.
+
+        Returns : np.array, np.array
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        test_stat = (mean - ref) / (std/np.sqrt(n))
+    if alternative == 'unequal':
+        pvalue = np.exp(-0.5*test_stat*test_stat) / math.sqrt(2*math.pi)
+    elif alternative == 'greater':
+        pvalue = 1.0 - analysis.norm_cdf(test_stat)
+    elif alternative == 'less':
+        pvalue = analysis.norm_cdf(test_stat)
+    else:
+        raise AssertionError("Alternative must be one of 'unequal', 'greater', or 'less'")
+    return test_stat, pvalue
+
+
+def sweep(dists_points, dists_expert, num_iqrs, alphas, directions, dists_filtered=None):
+    """ Test statistics, p-values and significance for every combination of filter, direction and alpha.
+
+        dists_points   : dict of level_id -> pd.Series
+            Unfiltered distances of the players of each level
+        dists_expert   : dict of level_id -> float
+        num_iqrs       : list of float
+            IQR multipliers to filter with, 0 for no filtering
+        alphas         : list of float
+        directions     : list of str
+        dists_filtered : dict of str -> dict of level_id -> pd.Series (default: None)
+            Distances already filtered otherwise, e.g. {'rect': ..., 'polygon': ...}
+
+        Returns : pd.DataFrame
+            One row per filter, direction, alpha and level, with COLUMNS
+    """
+    dists_filtered = dists_filtered or {}
+    level_ids = list(dists_points)
+
+    # Size, mean and standard deviation of every (filter, level), as arrays of shape (n_filters, n_levels)
+    moments = np.array([calc_iqr_moments(dists_points[level_id], num_iqrs) for level_id in level_ids]).transpose(1, 2, 0)
+    filters = [('iqr' if num_iqr else 'none', num_iqr) for num_iqr in num_iqrs]
+    if dists_filtered:
+        moments_filtered = np.array([[(len(dists[level_id]), dists[level_id].mean(), dists[level_id].std()) for level_id in level_ids]
+                                     for dists in dists_filtered.values()]).transpose(2, 0, 1)
+        moments = np.concatenate([moments, moments_filtered], axis=1)
+        filters += [(name, np.nan) for name in dists_filtered]
+    n, mean, std = moments
+    ref = np.array([dists_expert[level_id] for level_id in level_ids])
+
+    # Significance of every (alpha, filter, level) at once for each direction
+    alphas = np.asarray(alphas, dtype=np.float64)
+    tables = []
+    for direction in directions:
+        test_stat, pvalue = calc_test_stats_and_pvalues(n, mean, std, ref, alternative=direction)
+        is_signif = analysis.test_signif(test_stat, pvalue, alpha=alphas[:, None, None], alternative=direction)
+
+        shape = is_signif.shape
+        alpha_idx, filter_idx, level_idx = np.indices(shape).reshape(3, -1)
+        tables.append(pd.DataFrame({
+            'Filter': [filters[i][0] for i in filter_idx],
+            'Num IQR': [filters[i][1] for i in filter_idx],
+            'Direction': direction,
+            'Alpha': alphas[alpha_idx],
+            'Level': np.asarray(level_ids)[level_idx],
+            'N': n[filter_idx, level_idx].astype(np.int64),
+            'Test statistic': test_stat[filter_idx, level_idx],
+            'P-value': pvalue[filter_idx, level_idx],
+            'Significant?': is_signif.ravel(),
+        }, columns=COLUMNS))
+    return pd.concat(tables, ignore_index=True)
+
+
+def save_sweep(results, save_to):
+    """ Write the sweep table to save_to, as JSON records if it ends with '.json', else as CSV. """
+    if save_to.endswith('.json'):
+        results.to_json(save_to, orient='records', indent=1)
+    else:
+        results.to_csv(save_to, index=False)
+
+
+def parse_list(value, cast):
+    return [cast(v) for v in value.split(',')]
+
+
+def parse_and_assert_args():
+    arg_parser = argparse.ArgumentParser(prog='pinisi', description="Sweep Pinisi statistical analysis over several parameters in one run", usage="")
+
+    arg_parser.add_argument('-a', dest='alphas', help='Comma-separated significance levels (default: {})'.format(analysis.ALPHA))
+    arg_parser.add_argument('-d', dest='directions', help="Comma-separated directions of alternative hypothesis, of 'unequal', 'greater', or 'less' (default: '{}')".format(analysis.DIRECTION))
+    arg_parser.add_argument('-i', dest='num_iqrs', help='Comma-separated IQR multipliers to filter with, 0 for no filtering (default: {})'.format(analysis.NUM_IQR))
+    arg_parser.add_argument('-r', dest='filter_rect', action='store_true', help='Also evaluate the rectangle filter (default: False)')
+    arg_parser.add_argument('-g', dest='filter_polygon', action='store_true', help='Also evaluate the level polygon filter (default: False)')
+    arg_parser.add_argument('-o', dest='save_to', help="Write the table to this file, as JSON if it ends with '.json', else as CSV (default: None)")
+
+    args = arg_parser.parse_args()
+    args.alphas = parse_list(args.alphas, float) if args.alphas else [analysis.ALPHA]
+    args.directions = parse_list(args.directions, str) if args.directions else [analysis.DIRECTION]
+    args.num_iqrs = parse_list(args.num_iqrs, float) if args.num_iqrs else [analysis.NUM_IQR]
+    assert all((alpha >= 0.0) and (alpha <= 1.0) for alpha in args.alphas), "alphas must be between 0 and 1"
+    assert all(direction in analysis.VALID_DIRECTIONS for direction in args.directions), "directions must be of {}".format(analysis.VALID_DIRECTIONS)
+    assert all(num_iqr >= 0.0 for num_iqr in args.num_iqrs), "num_iqrs must be >= 0"
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_and_assert_args()
+
+    start = time.time()
+    points, users, levels, rects, TRUTH_ID, EXPERT_ID = loader.load_data()
+
+    points_truth = points[points.user_id == TRUTH_ID].reset_index(drop=True)
+    points_expert = points[points.user_id == EXPERT_ID].reset_index(drop=True)
+    points = points[~points.user_id.isin([TRUTH_ID, EXPERT_ID])].reset_index(drop=True)
+
+    dists, dists_expert = functions.get_dist_levels(points_truth, points_expert, points)
+    dists_levels = dists.groupby(points.level.values)
+    dists_points = {level_id: dists_levels.get_group(level_id) for level_id in LEVEL_IDS}
+    dists_expert = dists_expert.to_dict()
+
+    dists_filtered = {}
+    if args.filter_rect:
+        dists_filtered['rect'] = {level_id: dist_points[functions.get_points_level(points, rects, level_id).index]
+                                  for level_id, dist_points in dists_points.items()}
+    if args.filter_polygon:
+        in_polygon = functions.get_polygon_mask(points, functions.get_polygon_index(levels))
+        dists_filtered['polygon'] = {level_id: dist_points[points.index[in_polygon & (points.level == level_id).values]]
+                                     for level_id, dist_points in dists_points.items()}
+
+    results = sweep(dists_points, dists_expert, args.num_iqrs, args.alphas, args.directions, dists_filtered)
+    elapsed = time.time() - start
+
+    if args.save_to:
+        save_sweep(results, args.save_to)
+        print("Evaluated {} configurations over {} levels in {:.2f}s".format(len(results) // len(LEVEL_IDS), len(LEVEL_IDS), elapsed))
+    else:
+        with pd.option_context('display.max_rows', None, 'display.width', None):
+            print(results)
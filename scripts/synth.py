@@ -0,0 +1,142 @@
+import argparse
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+import functions
+import loader
+
+
+# Constants
+DATA_DIR = loader.DATA_DIR
+SEED = 0
+
+COMPLETE_RATE = 0.8     # share of players that play all levels
+REPLAY_RATE = 0.15      # share of plays that are played again
+OUTLIER_RATE = 0.03     # share of guesses far from the level
+SPREAD = 0.25           # typical guess error as a fraction of the level rectangle
+PLAY_SECONDS = 20       # mean seconds between two plays
+
+START_TIME = pd.Timestamp('2015-09-02 00:00:00')
+DURATION = pd.Timedelta(days=30)
+TRUTH_ID, EXPERT_ID = 1, 2
+
+
+# Functions
+def generate(num_users, levels, agents, seed=SEED):
+    """ Generate realistic raw points and users tables.
+
+        Players guess around the truth point of each level with heavy-tailed noise scaled to the level
+        rectangle, plus a few outliers. Some players do not complete all levels, some replay levels.
+        User 1 is the truth (exact level coordinates) and user 2 the expert.
+
+        num_users : int
+        levels    : list of dict, as in levels.json
+        agents    : list of str
+            Agent strings sampled uniformly for the users
+        seed      : int (default: SEED)
+
+        Returns : pd.DataFrame, pd.DataFrame
+            Points and users, with the columns of data/raw/*.psv
+    """
+    rng = np.random.default_rng(seed)
+    level_ids = np.array([level['level'] for level in levels])
+    rects = {level['level']: functions.get_rect(level['polygon']) for level in levels}
+    n_levels = len(level_ids)
+
+    # Levels played by each user: a random order, cut short for incomplete players
+    is_complete = rng.random(num_users) < COMPLETE_RATE
+    is_complete[:2] = True
+    num_plays = np.where(is_complete, n_levels, rng.integers(1, n_levels, num_users))
+    orders = np.argsort(rng.random((num_users, n_levels)), axis=1)
+    played = np.arange(n_levels) < num_plays[:, None]
+    user_idx = np.repeat(np.arange(num_users), n_levels)[played.ravel()]
+    level_idx = orders.ravel()[played.ravel()]
+
+    # Replays of some plays
+    replays = rng.random(len(user_idx)) < REPLAY_RATE
+    replays[user_idx < 2] = False
+    user_idx = np.concatenate([user_idx, user_idx[replays]])
+    level_idx = np.concatenate([level_idx, level_idx[replays]])
+    order = np.argsort(user_idx, kind='stable')
+    user_idx, level_idx = user_idx[order], level_idx[order]
+
+    # Guesses around the truth point of the level
+    truth = np.array([[level['lat'], level['lng']] for level in levels])
+    sizes = np.array([functions.get_rect_width_height(rects[level_id])[::-1] for level_id in level_ids])
+    noise = rng.standard_t(3, size=(len(user_idx), 2)) * SPREAD * sizes[level_idx]
+    outliers = rng.random(len(user_idx)) < OUTLIER_RATE
+    noise[outliers] *= 10
+    coords = truth[level_idx] + noise
+    coords[user_idx == 0] = truth[level_idx[user_idx == 0]]
+    coords[user_idx == 1] = truth[level_idx[user_idx == 1]] + 0.05 * sizes[level_idx[user_idx == 1]]
+
+    # Timestamps: users start uniformly over DURATION, plays follow each other
+    user_start = START_TIME + pd.to_timedelta(rng.random(num_users) * DURATION.total_seconds(), unit='s').round('s')
+    gaps = pd.to_timedelta(rng.exponential(PLAY_SECONDS, len(user_idx)).round() + 1, unit='s')
+    play_time = pd.Series(gaps).groupby(user_idx).cumsum().values
+    timestamps = user_start.values[user_idx] + play_time
+
+    user_ids = np.arange(1, num_users + 1)
+    points = pd.DataFrame({
+        'id': np.arange(1, len(user_idx) + 1),
+        'user_id': user_ids[user_idx],
+        'level': level_ids[level_idx],
+        'lat': coords[:, 0],
+        'lng': coords[:, 1],
+        'timestamp': pd.Series(timestamps).dt.strftime('%Y-%m-%d %H:%M:%S').values,
+    })
+    users = pd.DataFrame({
+        'id': user_ids,
+        'browser': np.asarray(agents, dtype=object)[rng.integers(0, len(agents), num_users)],
+        'timestamp': pd.Series(user_start).dt.strftime('%Y-%m-%d %H:%M:%S').values,
+    })
+    return points, users
+
+
+def write_data_dir(points, users, levels, save_to):
+    """ Write points and users as save_to/raw/*.psv, with levels.json, truth_ID and expert_ID, in the layout of data/. """
+    raw_dir = os.path.join(save_to, 'raw')
+    for d in [raw_dir, os.path.join(save_to, 'clean')]:
+        if not os.path.isdir(d):
+            os.makedirs(d)
+    points.to_csv(os.path.join(raw_dir, 'points.psv'), sep='|', index=False)
+    users.to_csv(os.path.join(raw_dir, 'users.psv'), sep='|', index=False)
+    with open(os.path.join(save_to, 'levels.json'), 'w') as f:
+        json.dump({'maps': levels}, f, indent=4)
+    with open(os.path.join(save_to, 'truth_ID'), 'w') as f:
+        f.write(str(TRUTH_ID))
+    with open(os.path.join(save_to, 'expert_ID'), 'w') as f:
+        f.write(str(EXPERT_ID))
+
+
+def load_levels_and_agents(data_dir=DATA_DIR):
+    """ Levels from levels.json and the distinct agent strings of the raw users. """
+    levels = json.load(open(os.path.join(data_dir, 'levels.json'), 'r'))['maps']
+    agents = pd.read_csv(os.path.join(data_dir, 'raw/users.psv'), sep='|')['browser'].unique().tolist()
+    return levels, agents
+
+
+def parse_and_assert_args():
+    arg_parser = argparse.ArgumentParser(prog='pinisi', description="Generate synthetic raw Pinisi data", usage="")
+
+    arg_parser.add_argument('-n', dest='num_users', required=True, help='Number of users')
+    arg_parser.add_argument('-s', dest='save_to', required=True, help='Data directory to write raw/points.psv, raw/users.psv, levels.json, truth_ID and expert_ID to')
+    arg_parser.add_argument('--seed', dest='seed', help='Random seed (default: {})'.format(SEED))
+
+    args = arg_parser.parse_args()
+    assert int(args.num_users) >= 2, "num_users must be >= 2"
+    assert os.path.abspath(args.save_to) != os.path.abspath(DATA_DIR), "save_to must not be the real data directory"
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_and_assert_args()
+    levels, agents = load_levels_and_agents()
+    points, users = generate(int(args.num_users), levels, agents, seed=int(args.seed) if args.seed else SEED)
+    write_data_dir(points, users, levels, args.save_to)
+    shutil.copytree(os.path.join(DATA_DIR, 'images'), os.path.join(args.save_to, 'images'), dirs_exist_ok=True)
+    print("Wrote {} points of {} users to {}".format(len(points), len(users), args.save_to))
@@ -0,0 +1,222 @@
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+import functions
+import loader
+
+
+# Constants
+SAVE_TO = os.path.join(loader.ROOT_DIR, 'tiles')
+TILE_SIZE = 256
+NUM_ZOOMS = 4    # zoom levels of the pyramid, the finest being the zoom of the level in levels.json
+TILES_VERSION = 1
+MANIFEST = 'tiles.json'
+COUNTS = 'counts.npy'
+
+
+# Functions
+def export_tiles(points, levels, save_to=SAVE_TO, num_zooms=NUM_ZOOMS, append=False, max_workers=None,
+                 cmap=functions.RASTER_CMAP, color_scale='log'):
+    """ Export the points of every level as a pyramid of count arrays and PNG tiles for a web map.
+
+        Points are counted once per pixel of the Web Mercator (XYZ) tiles at the zoom of the level in
+        levels.json, over the rect of its polygon. Each coarser zoom sums 2x2 blocks of the finer one.
+        Tiles are written as save_to/level{N}/{zoom}/{x}/{y}.npy (uint32 counts) and .png, skipping empty
+        ones. A tile is only rewritten when its counts or colour scale differ from the last export.
+
+        points      : pd.DataFrame with (level, lat, lng) columns
+        levels      : list of dict, as in levels.json
+        save_to     : str (default: SAVE_TO)
+        num_zooms   : int (default: NUM_ZOOMS)
+        append      : bool (default: False)
+            Add points to the counts of the last export instead of replacing them, keeping its colour
+            scale, so that only tiles touched by the new points are written
+        max_workers : int (default: None)
+            Size of the process pool writing tiles, None for os.cpu_count(). Set to 1 to write in this process
+
+        Returns : list of str
+            Paths of the PNG tiles written
+    """
+    jobs = []
+    manifests = {}
+    for level in levels:
+        level_dir = os.path.join(save_to, 'level{}'.format(level['level']))
+        manifest = _read_manifest(level_dir)
+        origin, shape, max_zoom = get_level_grid(level, num_zooms)
+        counts = get_tile_counts(points[points['level'].values == level['level']], origin, shape, max_zoom)
+        if append and (manifest.get('origin') == list(origin)) and os.path.exists(os.path.join(level_dir, COUNTS)):
+            counts += np.load(os.path.join(level_dir, COUNTS))
+        _save_counts(level_dir, counts)
+
+        tiles = manifest.get('tiles', {}) if manifest.get('version') == TILES_VERSION else {}
+        vmaxes = manifest.get('vmax', {}) if append else {}
+        new_manifest = {'version': TILES_VERSION, 'level': level['level'], 'origin': list(origin), 'zooms': [],
+                        'bounds': get_rect_bounds_dict(level), 'vmax': {}, 'tiles': {}}
+        for zoom, zoom_counts in zip(range(max_zoom, max_zoom - num_zooms, -1), get_pyramid(counts, num_zooms)):
+            vmax = vmaxes.get(str(zoom), int(zoom_counts.max()))
+            new_manifest['zooms'].append(zoom)
+            new_manifest['vmax'][str(zoom)] = vmax
+            tile_x0, tile_y0 = (origin[0] >> (max_zoom - zoom)) // TILE_SIZE, (origin[1] >> (max_zoom - zoom)) // TILE_SIZE
+            for (i, j), tile in _split_tiles(zoom_counts):
+                if not tile.any():
+                    continue
+                name = '{}/{}/{}'.format(zoom, tile_x0 + j, tile_y0 + i)
+                key = _tile_key(tile, vmax, cmap, color_scale)
+                new_manifest['tiles'][name] = key
+                if (tiles.get(name) != key) or not os.path.exists(os.path.join(level_dir, name + '.png')):
+                    jobs.append((os.path.join(level_dir, name), tile, vmax, cmap, color_scale))
+        manifests[level_dir] = new_manifest
+
+        # Tiles that have become empty
+        for name in set(tiles) - set(new_manifest['tiles']):
+            for ext in ['.npy', '.png']:
+                if os.path.exists(os.path.join(level_dir, name + ext)):
+                    os.remove(os.path.join(level_dir, name + ext))
+
+    max_workers = max_workers or os.cpu_count() or 1
+    if (max_workers == 1) or (len(jobs) <= 1):
+        for job in jobs:
+            _write_tile(*job)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for future in concurrent.futures.as_completed([executor.submit(_write_tile, *job) for job in jobs]):
+                future.result()
+
+    for level_dir, manifest in manifests.items():
+        _write_manifest(level_dir, manifest)
+    return [path + '.png' for path, tile, vmax, cmap, color_scale in jobs]
+
+
+def lat_lng_to_pixel(lat, lng, zoom):
+    """ Global Web Mercator pixel coordinates (x, y) of lat, lng at zoom, y growing southwards. """
+    scale = TILE_SIZE * 2**zoom
+    lat = np.radians(np.clip(lat, -85.05112878, 85.05112878))
+    x = (np.asarray(lng, dtype=np.float64) + 180.0) / 360.0 * scale
+    y = (1.0 - np.log(np.tan(lat) + 1.0/np.cos(lat)) / math.pi) / 2.0 * scale
+    return x, y
+
+
+def get_level_grid(level, num_zooms=NUM_ZOOMS):
+    """ Pixel grid of a level at its finest zoom, covering the rect of its polygon.
+
+        The grid is aligned on whole tiles of the coarsest zoom, so every zoom is made of whole tiles.
+
+        Returns : (int, int), (int, int), int
+            Global pixel (x, y) of the top-left corner, (rows, cols) and the finest zoom
+    """
+    max_zoom = level['zoom']
+    top_lat, top_lng, bot_lat, bot_lng = functions.get_rect_bounds(functions.get_rect(level['polygon']))
+    (x0, x1), (y0, y1) = [np.asarray(c) for c in lat_lng_to_pixel(np.array([top_lat, bot_lat]), np.array([top_lng, bot_lng]), max_zoom)]
+    block = TILE_SIZE * 2**(num_zooms - 1)
+    x_start, y_start = int(x0 // block) * block, int(y0 // block) * block
+    x_end, y_end = int(math.ceil(x1 / block)) * block, int(math.ceil(y1 / block)) * block
+    return (x_start, y_start), (y_end - y_start, x_end - x_start), max_zoom
+
+
+def get_rect_bounds_dict(level):
+    top_lat, top_lng, bot_lat, bot_lng = functions.get_rect_bounds(functions.get_rect(level['polygon']))
+    return {'top_lat': top_lat, 'top_lng': top_lng, 'bot_lat': bot_lat, 'bot_lng': bot_lng,
+            'lat': level['lat'], 'lng': level['lng'], 'zoom': level['zoom']}
+
+
+def get_tile_counts(points, origin, shape, zoom):
+    """ Count points per pixel of the grid from get_level_grid, ignoring points outside of it.
+
+        Returns : np.array of uint32 with given shape
+    """
+    x, y = lat_lng_to_pixel(points['lat'].values, points['lng'].values, zoom)
+    cols, rows = np.floor(x).astype(np.int64) - origin[0], np.floor(y).astype(np.int64) - origin[1]
+    inside = (rows >= 0) & (rows < shape[0]) & (cols >= 0) & (cols < shape[1])
+    flat = rows[inside]*shape[1] + cols[inside]
+    return np.bincount(flat, minlength=shape[0]*shape[1]).astype(np.uint32).reshape(shape)
+
+
+def get_pyramid(counts, num_zooms=NUM_ZOOMS):
+    """ counts and its num_zooms - 1 coarser versions, each summing 2x2 blocks of the previous one. """
+    pyramid = [counts]
+    for _ in range(num_zooms - 1):
+        rows, cols = pyramid[-1].shape
+        pyramid.append(pyramid[-1].reshape(rows // 2, 2, cols // 2, 2).sum(axis=(1, 3), dtype=np.uint32))
+    return pyramid
+
+
+def _split_tiles(counts):
+    rows, cols = counts.shape
+    for i in range(rows // TILE_SIZE):
+        for j in range(cols // TILE_SIZE):
+            yield (i, j), counts[i*TILE_SIZE:(i + 1)*TILE_SIZE, j*TILE_SIZE:(j + 1)*TILE_SIZE]
+
+
+def _tile_key(tile, vmax, cmap, color_scale):
+    h = hashlib.sha1(np.ascontiguousarray(tile).tobytes())
+    h.update(repr((TILES_VERSION, vmax, cmap, color_scale)).encode())
+    return h.hexdigest()
+
+
+def _write_tile(path, tile, vmax, cmap, color_scale):
+    from PIL import Image
+
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    np.save(path + '.npy', tile)
+    Image.fromarray(functions.colorize_counts(tile, cmap, color_scale, vmax=vmax)).save(path + '.png', optimize=False)
+
+
+def _save_counts(level_dir, counts):
+    if not os.path.isdir(level_dir):
+        os.makedirs(level_dir)
+    np.save(os.path.join(level_dir, COUNTS + '.tmp.npy'), counts)
+    os.replace(os.path.join(level_dir, COUNTS + '.tmp.npy'), os.path.join(level_dir, COUNTS))
+
+
+def _read_manifest(level_dir):
+    try:
+        with open(os.path.join(level_dir, MANIFEST), 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _write_manifest(level_dir, manifest):
+    path = os.path.join(level_dir, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def parse_and_assert_args():
+    arg_parser = argparse.ArgumentParser(prog='pinisi', description="Export Pinisi heatmaps as map tiles", usage="")
+
+    arg_parser.add_argument('-s', dest='save_to', help='Directory for saving tiles (default: {})'.format(SAVE_TO))
+    arg_parser.add_argument('-z', dest='num_zooms', help='Number of zoom levels of the pyramid (default: {})'.format(NUM_ZOOMS))
+    arg_parser.add_argument('-a', dest='append', help='Add the points of this points file (.psv) to the last export and rewrite only the tiles they touch (default: None)')
+    arg_parser.add_argument('-w', dest='max_workers', help='Number of processes writing tiles (default: os.cpu_count())')
+
+    args = arg_parser.parse_args()
+    if args.num_zooms is not None:
+        assert int(args.num_zooms) >= 1, "num_zooms must be >= 1"
+    if args.max_workers is not None:
+        assert int(args.max_workers) >= 1, "max_workers must be >= 1"
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_and_assert_args()
+    save_to = args.save_to or SAVE_TO
+    num_zooms = int(args.num_zooms) if args.num_zooms else NUM_ZOOMS
+    max_workers = int(args.max_workers) if args.max_workers else None
+
+    points, users, levels, rects, TRUTH_ID, EXPERT_ID = loader.load_data()
+    if args.append:
+        points = pd.read_csv(args.append, sep='|', index_col='id')
+    points = points[~points.user_id.isin([TRUTH_ID, EXPERT_ID])]
+
+    written = export_tiles(points, levels, save_to, num_zooms, append=bool(args.append), max_workers=max_workers)
+    print("Wrote {} tiles to {}".format(len(written), save_to))
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import functions
+import loader
+
+
+GRID_AREAS = [96, 192, 384]
+
+
+def reference_bins(points, rects, level_id, grid_area):
+    # get_bins before it was vectorised: pd.cut on both axes, then counts per (lat, lng) cell
+    plevel = functions.get_points_level(points, rects, level_id)
+    grid_horiz, grid_vertic = functions.get_grids(rects, level_id, grid_area, functions.FIG_AREA)
+    bins_lat = pd.cut(plevel.lat, sorted(grid_horiz), include_lowest=True)
+    bins_lng = pd.cut(plevel.lng, sorted(grid_vertic), include_lowest=True)
+    counts = plevel.groupby([bins_lat, bins_lng], observed=False).size().unstack(fill_value=0)
+    assert counts.values.sum() == len(plevel)
+
+    counts.index = list(counts.index.categories.left)
+    counts.columns = list(counts.columns.categories.left)
+    return counts.iloc[::-1]
+
+
+def edge_points(rects, grid_area):
+    # Points on every inner and upper grid edge, crossed with the cell centres of the other axis
+    rows = []
+    for level_id in sorted(rects):
+        grid_horiz, grid_vertic = functions.get_grids(rects, level_id, grid_area, functions.FIG_AREA)
+        edges_lat, edges_lng = np.sort(grid_horiz), np.sort(grid_vertic)
+        centres_lat, centres_lng = (edges_lat[1:] + edges_lat[:-1]) / 2, (edges_lng[1:] + edges_lng[:-1]) / 2
+        for lat in np.concatenate([edges_lat[1:], centres_lat]):
+            for lng in np.concatenate([edges_lng[1:], centres_lng]):
+                rows.append((level_id, lat, lng))
+    return pd.DataFrame(rows, columns=['level', 'lat', 'lng'])
+
+
+@pytest.fixture(scope='module')
+def dataset():
+    return loader.load_data()
+
+
+@pytest.mark.parametrize('grid_area', GRID_AREAS)
+def test_get_bins_matches_pd_cut(dataset, grid_area):
+    for level_id in sorted(dataset.rects):
+        expected = reference_bins(dataset.points, dataset.rects, level_id, grid_area)
+        bins = functions.get_bins(dataset.points, dataset.rects, level_id, grid_area)
+        np.testing.assert_array_equal(bins.values, expected.values)
+        assert list(bins.index) == list(expected.index)
+        assert list(bins.columns) == list(expected.columns)
+
+
+@pytest.mark.parametrize('grid_area', GRID_AREAS)
+def test_get_bins_levels_on_edges(dataset, grid_area):
+    points = edge_points(dataset.rects, grid_area)
+    bins_levels = functions.get_bins_levels(points, dataset.rects, grid_area=grid_area)
+    for level_id in sorted(dataset.rects):
+        expected = reference_bins(points, dataset.rects, level_id, grid_area)
+        np.testing.assert_array_equal(bins_levels[level_id].values, expected.values)
+        assert list(bins_levels[level_id].index) == list(expected.index)
@@ -0,0 +1,29 @@
+import os
+
+import pandas as pd
+import pytest
+
+import clean
+import synth
+
+
+CHUNKSIZES = [1, 7, 500, 10**6]
+
+
+@pytest.fixture(scope='module')
+def points_path(tmp_path_factory):
+    # Synthetic raw export with incomplete players and replayed levels
+    levels, agents = synth.load_levels_and_agents()
+    points, users = synth.generate(300, levels, agents)
+    save_to = str(tmp_path_factory.mktemp('raw'))
+    synth.write_data_dir(points, users, levels, save_to)
+    return os.path.join(save_to, 'raw', 'points.psv')
+
+
+@pytest.mark.parametrize('chunksize', CHUNKSIZES)
+def test_stream_clean_points_matches_clean_points(points_path, chunksize):
+    raw = pd.read_csv(points_path, sep='|', index_col='id')
+    expected = clean.clean_points(raw)
+    points, n_rows = clean.stream_clean_points(points_path, chunksize)
+    assert n_rows == len(raw)
+    assert points.to_csv(sep='|') == expected.to_csv(sep='|')
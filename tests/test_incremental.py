@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import clean
+import functions
+import incremental
+import synth
+
+
+@pytest.fixture(scope='module')
+def raw():
+    levels, agents = synth.load_levels_and_agents()
+    points, _ = synth.generate(200, levels, agents)
+    rects = {level['level']: functions.get_rect(level['polygon']) for level in levels}
+    return points.set_index('id'), rects
+
+
+def split_clean(points):
+    # Cleaned points of the players, their ids, and the truth points, as analysis.py reads them
+    points = clean.clean_points(points)
+    points_truth = points[points.user_id == synth.TRUTH_ID].reset_index(drop=True)
+    points = points[~points.user_id.isin([synth.TRUTH_ID, synth.EXPERT_ID])]
+    return points.reset_index(drop=True), points.index.values, points_truth
+
+
+def assert_same_stats(level_stats, expected):
+    for level_id, stats in expected.items():
+        assert level_stats[level_id].n == stats.n
+        assert np.isclose(level_stats[level_id].mean, stats.mean)
+        assert np.isclose(level_stats[level_id].m2, stats.m2)
+        assert (level_stats[level_id].bins.values == stats.bins.values).all()
+
+
+def test_refresh_folds_new_points(raw, tmp_path):
+    points, rects = raw
+    path = str(tmp_path / 'state.json')
+    first = split_clean(points[points.user_id <= 100])
+    incremental.refresh_level_stats(path, *first, rects)
+
+    # Players after the first run only add points with higher ids
+    clean_points, point_ids, points_truth = split_clean(points)
+    level_stats, num_folded, is_rebuilt = incremental.refresh_level_stats(path, clean_points, point_ids, points_truth, rects)
+    assert not is_rebuilt
+    assert num_folded == (point_ids > first[1].max()).sum()
+
+    expected = incremental.update_level_stats(incremental.get_level_stats(points_truth, rects), clean_points)
+    assert_same_stats(level_stats, expected)
+    assert incremental.refresh_level_stats(path, clean_points, point_ids, points_truth, rects)[1:] == (0, False)
+
+
+def test_refresh_rebuilds_on_replayed_level(raw, tmp_path):
+    points, rects = raw
+    path = str(tmp_path / 'state.json')
+    incremental.refresh_level_stats(path, *split_clean(points), rects)
+
+    # A complete player replays a level already folded: its new point replaces the folded one
+    folded, folded_ids, _ = split_clean(points)
+    replayed = points.loc[[folded_ids[0]]].copy()
+    replayed.index = [points.index.max() + 1]
+    replayed[['lat', 'lng', 'timestamp']] = [0.0, 100.0, '2099-01-01 00:00:00']
+    points = pd.concat([points, replayed]).rename_axis('id')
+
+    clean_points, point_ids, points_truth = split_clean(points)
+    level_stats, num_folded, is_rebuilt = incremental.refresh_level_stats(path, clean_points, point_ids, points_truth, rects)
+    assert folded_ids[0] not in point_ids
+    assert is_rebuilt
+    assert num_folded == len(clean_points)
+
+    expected = incremental.update_level_stats(incremental.get_level_stats(points_truth, rects), clean_points)
+    assert_same_stats(level_stats, expected)
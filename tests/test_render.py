@@ -0,0 +1,19 @@
+import numpy as np
+
+import functions
+import render
+
+
+def test_func_digest_follows_repo_helpers():
+    references = render._repo_references(functions.plot_heatmap)
+    assert {functions.plot_heatmap, functions.get_bins, functions.get_grids} <= references
+    assert np.histogram2d not in references
+
+
+def test_func_digest_changes_with_helper(monkeypatch):
+    digest = render.func_digest(functions.plot_heatmap)
+    assert render.func_digest(functions.plot_heatmap) == digest
+
+    # get_bins now resolves to another function of the repo, as if its source had been edited
+    monkeypatch.setattr(functions, 'get_bins', functions.get_bins_levels)
+    assert render.func_digest(functions.plot_heatmap) != digest
@@ -0,0 +1,34 @@
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
+import numpy as np
+import pandas as pd
+
+import functions
+import loader
+
+
+def test_dilate_counts_spreads_isolated_points():
+    counts = np.zeros((5, 6), dtype=np.int64)
+    counts[0, 0], counts[2, 3], counts[2, 4] = 1, 2, 7
+    dilated = functions.dilate_counts(counts)
+    assert (dilated[:2, :2] == 1).all()
+    assert (dilated[1:4, 2:6] == np.array([[2, 7, 7, 7], [2, 2, 7, 7], [2, 7, 7, 7]])).all()
+    assert (dilated[counts > 0] == counts[counts > 0]).all()
+    assert dilated[4, 0] == 0
+
+
+def test_raster_scatter_matches_axes_pixels():
+    points, users, levels, rects, truth_id, expert_id = loader.load_data()
+    level_id = 3
+    top_lat, top_lng, bot_lat, bot_lng = functions.get_rect_bounds(rects[level_id])
+    single = pd.DataFrame({'level': [level_id], 'lat': [(top_lat + bot_lat) / 2], 'lng': [(top_lng + bot_lng) / 2]})
+
+    fig = Figure()
+    ax = functions.plot_scatter(single, rects, level_id, backend='raster', grid_area=None, with_img=False, ax=fig.add_subplot())
+    raster = ax.get_images()[0].get_array()
+    bbox = ax.get_window_extent()
+    assert raster.shape[:2] == (int(round(bbox.height)), int(round(bbox.width)))
+
+    # The single point covers a 3x3 square of opaque pixels
+    assert (np.asarray(raster)[..., 3] > 0).sum() == 9
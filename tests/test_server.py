@@ -0,0 +1,93 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+import analysis
+import functions
+import loader
+import server
+
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'scripts')
+
+
+async def get(port, target):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write('GET {} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n'.format(target).encode())
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+
+    head, _, body = response.partition(b'\r\n\r\n')
+    status_line, *header_lines = head.decode('latin-1').split('\r\n')
+    headers = {name.lower(): value.strip() for name, _, value in (line.partition(':') for line in header_lines)}
+    return int(status_line.split()[1]), headers, body
+
+
+async def serve_and_get(targets):
+    service = server.Service()
+    srv = await asyncio.start_server(lambda reader, writer: server.serve_connection(service, reader, writer), '127.0.0.1', 0)
+    port = srv.sockets[0].getsockname()[1]
+    try:
+        async with srv:
+            return [await get(port, target) for target in targets]
+    finally:
+        service.close()
+
+
+def player_distances():
+    # Same steps as analysis.py
+    points, users, levels, rects, truth_id, expert_id = loader.load_data()
+    points_truth = points[points.user_id == truth_id].reset_index(drop=True)
+    points_expert = points[points.user_id == expert_id].reset_index(drop=True)
+    points = points[~points.user_id.isin([truth_id, expert_id])].reset_index(drop=True)
+    dists, dists_expert = functions.get_dist_levels(points_truth, points_expert, points)
+    return points, dists, dists_expert
+
+
+def expected_stats(level_id):
+    # analysis.py with its default parameters
+    points, dists, dists_expert = player_distances()
+    dist_points = functions.filter_iqr(dists[(points.level == level_id).values], analysis.NUM_IQR)
+    test_stat, pvalue = analysis.calc_test_stat_and_pvalue(dist_points, dists_expert[level_id], alternative=analysis.DIRECTION)
+    return len(dist_points), test_stat, pvalue, analysis.test_signif(test_stat, pvalue, alpha=analysis.ALPHA, alternative=analysis.DIRECTION)
+
+
+def test_stats_matches_analysis_and_is_cached():
+    (status, headers, body), (status_again, headers_again, body_again) = asyncio.run(serve_and_get(['/levels/1/stats'] * 2))
+
+    assert status == 200 and status_again == 200
+    assert headers['x-cache'] == 'miss'
+    assert headers_again['x-cache'] == 'hit'
+    assert body_again == body
+
+    stats = json.loads(body)
+    n, test_stat, pvalue, is_signif = expected_stats(1)
+    assert stats['n'] == n
+    assert stats['test_stat'] == test_stat
+    assert stats['pvalue'] == pvalue
+    assert stats['significant'] == is_signif
+
+
+def test_errors():
+    (bad_param, _, _), (bad_level, _, _), (bad_route, _, _) = asyncio.run(serve_and_get(
+        ['/levels/1/stats?alpha=2', '/levels/9/stats', '/nowhere']))
+    assert (bad_param, bad_level, bad_route) == (400, 404, 404)
+
+
+def test_cumulative_does_not_import_matplotlib():
+    # Run in a fresh interpreter, since other tests may have imported matplotlib already
+    code = ("import asyncio, json, sys, test_server; "
+            "(status, _, body), = asyncio.run(test_server.serve_and_get(['/levels/2/cumulative?filter=none'])); "
+            "print(json.dumps([status, json.loads(body)['mean'][-1], 'matplotlib' in sys.modules]))")
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.dirname(__file__), SCRIPTS_DIR]))
+    status, last_mean, has_matplotlib = json.loads(subprocess.check_output([sys.executable, '-c', code], env=env))
+
+    points, dists, _ = player_distances()
+    assert status == 200
+    assert np.isclose(last_mean, dists[(points.level == 2).values].mean())
+    assert not has_matplotlib
@@ -0,0 +1,31 @@
+import pandas as pd
+
+import clean
+import loader
+import store
+
+
+def test_store_round_trips_loaded_points_and_users(tmp_path):
+    points, users, levels, rects, truth_id, expert_id = loader.load_data()
+    conn = store.connect(str(tmp_path / 'pinisi.db'))
+    store.upsert_points(conn, points, store.LEVEL_IDS)
+    store.upsert_users(conn, users)
+
+    for level_id in store.LEVEL_IDS:
+        expected = points[points['level'].values == level_id].sort_values(by=['user_id', 'level'], kind='mergesort')
+        pd.testing.assert_frame_equal(store.load_level(conn, level_id), expected)
+
+    loaded_users = store.load_users(conn)
+    assert loaded_users['timestamp'].dtype == users['timestamp'].dtype
+    assert (loaded_users['timestamp'] == users['timestamp']).all()
+
+
+def test_store_keeps_last_raw_point_at_microseconds(tmp_path):
+    raw = pd.read_csv(clean.RAW_POINTS, sep='|', index_col='id')
+    conn = store.connect(str(tmp_path / 'pinisi.db'))
+    store.upsert_points(conn, raw, store.LEVEL_IDS)
+
+    points, users, levels, rects, truth_id, expert_id = loader.load_data()
+    stored = pd.concat([store.load_level(conn, level_id) for level_id in store.LEVEL_IDS])
+    assert stored['timestamp'].dtype == points['timestamp'].dtype
+    assert sorted(stored.index) == sorted(points.index)